@@ -1,27 +1,49 @@
-import google.generativeai as genai
+import time
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from config import Config
+from caches import AnswerCache
+from metrics import span, observe, STAGE_ERRORS
 
-# Kiểm tra cấu hình API
-if Config.GEMINI_API_KEY:
-    genai.configure(api_key=Config.GEMINI_API_KEY)
-    print("Đã gọi thành công Gemini API!")
-else:
+# Kiểm tra cấu hình API (thư viện Gemini chỉ được import và cấu hình ở lần gọi đầu tiên)
+if not Config.GEMINI_API_KEY:
     print("Chưa có API_KEY trong .env!")
 
-def ask_gemini(question, context_docs):
-    if not Config.GEMINI_API_KEY:
-        return None
+AI_ERROR_MESSAGE = "Xin lỗi, AI đang gặp sự cố kết nối."
+MAX_CONTEXT_DOCS = 5 # Giới hạn 5 context để tránh quá dài
 
-    try:
-        model = genai.GenerativeModel('gemini-2.5-flash') 
+answer_cache = AnswerCache()
+
+_model = None
+_model_lock = threading.Lock()
+
+# Luồng riêng cho các lần gọi Gemini: giới hạn số câu trả lời sinh đồng thời để vài câu chậm không chiếm hết worker.
+_generation_pool = ThreadPoolExecutor(max_workers=Config.AI_MAX_CONCURRENT, thread_name_prefix="gemini")
+
+# Khởi tạo model Gemini một lần và dùng lại cho mọi request.
+def get_gemini_model():
+    global _model
+    with _model_lock:
+        if _model is None:
+            import google.generativeai as genai
+            genai.configure(api_key=Config.GEMINI_API_KEY)
+            _model = genai.GenerativeModel(Config.GEMINI_MODEL)
+            print("Đã gọi thành công Gemini API!")
+        return _model
+
+def gemini_model_loaded():
+    return _model is not None
 
-        context_text = ""
-        limit_docs = context_docs[:5]   # Giới hạn 5 context để tránh quá dài
+# Tạo prompt từ câu hỏi và các đoạn tài liệu tham khảo.
+def build_prompt(question, context_docs):
+    context_text = ""
+    limit_docs = context_docs[:MAX_CONTEXT_DOCS]
 
-        for i, doc in enumerate(limit_docs):
-            context_text += f"--- Thông tin {i+1} ---\n{doc}\n\n"
+    for i, doc in enumerate(limit_docs):
+        context_text += f"--- Thông tin {i+1} ---\n{doc}\n\n"
 
-        prompt = f"""
+    return f"""
         Bạn là trợ lý AI của trường Đại học Giao thông Vận tải (UTC).
         Nhiệm vụ: Trả lời câu hỏi của sinh viên dựa CHÍNH XÁC vào thông tin được cung cấp.
         
@@ -37,9 +59,116 @@ def ask_gemini(question, context_docs):
         {context_text}
         """
 
-        response = model.generate_content(prompt)
-        return response.text
+# Khóa cache câu trả lời cho câu hỏi + context; None nếu không biết id chunk nguồn (không cache).
+def _answer_key(question, context_docs, chunk_ids):
+    if chunk_ids is None:
+        return None
+    return AnswerCache.make_key(Config.GEMINI_MODEL, question, chunk_ids[:MAX_CONTEXT_DOCS], context_docs[:MAX_CONTEXT_DOCS])
+
+# chunk_ids: id các chunk tương ứng với context_docs, dùng cho cache câu trả lời.
+def ask_gemini(question, context_docs, chunk_ids=None):
+    if not Config.GEMINI_API_KEY:
+        return None
+
+    key = _answer_key(question, context_docs, chunk_ids)
+    if key is not None:
+        cached = answer_cache.get(key)
+        if cached is not None:
+            return cached
+
+    future = None
+    try:
+        with span("gemini"):
+            future = _generation_pool.submit(lambda: get_gemini_model().generate_content(build_prompt(question, context_docs)).text)
+            answer = future.result(timeout=Config.AI_TIMEOUT_SECONDS)
+        if key is not None and answer:
+            answer_cache.put(key, answer, chunk_ids[:MAX_CONTEXT_DOCS])
+        return answer
 
     except Exception as e:
+        if future is not None:
+            future.cancel() # Quá thời gian chờ khi lượt gọi còn xếp hàng trong pool: bỏ luôn, không chiếm luồng sinh câu trả lời.
         print(f"Lỗi gọi Gemini: {e}")
-        return "Xin lỗi, AI đang gặp sự cố kết nối."
\ No newline at end of file
+        return AI_ERROR_MESSAGE
+
+# Sinh câu trả lời dạng stream: trả về từng cặp (ok, text) ngay khi Gemini gửi về.
+# ok = False khi Gemini lỗi/quá thời gian chờ (kể cả giữa chừng), text lúc đó là AI_ERROR_MESSAGE: nơi gọi không được cache câu trả lời dở dang.
+# Việc gọi Gemini chạy trong _generation_pool, generator này chỉ đọc từ hàng đợi nên có thể ngắt khi quá thời gian chờ.
+# Khi generator kết thúc sớm (quá thời gian chờ, lỗi, client ngắt kết nối) thì báo luồng sinh dừng đọc stream của Gemini.
+def stream_gemini(question, context_docs, chunk_ids=None):
+    if not Config.GEMINI_API_KEY:
+        return
+
+    key = _answer_key(question, context_docs, chunk_ids)
+    if key is not None:
+        cached = answer_cache.get(key)
+        if cached is not None: # Câu trả lời đã có: gửi nguyên một lần.
+            yield True, cached
+            return
+
+    chunks = queue.Queue()
+    done = object() # Đánh dấu kết thúc stream.
+    stop = threading.Event() # Người đọc đã bỏ stream: luồng sinh dừng lại thay vì đọc hết câu trả lời.
+    started = time.perf_counter()
+
+    def generate():
+        try:
+            for part in get_gemini_model().generate_content(build_prompt(question, context_docs), stream=True):
+                if stop.is_set():
+                    break
+                chunks.put(part)
+        except Exception as e:
+            chunks.put(e)
+        finally:
+            chunks.put(done)
+
+    future = _generation_pool.submit(generate)
+
+    first_token_at = None
+    token_count = 0
+    parts = []
+    try:
+        while True:
+            try:
+                item = chunks.get(timeout=Config.AI_TIMEOUT_SECONDS)
+            except queue.Empty:
+                print("Lỗi gọi Gemini: quá thời gian chờ")
+                STAGE_ERRORS.inc(stage="gemini")
+                yield False, AI_ERROR_MESSAGE
+                return
+            if item is done:
+                break
+            if isinstance(item, Exception):
+                print(f"Lỗi gọi Gemini: {item}")
+                STAGE_ERRORS.inc(stage="gemini")
+                yield False, AI_ERROR_MESSAGE
+                return
+
+            try:
+                text = getattr(item, 'text', '') or ''
+            except ValueError as e: # Chunk không có nội dung hợp lệ (vd. bị bộ lọc an toàn chặn): .text ném ValueError.
+                print(f"Lỗi gọi Gemini: {e}")
+                STAGE_ERRORS.inc(stage="gemini")
+                yield False, AI_ERROR_MESSAGE
+                return
+            if not text:
+                continue
+            if first_token_at is None:
+                first_token_at = time.perf_counter()
+            usage = getattr(item, 'usage_metadata', None)
+            token_count = getattr(usage, 'candidates_token_count', 0) or token_count + len(text.split())
+            parts.append(text)
+            yield True, text
+    finally:
+        stop.set()
+        future.cancel() # Chưa bắt đầu (pool đang bận) thì không cần gọi Gemini nữa.
+
+    if key is not None and parts:
+        answer_cache.put(key, "".join(parts), chunk_ids[:MAX_CONTEXT_DOCS])
+
+    observe("gemini", time.perf_counter() - started)
+    if first_token_at is not None:
+        observe("gemini_first_token", first_token_at - started)
+        total = time.perf_counter() - started
+        gen_time = max(total - (first_token_at - started), 1e-6)
+        print(f"--- Gemini: TTFB {(first_token_at - started) * 1000:.0f} ms, {token_count} tokens, {token_count / gen_time:.1f} tokens/s ---")
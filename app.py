@@ -1,13 +1,69 @@
-from flask import Flask, render_template, request, jsonify, redirect, url_for, session, flash
+import os
+import json
+from flask import Flask, render_template, request, jsonify, redirect, url_for, session, flash, Response, stream_with_context
 from config import Config, supabase
 from models import faiss_manager
 from utils import get_file_list, pretty_name
 from services import process_upload, delete_document
-from ai_services import ask_gemini
+from jobs import job_manager
+from ai_services import ask_gemini, stream_gemini, answer_cache, gemini_model_loaded, AI_ERROR_MESSAGE
+from caches import LRUCache, normalize_query
+from models import embedding_cache, embed_model_loaded, get_embed_model, warm_up, process_rss_bytes
+from embedders import resolve_backend
+from pipeline import page_renderer
+import metrics
 
 app = Flask(__name__, template_folder="templates")
 app.secret_key = Config.SECRET_KEY
 
+# Cache kết quả tìm kiếm hoàn chỉnh, gắn với phiên bản chỉ mục nên tự hết hạn khi upload/xóa/build lại.
+result_cache = LRUCache(Config.RESULT_CACHE_SIZE)
+
+# Chạy với gunicorn --preload: tải model một lần ở tiến trình cha trước khi fork, các worker dùng chung bộ nhớ (copy-on-write).
+# Chỉ tải trọng số, chưa chạy encode, để không khởi tạo thread pool của torch/ONNX trước khi fork.
+# Khi chạy `python app.py`, tiến trình con của pool render import lại file này dưới tên __mp_main__: không tải model ở đó.
+if Config.PRELOAD_MODEL and __name__ != "__mp_main__":
+    get_embed_model()
+
+# Đo thời gian mọi request (histogram theo endpoint) và ghi lại request chậm (SLOW_REQUEST_MS).
+@app.before_request
+def _start_request_timer():
+    metrics.start_request()
+
+@app.after_request
+def _finish_request_timer(response):
+    metrics.finish_request(request.endpoint or "unknown", request.method, response.status_code, request.path)
+    return response
+
+@app.teardown_request
+def _teardown_request_timer(error=None): # Request lỗi không qua after_request: vẫn ghi nhận (đã ghi rồi thì bỏ qua).
+    metrics.finish_request(request.endpoint or "unknown", request.method, 500, request.path)
+
+# Số liệu đọc tại thời điểm Prometheus scrape.
+def _cache_counts(field):
+    return {
+        ("query_embedding",): getattr(faiss_manager.query_cache, field),
+        ("search_result",): getattr(result_cache, field),
+        ("chunk_embedding",): getattr(embedding_cache, field),
+        ("ai_answer",): getattr(answer_cache, field),
+        ("page_image",): getattr(page_renderer.cache, field),
+    }
+
+def _index_ntotal():
+    return faiss_manager.ntotal
+
+metrics.registry.callback("embeddingpdf_index_vectors", "Số vector trong chỉ mục FAISS đang phục vụ", _index_ntotal)
+metrics.registry.callback("embeddingpdf_index_generation", "Thế hệ snapshot chỉ mục đang được map", lambda: faiss_manager.generation)
+metrics.registry.callback("embeddingpdf_index_version", "Phiên bản chỉ mục trong tiến trình (tăng mỗi lần thay đổi)", lambda: faiss_manager.version, kind="counter")
+metrics.registry.callback("embeddingpdf_lexical_documents", "Số chunk trong chỉ mục từ khóa BM25", lambda: len(faiss_manager.lexical))
+metrics.registry.callback("embeddingpdf_cache_hits_total", "Số lần cache trúng", lambda: _cache_counts("hits"), kind="counter", label_names=("cache",))
+metrics.registry.callback("embeddingpdf_cache_misses_total", "Số lần cache trượt", lambda: _cache_counts("misses"), kind="counter", label_names=("cache",))
+metrics.registry.callback("embeddingpdf_jobs_in_flight", "Số job upload đang chờ hoặc đang chạy", job_manager.active_count)
+metrics.registry.callback("embeddingpdf_embed_model_loaded", "Model embedding đã được tải (1/0)", lambda: int(embed_model_loaded()))
+metrics.registry.callback("embeddingpdf_process_rss_bytes", "RSS của tiến trình worker", process_rss_bytes)
+metrics.registry.callback("embeddingpdf_process_anon_rss_bytes", "RSS ẩn danh của tiến trình worker (không gồm snapshot memory-map)",
+                          lambda: process_rss_bytes("RssAnon"))
+
 @app.route("/") # Trang chủ
 def home():
     return render_template("search_site.html")
@@ -54,98 +110,152 @@ def upload_page():
     if request.method == "POST":
         file = request.files.get("file") # Lấy file từ form
         
+        wants_json = request.accept_mimetypes.best == "application/json"
         if not file or not file.filename:
+            if wants_json: return jsonify({"error": "Vui lòng chọn file."}), 400
             flash("❌ Vui lòng chọn file.", "error")
+            return redirect(request.url)
+
+        # Đọc file ngay trong request rồi đưa vào hàng đợi xử lý nền, không giữ worker Flask trong lúc OCR/embedding.
+        job_id = job_manager.submit(f"Upload {file.filename}", process_upload, file.read(), file.filename)
+        if job_id is None:
+            if wants_json: return jsonify({"error": "Hệ thống đang xử lý quá nhiều file, vui lòng thử lại sau."}), 429
+            flash("⚠️ Hệ thống đang xử lý quá nhiều file, vui lòng thử lại sau.", "warning")
+            return redirect(request.url)
+
+        if wants_json: return jsonify({"job_id": job_id}), 202
+        flash(f"✅ Đã nhận {file.filename}, đang xử lý nền.", "success")
+        return redirect(url_for('upload_page', job=job_id))
+
+    return render_template("upload_site.html", files=get_file_list(), job_id=request.args.get("job"))
+
+@app.route("/api/jobs/<job_id>") # API xem tiến độ xử lý upload
+def job_status(job_id):
+    if 'user' not in session: return jsonify({'error': 'Unauthorized'}), 401
+    job = job_manager.get(job_id)
+    if job is None: return jsonify({'error': 'Không tìm thấy job'}), 404
+    return jsonify(job)
+
+# Lấy nội dung các chunk từ kho cục bộ cạnh chỉ mục (không gọi DB), trả về dict id -> dòng dữ liệu.
+def _fetch_docs(doc_ids):
+    if not doc_ids:
+        return {}
+    return faiss_manager.get_chunks(list(doc_ids))
+
+# Tạo danh sách kết quả hiển thị (giữ thứ tự điểm) và context cho AI từ các kết quả hợp lệ.
+def _build_results(matches, docs, search_type):
+    results = []
+    context_for_ai = [] # List context cho AI
+
+    for doc_id, score in matches: # Duyệt qua từng kết quả
+        doc = docs.get(doc_id)
+        if doc is None:
+            continue
+        meta = doc.get('metadata', {})
+        image_url = meta.get('image_url') # Lấy URL ảnh
+        raw_content = doc.get('content', '') # Lấy nội dung
+        
+        # Loại bỏ prefix thừa
+        clean_content = raw_content.replace('Tiêu đề: ', '', 1).replace('\nNội dung: ', '\n', 1) # Loại bỏ prefix thừa
+
+        if search_type == 'image' and not image_url:
+            continue 
+            
+        safe_name = meta.get('source_file', '')
+        item = {
+            "id": doc_id,
+            "title": meta.get('section_title', 'N/A'),
+            "similarity": score,
+            "source_file_pretty_name": pretty_name(safe_name),
+            "source_file_url": supabase.storage.from_(Config.BUCKET_NAME).get_public_url(safe_name) if safe_name else "#"
+        }
+        
+        if search_type == 'image':
+            item["page_number"] = meta.get('page', 'N/A')
+            item["image_url"] = image_url
+            item["content_body"] = "" 
+        elif search_type == 'ai':
+            # Mode AI: Lấy context, item result để hiển thị reference gọn
+            context_for_ai.append(clean_content) # Thêm context vào list
+            item["content_body"] = "" # Không cần body dài dòng ở reference
         else:
-            try:
-                success, msg = process_upload(file) # Xử lý upload
-                if success: flash(f"✅ {msg}", "success")
-                else: flash(f"⚠️ {msg}", "warning")
-            except Exception as e:
-                flash(f"❌ Lỗi upload: {e}", "error")
-                print(f"Upload error: {e}")
-        return redirect(request.url)
+            # Mode Text
+            item["content_body"] = clean_content.replace('\n', '<br>')
+            item["image_url"] = image_url 
+            
+        results.append(item)
+    return results, context_for_ai
+
+SEARCH_MODES = ('vector', 'lexical', 'hybrid')
+
+# Chế độ tìm kiếm từ tham số mode (mặc định theo cấu hình).
+def _search_mode(value):
+    return value if value in SEARCH_MODES else Config.SEARCH_MODE
+
+# Bộ lọc phạm vi tìm kiếm từ tham số (file_id, page_from, page_to), trả về tuple để dùng làm khóa cache.
+def _scope_filters(args):
+    def page(name):
+        value = args.get(name)
+        try:
+            return int(value) if value not in (None, "") else None
+        except (TypeError, ValueError):
+            return None
+    return (args.get("file_id") or None, page("page_from"), page("page_to"))
 
-    return render_template("upload_site.html", files=get_file_list())
+# Id các chunk trong phạm vi; mode ảnh chỉ tìm trong các chunk có ảnh trang để không bị hụt kết quả khi lọc sau.
+def _scope(filters, search_type):
+    return faiss_manager.scope_ids(*filters, image_only=search_type == 'image')
+
+# Tìm kiếm + lấy nội dung kết quả, trả về (results, context_for_ai).
+def _retrieve(q, search_type, mode, filters=(None, None, None)):
+    valid_matches = faiss_manager.search_matches(q, top_k=Config.TOP_K_SEARCH, mode=mode, scope=_scope(filters, search_type)) # Tìm kiếm
+    if not valid_matches: # Nếu không tìm thấy kết quả
+        return [], []
+    docs = _fetch_docs([mid for mid, _ in valid_matches]) # Lấy nội dung từ kho chunk cục bộ
+    return _build_results(valid_matches, docs, search_type)
+
+# Khóa cache kết quả tìm kiếm.
+def _result_cache_key(q, search_type, mode, filters):
+    return (normalize_query(q), search_type, mode, filters, Config.TOP_K_SEARCH, Config.SIMILARITY_THRESHOLD)
 
 @app.route("/api/search") # API tìm kiếm
 def search():
     search_type = request.args.get("type", "ai") 
     q = request.args.get("q", "")
+    mode = _search_mode(request.args.get("mode"))
+    filters = _scope_filters(request.args) # Tùy chọn: chỉ tìm trong một tài liệu / khoảng trang
     
     if not q: return jsonify({"error": "Thiếu từ khóa"}), 400 
     
+    cache_key = _result_cache_key(q, search_type, mode, filters)
+    faiss_manager.check_for_updates() # Chuyển sang thế hệ mới (nếu có) trước khi đọc cache, tránh trả kết quả của thế hệ cũ.
+    index_version = faiss_manager.version # Đọc trước khi tìm kiếm để kết quả không bị gắn với phiên bản mới hơn.
+    cached = result_cache.get(cache_key, version=index_version)
+    if cached is not None:
+        return jsonify(cached)
+
     try:
-        dists, idxs, id_map = faiss_manager.search(q, top_k=Config.TOP_K_SEARCH) # Tìm kiếm
-        
-        if not id_map or idxs.size == 0 or idxs[0].size == 0: # Nếu không tìm thấy kết quả
-             return jsonify({"query": q, "results": [], "type": search_type})
-
-        valid_matches = []
-        for i, dist in zip(idxs, dists):
-            if i > -1 and dist >= Config.SIMILARITY_THRESHOLD: # Nếu kết quả tương đồng lớn hơn ngưỡng
-                if i in id_map: 
-                    valid_matches.append((id_map[i], float(dist))) # Thêm kết quả vào list
-                
-        if not valid_matches:
-            return jsonify({"query": q, "results": [], "type": search_type}) 
-            
-        top_ids = [mid for mid, _ in valid_matches] # Lấy ID của kết quả
-        scores = {mid: s for mid, s in valid_matches} # Lấy điểm tương đồng của kết quả
-        
-        res = supabase.table('documents').select('id, content, metadata').in_('id', top_ids).execute() # Lấy dữ liệu từ DB
-        
-        sorted_docs = sorted(res.data, key=lambda x: top_ids.index(x['id'])) # Sắp xếp kết quả theo ID
-        results = []
-        context_for_ai = [] # List context cho AI
-
-        for doc in sorted_docs: # Duyệt qua từng kết quả
-            meta = doc.get('metadata', {})
-            image_url = meta.get('image_url') # Lấy URL ảnh
-            raw_content = doc.get('content', '') # Lấy nội dung
-            
-            # Loại bỏ prefix thừa
-            clean_content = raw_content.replace('Tiêu đề: ', '', 1).replace('\nNội dung: ', '\n', 1) # Loại bỏ prefix thừa
-
-            if search_type == 'image' and not image_url:
-                continue 
-                
-            safe_name = meta.get('source_file', '')
-            item = {
-                "id": doc['id'],
-                "title": meta.get('section_title', 'N/A'),
-                "similarity": scores[doc['id']],
-                "source_file_pretty_name": pretty_name(safe_name),
-                "source_file_url": supabase.storage.from_(Config.BUCKET_NAME).get_public_url(safe_name) if safe_name else "#"
-            }
-            
-            if search_type == 'image':
-                item["page_number"] = meta.get('page', 'N/A')
-                item["image_url"] = image_url
-                item["content_body"] = "" 
-            elif search_type == 'ai':
-                # Mode AI: Lấy context, item result để hiển thị reference gọn
-                context_for_ai.append(clean_content) # Thêm context vào list
-                item["content_body"] = "" # Không cần body dài dòng ở reference
-            else:
-                # Mode Text
-                item["content_body"] = clean_content.replace('\n', '<br>')
-                item["image_url"] = image_url 
-                
-            results.append(item)
+        results, context_for_ai = _retrieve(q, search_type, mode, filters)
+        if not results: # Nếu không tìm thấy kết quả
+            response = {"query": q, "results": [], "type": search_type}
+            result_cache.put(cache_key, response, version=index_version)
+            return jsonify(response) 
             
         # --- AI PROCESSING ---
         ai_answer = None
         # Chỉ gọi AI ở mode AI
         if search_type == 'ai' and results and Config.GEMINI_API_KEY:
-            ai_answer = ask_gemini(q, context_for_ai)
+            ai_answer = ask_gemini(q, context_for_ai, chunk_ids=[r["id"] for r in results])
 
-        return jsonify({
+        response = {
             "query": q, 
             "results": results, 
             "type": search_type,
             "ai_answer": ai_answer
-        })
+        }
+        if search_type != 'ai' or ai_answer not in (None, AI_ERROR_MESSAGE): # Không cache khi AI lỗi/không trả lời được.
+            result_cache.put(cache_key, response, version=index_version)
+        return jsonify(response)
 
     except Exception as e:
         print(f"Search error: {e}")
@@ -153,6 +263,170 @@ def search():
             return jsonify({"query": q, "results": [], "type": search_type})
         return jsonify({"error": str(e)}), 500
 
+# Định dạng một sự kiện Server-Sent Events.
+def _sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+@app.route("/api/search/stream") # API tìm kiếm mode AI dạng stream (SSE): gửi tài liệu tham khảo trước, sau đó từng đoạn câu trả lời
+def search_stream():
+    q = request.args.get("q", "")
+    if not q: return jsonify({"error": "Thiếu từ khóa"}), 400
+
+    mode = _search_mode(request.args.get("mode"))
+    filters = _scope_filters(request.args)
+    cache_key = _result_cache_key(q, 'ai', mode, filters)
+    faiss_manager.check_for_updates()
+    index_version = faiss_manager.version
+
+    def events():
+        cached = result_cache.get(cache_key, version=index_version)
+        if cached is not None:
+            yield _sse("references", {"query": q, "results": cached["results"], "type": "ai"})
+            if cached.get("ai_answer"):
+                yield _sse("token", {"text": cached["ai_answer"]})
+            yield _sse("done", {})
+            return
+
+        try:
+            results, context_for_ai = _retrieve(q, 'ai', mode, filters)
+        except Exception as e:
+            print(f"Search error: {e}")
+            yield _sse("error", {"error": str(e)})
+            return
+
+        yield _sse("references", {"query": q, "results": results, "type": "ai"})
+        answer = []
+        failed = False
+        if results and Config.GEMINI_API_KEY:
+            for ok, text in stream_gemini(q, context_for_ai, chunk_ids=[r["id"] for r in results]):
+                failed = failed or not ok
+                answer.append(text)
+                yield _sse("token", {"text": text})
+        yield _sse("done", {})
+
+        # Gemini lỗi giữa chừng: câu trả lời chỉ là phần đầu + thông báo lỗi, không cache.
+        ai_answer = "".join(answer) or None
+        if not failed and (ai_answer or not results):
+            result_cache.put(cache_key, {"query": q, "results": results, "type": "ai", "ai_answer": ai_answer}, version=index_version)
+
+    return Response(stream_with_context(events()), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}) # Tắt buffer của proxy để token đến trình duyệt ngay
+
+@app.route("/api/search/batch", methods=["POST"]) # API tìm kiếm nhiều câu hỏi trong một request
+def search_batch():
+    payload = request.get_json(silent=True) or {}
+    queries = payload.get("queries")
+    search_type = payload.get("type", "text")
+    top_k = payload.get("top_k", Config.TOP_K_SEARCH)
+    mode = _search_mode(payload.get("mode"))
+    filters = _scope_filters(payload)
+
+    if not isinstance(queries, list) or not queries or not all(isinstance(q, str) and q for q in queries):
+        return jsonify({"error": "queries phải là danh sách câu hỏi không rỗng"}), 400
+    if len(queries) > Config.MAX_BATCH_QUERIES:
+        return jsonify({"error": f"Tối đa {Config.MAX_BATCH_QUERIES} câu hỏi mỗi lần"}), 400
+    if not isinstance(top_k, int) or not 1 <= top_k <= 100:
+        return jsonify({"error": "top_k phải nằm trong khoảng 1-100"}), 400
+
+    try:
+        scope = _scope(filters, search_type)
+        all_matches = faiss_manager.search_matches_many(queries, top_k=top_k, mode=mode, scope=scope) # Encode cả lô + một lần quét FAISS
+        docs = _fetch_docs({mid for matches in all_matches for mid, _ in matches}) # Một lần đọc kho chunk cho toàn bộ lô
+
+        responses = []
+        for q, matches in zip(queries, all_matches):
+            results, context_for_ai = _build_results(matches, docs, search_type)
+            ai_answer = None
+            if search_type == 'ai' and results and Config.GEMINI_API_KEY:
+                ai_answer = ask_gemini(q, context_for_ai, chunk_ids=[r["id"] for r in results])
+            responses.append({"query": q, "results": results, "type": search_type, "ai_answer": ai_answer})
+        return jsonify({"results": responses})
+
+    except Exception as e:
+        print(f"Batch search error: {e}")
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/cache/stats') # API thống kê hit/miss của các cache
+def cache_stats_api():
+    return jsonify({
+        "index_version": faiss_manager.version,
+        "query_embedding": faiss_manager.query_cache.stats(),
+        "search_result": result_cache.stats(),
+        "chunk_embedding": embedding_cache.stats(),
+        "ai_answer": answer_cache.stats(),
+        "page_image": page_renderer.cache.stats(),
+        "lexical_index": faiss_manager.lexical.stats()
+    })
+
+@app.route('/api/index/recall') # API đo recall@k của chỉ mục so với tìm kiếm chính xác
+def index_recall_api():
+    if 'user' not in session: return jsonify({'error': 'Unauthorized'}), 401
+    k = request.args.get('k', Config.TOP_K_SEARCH, type=int)
+    n = request.args.get('n', 200, type=int)
+    report = faiss_manager.evaluate_recall(k=k, n_queries=n)
+    if report is None:
+        return jsonify({'error': 'Chỉ mục chưa sẵn sàng'}), 503
+    return jsonify(report)
+
+@app.route('/api/index/stats') # API thống kê bộ nhớ của chỉ mục
+def index_stats_api():
+    if 'user' not in session: return jsonify({'error': 'Unauthorized'}), 401
+    return jsonify(faiss_manager.memory_stats())
+
+@app.route('/metrics') # Số liệu theo định dạng Prometheus (mỗi worker trả về số liệu của riêng nó)
+def metrics_api():
+    return Response(metrics.registry.render(), mimetype="text/plain; version=0.0.4; charset=utf-8")
+
+@app.route('/healthz') # Kiểm tra sẵn sàng: model embedding + chỉ mục đã nạp chưa (không tự tải gì thêm)
+def healthz():
+    index = faiss_manager.index
+    model_ready = embed_model_loaded()
+    index_ready = index is not None
+    status = {
+        "status": "ready" if model_ready and index_ready else "starting",
+        "embed_model": {"loaded": model_ready, "name": Config.EMBED_MODEL_NAME, "backend": resolve_backend()},
+        "index": {
+            "loaded": index_ready,
+            "ntotal": faiss_manager.ntotal,
+            "type": faiss_manager.index_kind,
+            "codec": faiss_manager.index_codec,
+            "version": faiss_manager.version,
+            "generation": faiss_manager.generation, # Thế hệ snapshot dùng chung trên đĩa mà worker này đang map
+            "pid": os.getpid()
+        },
+        "lexical_index": faiss_manager.lexical.stats(),
+        "gemini": {"configured": bool(Config.GEMINI_API_KEY), "loaded": gemini_model_loaded()}
+    }
+    return jsonify(status), 200 if status["status"] == "ready" else 503
+
+@app.route('/page/<file>/<int:page_no>.jpg') # Ảnh trang render theo yêu cầu (PAGE_IMAGE_MODE=lazy), ?size=thumb để lấy ảnh nhỏ
+def page_image(file, page_no):
+    size = request.args.get('size') or None
+    if size is not None and size not in page_renderer.sizes:
+        return jsonify({'error': f"Cỡ ảnh không hợp lệ, chọn một trong: {', '.join(page_renderer.sizes)}"}), 400
+    if not file.lower().endswith('.pdf') or file.startswith('.'):
+        return jsonify({'error': 'Không tìm thấy trang'}), 404
+
+    # Trình duyệt đã có ảnh: trả 304 ngay, không đọc cache hay render.
+    etag = page_renderer.etag(file, page_no, size)
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        try:
+            path = page_renderer.get(file, page_no, size)
+        except Exception as e:
+            print(f"Lỗi render trang {page_no} của {file}: {e}")
+            path = None
+        if path is None:
+            return jsonify({'error': 'Không tìm thấy trang'}), 404
+        with open(path, 'rb') as f:
+            response = Response(f.read(), mimetype="image/jpeg")
+    # Tên file có mốc thời gian + uid nên ảnh của một URL không bao giờ đổi: cho phép trình duyệt/CDN cache lâu.
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = 7 * 24 * 3600
+    return response
+
 @app.route('/api/delete_file', methods=['POST']) # API xóa file
 def delete_file_api():
     if 'user' not in session: return jsonify({'error': 'Unauthorized'}), 401
@@ -167,5 +441,5 @@ def delete_file_api():
         return jsonify({'error': msg}), 500
 
 if __name__ == "__main__":
-    faiss_manager.refresh_index()
+    warm_up() # Tải model + nạp snapshot trên đĩa (chỉ lấy phần thay đổi từ DB) trước khi nhận request
     app.run(debug=True)
\ No newline at end of file
@@ -0,0 +1,283 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import datetime
+import tempfile
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+# Benchmark các luồng chính hoàn toàn offline: Supabase được thay bằng bản giả lập trong RAM (fake_supabase.py),
+# tài liệu là các file PDF quy chế tiếng Việt sinh ngẫu nhiên, model embedding có thể thay bằng backend stub.
+# Mỗi giai đoạn (chunk_pdf, process_upload, build_index, search, /api/search) báo throughput, độ trễ p50/p95/p99
+# và RSS đỉnh của tiến trình. Kết quả ghi ra JSON để so sánh giữa các phiên bản:
+#   python benchmark.py --docs 20 --pages 30 --output bench-new.json --compare bench-old.json
+#   python benchmark.py --embedder real   (dùng model thật theo EMBED_BACKEND)
+
+_SUBJECTS = ["Sinh viên", "Giảng viên", "Người học", "Cơ sở đào tạo", "Hội đồng khoa học", "Trưởng khoa", "Phòng Đào tạo", "Nhà trường"]
+_VERBS = ["có trách nhiệm", "được quyền", "phải thực hiện việc", "không được", "có nghĩa vụ", "được xem xét"]
+_OBJECTS = ["đăng ký học phần", "nộp học phí", "bảo lưu kết quả học tập", "xét tốt nghiệp", "đánh giá kết quả rèn luyện",
+            "chuyển ngành đào tạo", "dự thi kết thúc học phần", "công nhận tín chỉ", "miễn giảm học phí", "khiếu nại kết quả thi",
+            "thực tập tốt nghiệp", "học cùng lúc hai chương trình"]
+_TAILS = ["theo quy định của Bộ Giáo dục và Đào tạo", "trong thời hạn 15 ngày làm việc", "theo kế hoạch của từng học kỳ",
+          "trước khi bắt đầu năm học", "theo đề nghị của trưởng khoa", "khi có đủ hồ sơ hợp lệ", "theo quy chế hiện hành"]
+_TITLES = ["Phạm vi điều chỉnh", "Đối tượng áp dụng", "Học phí", "Đăng ký học phần", "Đánh giá kết quả học tập", "Xét tốt nghiệp",
+           "Khen thưởng và kỷ luật", "Bảo lưu kết quả", "Điều kiện dự thi", "Tổ chức thực hiện", "Chuyển điểm", "Học lại, thi lại"]
+_ROMAN = ["I", "II", "III", "IV", "V", "VI", "VII", "VIII", "IX", "X", "XI", "XII", "XIII", "XIV", "XV"]
+
+def _sentence(rng):
+    return f"{rng.choice(_SUBJECTS)} {rng.choice(_VERBS)} {rng.choice(_OBJECTS)} {rng.choice(_TAILS)}."
+
+# Sinh một file PDF quy chế: các chương, mỗi chương nhiều điều, mỗi điều vài khoản. Chữ được dựng bằng
+# insert_htmlbox (font dự phòng có sẵn của MuPDF) nên lớp text tiếng Việt có dấu đọc lại được như PDF thật.
+def synthetic_pdf(pages, seed=0, paragraphs_per_page=9):
+    import fitz
+    rng = np.random.default_rng(seed)
+    doc = fitz.open()
+    article = 0
+    for page_no in range(pages):
+        parts = []
+        if page_no % 4 == 0:
+            parts.append(f"<p><b>Chương {_ROMAN[(page_no // 4) % len(_ROMAN)]}</b></p>")
+        while len(parts) < paragraphs_per_page:
+            article += 1
+            parts.append(f"<p><b>Điều {article}. {rng.choice(_TITLES)}</b></p>")
+            for clause in range(1, int(rng.integers(2, 4)) + 1):
+                parts.append(f"<p>{clause}. {' '.join(_sentence(rng) for _ in range(int(rng.integers(2, 5))))}</p>")
+        page = doc.new_page()
+        page.insert_htmlbox(fitz.Rect(50, 50, page.rect.width - 50, page.rect.height - 50),
+                            "".join(parts),
+                            css="p { font-size: 10pt; margin-bottom: 6pt; }")
+    data = doc.tobytes(garbage=3, deflate=True)
+    doc.close()
+    return data
+
+# Câu hỏi mẫu: số điều, cụm từ khóa và câu hỏi dài (giống câu hỏi của người dùng).
+def synthetic_queries(n, seed=0, max_article=100):
+    rng = np.random.default_rng(seed)
+    queries = []
+    for i in range(n):
+        kind = i % 3
+        if kind == 0:
+            queries.append(f"Điều {int(rng.integers(1, max_article + 1))}")
+        elif kind == 1:
+            queries.append(f"{rng.choice(_OBJECTS)}")
+        else:
+            queries.append(f"{rng.choice(_SUBJECTS).lower()} có được {rng.choice(_OBJECTS)} {rng.choice(_TAILS)} không?")
+    return queries
+
+# Lấy mẫu RSS của tiến trình trong lúc một giai đoạn chạy để biết mức đỉnh (không làm chậm code như tracemalloc).
+class RssSampler:
+    def __init__(self, interval=0.005):
+        from models import process_rss_bytes
+        self._read = process_rss_bytes
+        self.interval = interval
+        self.start = self.peak = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        self.start = self.peak = self._read()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, self._read())
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, self._read())
+
+def _latency_stats(latencies_ms):
+    if not latencies_ms:
+        return {}
+    values = np.asarray(latencies_ms)
+    return {
+        "p50": round(float(np.percentile(values, 50)), 2),
+        "p95": round(float(np.percentile(values, 95)), 2),
+        "p99": round(float(np.percentile(values, 99)), 2),
+        "max": round(float(values.max()), 2),
+    }
+
+# Chạy fn(item) cho từng item (song song nếu clients > 1). fn trả về số đơn vị đã xử lý (trang, chunk, câu hỏi...).
+def run_stage(name, items, fn, unit, clients=1):
+    latencies = []
+    processed = [0]
+    lock = threading.Lock()
+
+    def one(item):
+        t0 = time.perf_counter()
+        count = fn(item)
+        elapsed = (time.perf_counter() - t0) * 1000
+        with lock:
+            latencies.append(elapsed)
+            processed[0] += 1 if count is None else count
+
+    with RssSampler() as rss:
+        started = time.perf_counter()
+        if clients > 1:
+            with ThreadPoolExecutor(max_workers=clients) as pool:
+                list(pool.map(one, items))
+        else:
+            for item in items:
+                one(item)
+        wall = time.perf_counter() - started
+
+    result = {
+        "calls": len(latencies),
+        "unit": unit,
+        "units": processed[0],
+        "wall_s": round(wall, 3),
+        "throughput_per_s": round(processed[0] / wall, 2) if wall > 0 else 0,
+        "latency_ms": _latency_stats(latencies),
+        "rss_start_mb": round(rss.start / 1e6, 1),
+        "rss_peak_mb": round(rss.peak / 1e6, 1),
+    }
+    print(f"[{name}] {result['units']} {unit} trong {wall:.2f}s ({result['throughput_per_s']} {unit}/s), "
+          f"p50={result['latency_ms'].get('p50')}ms p95={result['latency_ms'].get('p95')}ms, RSS đỉnh {result['rss_peak_mb']} MB")
+    return result
+
+# Đặt biến môi trường trước khi import config: chỉ mục, cache và backend embedding nằm trong thư mục tạm của lần chạy.
+def _prepare_environment(args, work_dir):
+    os.environ["INDEX_DIR"] = os.path.join(work_dir, "index")
+    os.environ["EMBED_CACHE_PATH"] = os.path.join(work_dir, "embeddings.sqlite")
+    os.environ["ANSWER_CACHE_PATH"] = os.path.join(work_dir, "answers.sqlite")
+    os.environ["OCR_CACHE_DIR"] = os.path.join(work_dir, "ocr")
+    os.environ["PAGE_CACHE_DIR"] = os.path.join(work_dir, "pages")
+    os.environ["PRELOAD_MODEL"] = "0"
+    os.environ["API_KEY"] = "" # Không gọi Gemini khi benchmark.
+    if args.embedder == "stub":
+        os.environ["EMBED_BACKEND"] = "stub"
+        os.environ["EMBED_STUB_DIM"] = str(args.dim)
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+# In chênh lệch throughput và p95 so với một file kết quả trước đó.
+def compare(report, baseline_path):
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = json.load(f)
+    print(f"--- So sánh với {baseline_path} (commit {baseline.get('git_commit')}) ---")
+    for name, stage in report["stages"].items():
+        old = baseline.get("stages", {}).get(name)
+        if not old:
+            continue
+        def delta(new_value, old_value):
+            return f"{(new_value - old_value) / old_value * 100:+.1f}%" if old_value else "n/a"
+        new_p95 = stage["latency_ms"].get("p95", 0)
+        old_p95 = old["latency_ms"].get("p95", 0)
+        print(f"{name:18s} throughput {old['throughput_per_s']:>10} -> {stage['throughput_per_s']:>10} ({delta(stage['throughput_per_s'], old['throughput_per_s'])}), "
+              f"p95 {old_p95}ms -> {new_p95}ms ({delta(new_p95, old_p95)}), RSS đỉnh {old['rss_peak_mb']} -> {stage['rss_peak_mb']} MB")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark offline với Supabase giả lập và bộ PDF tổng hợp.")
+    parser.add_argument("--docs", type=int, default=10, help="Số file PDF tổng hợp")
+    parser.add_argument("--pages", type=int, default=20, help="Số trang mỗi file")
+    parser.add_argument("--queries", type=int, default=200, help="Số câu hỏi cho giai đoạn tìm kiếm")
+    parser.add_argument("--top-k", type=int, default=10)
+    parser.add_argument("--clients", type=int, default=4, help="Số luồng gửi request đồng thời cho /api/search")
+    parser.add_argument("--embedder", choices=["stub", "real"], default="stub", help="stub: vector băm từ khóa, không cần tải model")
+    parser.add_argument("--dim", type=int, default=1024, help="Số chiều vector của embedder stub")
+    parser.add_argument("--db-latency-ms", type=float, default=0, help="Độ trễ giả lập mỗi request tới Supabase")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Ghi kết quả JSON ra file")
+    parser.add_argument("--compare", help="File JSON kết quả trước đó để so sánh")
+    parser.add_argument("--keep", action="store_true", help="Giữ lại thư mục làm việc (chỉ mục, cache)")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="embeddingpdf-bench-")
+    _prepare_environment(args, work_dir)
+
+    import config
+    from fake_supabase import FakeSupabase
+    fake = FakeSupabase(latency_ms=args.db_latency_ms)
+    config.supabase = fake # Phải gán trước khi import các module dùng `from config import supabase`.
+
+    import metrics
+    from models import faiss_manager
+    from services import chunk_pdf, process_upload
+    from app import app
+
+    stages = {}
+    try:
+        print(f"--- Sinh {args.docs} file PDF x {args.pages} trang ---")
+        pdfs = []
+        def generate(i):
+            pdfs.append((f"Quy che tong hop {i + 1}.pdf", synthetic_pdf(args.pages, seed=args.seed + i)))
+            return args.pages
+        stages["generate_pdf"] = run_stage("generate_pdf", range(args.docs), generate, "trang")
+
+        stages["chunk_pdf"] = run_stage("chunk_pdf", pdfs,
+            lambda item: len(chunk_pdf(item[1], item[0], process_mode='text')), "chunk")
+
+        # Luồng upload đầy đủ: OCR (bỏ qua vì đã có lớp text), render + upload ảnh, chunk, embedding, ghi DB, cập nhật chỉ mục.
+        def upload(item):
+            ok, msg = process_upload(item[1], item[0])
+            if not ok:
+                raise RuntimeError(msg)
+            return args.pages
+        stages["process_upload"] = run_stage("process_upload", pdfs, upload, "trang")
+
+        # Build lại toàn bộ từ DB giả lập (tải embedding theo trang, train/đưa vector vào index, ghi snapshot).
+        def build(_):
+            if not faiss_manager.build_index():
+                raise RuntimeError("build_index thất bại")
+            return int(faiss_manager.index.ntotal)
+        stages["build_index"] = run_stage("build_index", [None], build, "vector")
+
+        def search(q):
+            faiss_manager.search(q, args.top_k)
+            return 1
+        queries = synthetic_queries(args.queries, seed=args.seed, max_article=args.pages * 3)
+        stages["search"] = run_stage("search", queries, search, "câu hỏi")
+
+        api_queries = synthetic_queries(args.queries, seed=args.seed + 1, max_article=args.pages * 3)
+        client = app.test_client()
+        def api_search(q):
+            response = client.get("/api/search", query_string={"q": q, "type": "document"})
+            if response.status_code != 200:
+                raise RuntimeError(f"/api/search trả về {response.status_code}: {response.get_data(as_text=True)[:200]}")
+            return 1
+        stages["api_search"] = run_stage("api_search", api_queries, api_search, "request", clients=args.clients)
+        stages["api_search_cached"] = run_stage("api_search_cached", api_queries, api_search, "request", clients=args.clients)
+    finally:
+        if not args.keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    report = {
+        "created_at": datetime.datetime.now().isoformat(),
+        "git_commit": _git_commit(),
+        "python": sys.version.split()[0],
+        "settings": vars(args),
+        "config": {
+            "embed_backend": config.Config.EMBED_BACKEND,
+            "index_type": config.Config.INDEX_TYPE,
+            "vector_codec": config.Config.VECTOR_CODEC,
+            "search_mode": config.Config.SEARCH_MODE,
+        },
+        "corpus": {"documents": fake.count("documents"), "storage_files": len(fake.storage.files), "db_requests": fake.requests},
+        "stages": stages,
+        # Tổng thời gian các span bên trong (OCR, embedding, ghi DB, tìm FAISS...) để biết giai đoạn nào thay đổi.
+        "spans": {key[0]: value for key, value in sorted(metrics.STAGE_SECONDS.totals().items())},
+    }
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"--- Đã ghi kết quả vào {args.output} ---")
+    if args.compare:
+        compare(report, args.compare)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+import json
+import time
+import argparse
+import threading
+import numpy as np
+from config import Config
+from chunk_store import ChunkStore, current_store_path
+from embedders import create_embedder, EMBED_BACKENDS
+
+# So sánh các backend embedding trên chính các chunk trong kho cục bộ (kho chunk hiện tại trong INDEX_DIR):
+# độ trễ một câu hỏi, throughput encode tài liệu, throughput khi nhiều request đồng thời (gộp lô)
+# và độ tương đồng cosine với backend đầu tiên (mặc định torch hiện tại).
+#   python benchmark_embedder.py --backends torch,onnx-int8 --docs 256 --queries 64 --output bench.json
+
+# Lấy mẫu nội dung chunk và câu hỏi (dòng tiêu đề của chunk) từ kho cục bộ.
+def load_samples(n_docs, n_queries):
+    store = ChunkStore(current_store_path(Config.INDEX_DIR))
+    contents = []
+    for rows in store.iter_batches():
+        contents.extend(row['content'] for row in rows)
+        if len(contents) >= max(n_docs, n_queries):
+            break
+    if not contents:
+        raise SystemExit("Kho chunk trống, hãy build chỉ mục trước (python app.py).")
+    queries = [c.split('\n', 1)[0][:200] for c in contents[:n_queries]]
+    return contents[:n_docs], queries
+
+def _normalize(vectors):
+    vectors = np.asarray(vectors, dtype='float32')
+    return vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+# Nhiều luồng cùng gửi từng câu hỏi một (giống nhiều request tìm kiếm đồng thời), trả về số câu/giây.
+def concurrent_qps(model, queries, clients):
+    chunks = [queries[i::clients] for i in range(clients)]
+    def run(items):
+        for q in items:
+            model.encode([q])
+    threads = [threading.Thread(target=run, args=(items,)) for items in chunks]
+    started = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return len(queries) / (time.perf_counter() - started)
+
+def benchmark(backend, docs, queries, threads, clients, batch_size):
+    started = time.perf_counter()
+    model = create_embedder(backend, threads=threads)
+    load_s = time.perf_counter() - started
+    model.encode(queries[:2]) # Warm-up
+
+    latencies = []
+    for q in queries:
+        t0 = time.perf_counter()
+        model.encode([q])
+        latencies.append((time.perf_counter() - t0) * 1000)
+
+    t0 = time.perf_counter()
+    doc_vectors = model.encode(docs, batch_size=batch_size)
+    doc_s = time.perf_counter() - t0
+
+    query_vectors = model.encode(queries, batch_size=batch_size)
+    return {
+        "backend": backend,
+        "load_s": round(load_s, 2),
+        "query_latency_ms_p50": round(float(np.percentile(latencies, 50)), 2),
+        "query_latency_ms_p95": round(float(np.percentile(latencies, 95)), 2),
+        "docs_per_s": round(len(docs) / doc_s, 1),
+        "concurrent_queries_per_s": round(concurrent_qps(model, queries, clients), 1),
+    }, _normalize(doc_vectors), _normalize(query_vectors)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark các backend embedding trên chunk thật.")
+    parser.add_argument("--backends", default="torch,torch-int8,onnx,onnx-int8")
+    parser.add_argument("--docs", type=int, default=256)
+    parser.add_argument("--queries", type=int, default=64)
+    parser.add_argument("--threads", type=int, default=Config.EMBED_THREADS)
+    parser.add_argument("--clients", type=int, default=8, help="Số luồng gửi câu hỏi đồng thời")
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--output", help="Ghi kết quả JSON ra file")
+    args = parser.parse_args()
+
+    backends = [b.strip() for b in args.backends.split(",") if b.strip() in EMBED_BACKENDS]
+    docs, queries = load_samples(args.docs, args.queries)
+    print(f"--- Benchmark {backends} trên {len(docs)} chunk, {len(queries)} câu hỏi ---")
+
+    report = []
+    baseline = None
+    for backend in backends:
+        try:
+            result, doc_vectors, query_vectors = benchmark(backend, docs, queries, args.threads, args.clients, args.batch_size)
+        except Exception as e:
+            print(f"Backend {backend} lỗi: {e}")
+            report.append({"backend": backend, "error": str(e)})
+            continue
+        if baseline is None:
+            baseline = (backend, doc_vectors, query_vectors)
+        # Cosine giữa vector của backend này và backend gốc cho cùng nội dung, cùng recall@10 khi tìm câu hỏi trong tập chunk.
+        doc_cos = np.sum(doc_vectors * baseline[1], axis=1)
+        base_top = np.argsort(-(baseline[2] @ baseline[1].T), axis=1)[:, :10]
+        top = np.argsort(-(query_vectors @ baseline[1].T), axis=1)[:, :10]
+        result.update({
+            "baseline": baseline[0],
+            "cosine_mean": round(float(doc_cos.mean()), 5),
+            "cosine_min": round(float(doc_cos.min()), 5),
+            "recall_at_10": round(float(np.mean([len(set(a) & set(b)) / len(a) for a, b in zip(base_top, top)])), 4),
+        })
+        print(json.dumps(result, ensure_ascii=False))
+        report.append(result)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+if __name__ == "__main__":
+    main()
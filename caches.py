@@ -0,0 +1,309 @@
+import os
+import re
+import hashlib
+import time
+import sqlite3
+import threading
+import unicodedata
+from collections import OrderedDict
+import numpy as np
+from config import Config
+
+# Chuẩn hóa câu hỏi (dạng Unicode, khoảng trắng) để các câu giống nhau dùng chung một khóa cache.
+# Giữ nguyên hoa/thường vì mô hình e5 phân biệt hoa/thường.
+def normalize_query(text):
+    text = unicodedata.normalize('NFC', text or '')
+    return re.sub(r'\s+', ' ', text).strip()
+
+# Cache LRU trong RAM, an toàn khi dùng từ nhiều luồng, có đếm hit/miss.
+# Nếu truyền version khi get/put thì mục chỉ hợp lệ khi version khớp (dùng phiên bản chỉ mục để không trả kết quả cũ).
+class LRUCache:
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, version=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[0] != version:
+                if entry is not None:
+                    del self._data[key] # Mục thuộc phiên bản chỉ mục cũ.
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value, version=None):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._data[key] = (version, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {"size": len(self._data), "max_size": self.max_size, "hits": self.hits, "misses": self.misses,
+                    "hit_rate": round(self.hits / total, 3) if total else 0.0}
+
+# Cache embedding bền vững trên đĩa (SQLite), khóa theo tên model + hash nội dung chunk.
+# Dùng chung giữa các file, các lần upload lại và các lần build lại; giới hạn kích thước theo LRU.
+class EmbeddingCache:
+    def __init__(self, path=Config.EMBED_CACHE_PATH, model_name=Config.EMBED_MODEL_NAME, max_entries=Config.EMBED_CACHE_MAX_ENTRIES):
+        self.path = path
+        self.model_name = model_name
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._init_db()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        return conn
+
+    def _init_db(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL, last_used REAL NOT NULL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_embeddings_last_used ON embeddings(last_used)")
+
+    def _key(self, content_hash):
+        return f"{self.model_name}:{content_hash}"
+
+    # Lấy các embedding đã có, trả về dict hash -> vector float32.
+    def get_many(self, hashes):
+        found = {}
+        now = time.time()
+        keys = {self._key(h): h for h in set(hashes)}
+        key_list = list(keys)
+        with self._lock, self._connect() as conn:
+            for i in range(0, len(key_list), 500): # SQLite giới hạn số tham số mỗi câu lệnh.
+                batch = key_list[i:i + 500]
+                marks = ",".join("?" * len(batch))
+                rows = conn.execute(f"SELECT key, vector FROM embeddings WHERE key IN ({marks})", batch).fetchall()
+                for key, blob in rows:
+                    found[keys[key]] = np.frombuffer(blob, dtype='float32')
+                conn.execute(f"UPDATE embeddings SET last_used = ? WHERE key IN ({marks})", [now] + batch)
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+        return found
+
+    # Lưu embedding mới rồi xóa các mục ít dùng nhất nếu vượt quá giới hạn.
+    def put_many(self, items):
+        if not items:
+            return
+        now = time.time()
+        rows = [(self._key(h), np.asarray(v, dtype='float32').tobytes(), now) for h, v in items.items()]
+        with self._lock, self._connect() as conn:
+            conn.executemany("INSERT OR REPLACE INTO embeddings (key, vector, last_used) VALUES (?, ?, ?)", rows)
+            overflow = conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0] - self.max_entries
+            if overflow > 0:
+                conn.execute("DELETE FROM embeddings WHERE key IN (SELECT key FROM embeddings ORDER BY last_used ASC LIMIT ?)", (overflow,))
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses}
+
+# Cache câu trả lời AI bền vững trên đĩa (SQLite), khóa theo model + câu hỏi đã chuẩn hóa + các chunk context theo đúng thứ tự.
+# Mỗi mục ghi lại id các chunk nguồn để xóa ngay khi chunk bị thay thế/xóa; ngoài ra có TTL và giới hạn kích thước theo LRU.
+class AnswerCache:
+    def __init__(self, path=Config.ANSWER_CACHE_PATH, ttl=Config.ANSWER_CACHE_TTL_SECONDS, max_entries=Config.ANSWER_CACHE_MAX_ENTRIES):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._init_db()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        return conn
+
+    def _init_db(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS answers (key TEXT PRIMARY KEY, answer TEXT NOT NULL, created REAL NOT NULL, last_used REAL NOT NULL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_answers_last_used ON answers(last_used)")
+            conn.execute("CREATE TABLE IF NOT EXISTS answer_sources (key TEXT NOT NULL, chunk_id INTEGER NOT NULL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_answer_sources_chunk ON answer_sources(chunk_id)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_answer_sources_key ON answer_sources(key)")
+
+    # Khóa = hash của model, câu hỏi và (id, hash nội dung) của từng chunk context theo thứ tự.
+    @staticmethod
+    def make_key(model_name, question, chunk_ids, contexts):
+        h = hashlib.sha256(f"{model_name}\n{normalize_query(question)}".encode('utf-8'))
+        for chunk_id, text in zip(chunk_ids, contexts):
+            h.update(f"\n{chunk_id}:{hashlib.md5(text.encode('utf-8')).hexdigest()}".encode('utf-8'))
+        return h.hexdigest()
+
+    def get(self, key):
+        now = time.time()
+        with self._lock, self._connect() as conn:
+            row = conn.execute("SELECT answer, created FROM answers WHERE key = ?", (key,)).fetchone()
+            if row is not None and now - row[1] > self.ttl: # Hết hạn: xóa luôn.
+                self._delete_keys(conn, [key])
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            conn.execute("UPDATE answers SET last_used = ? WHERE key = ?", (now, key))
+            self.hits += 1
+            return row[0]
+
+    def put(self, key, answer, chunk_ids):
+        if self.max_entries <= 0:
+            return
+        now = time.time()
+        with self._lock, self._connect() as conn:
+            conn.execute("DELETE FROM answer_sources WHERE key = ?", (key,))
+            conn.execute("INSERT OR REPLACE INTO answers (key, answer, created, last_used) VALUES (?, ?, ?, ?)", (key, answer, now, now))
+            conn.executemany("INSERT INTO answer_sources (key, chunk_id) VALUES (?, ?)", [(key, int(i)) for i in set(chunk_ids)])
+            # Dọn mục hết hạn và mục ít dùng nhất nếu vượt quá giới hạn.
+            expired = [r[0] for r in conn.execute("SELECT key FROM answers WHERE created < ?", (now - self.ttl,))]
+            overflow = conn.execute("SELECT COUNT(*) FROM answers").fetchone()[0] - len(expired) - self.max_entries
+            if overflow > 0:
+                expired += [r[0] for r in conn.execute("SELECT key FROM answers WHERE created >= ? ORDER BY last_used ASC LIMIT ?", (now - self.ttl, overflow))]
+            self._delete_keys(conn, expired)
+
+    # Xóa mọi câu trả lời có dùng tới một trong các chunk (gọi khi chunk bị thay thế hoặc xóa).
+    def invalidate_chunks(self, chunk_ids):
+        ids = [int(i) for i in set(chunk_ids)]
+        if not ids:
+            return 0
+        with self._lock, self._connect() as conn:
+            keys = set()
+            for i in range(0, len(ids), 500): # SQLite giới hạn số tham số mỗi câu lệnh.
+                batch = ids[i:i + 500]
+                marks = ",".join("?" * len(batch))
+                keys.update(r[0] for r in conn.execute(f"SELECT DISTINCT key FROM answer_sources WHERE chunk_id IN ({marks})", batch))
+            self._delete_keys(conn, list(keys))
+        if keys:
+            print(f"--- Answer cache: xóa {len(keys)} câu trả lời dùng chunk đã thay đổi ---")
+        return len(keys)
+
+    def _delete_keys(self, conn, keys):
+        for i in range(0, len(keys), 500):
+            batch = keys[i:i + 500]
+            marks = ",".join("?" * len(batch))
+            conn.execute(f"DELETE FROM answers WHERE key IN ({marks})", batch)
+            conn.execute(f"DELETE FROM answer_sources WHERE key IN ({marks})", batch)
+
+    def stats(self):
+        with self._connect() as conn:
+            size = conn.execute("SELECT COUNT(*) FROM answers").fetchone()[0]
+        return {"size": size, "max_size": self.max_entries, "ttl_seconds": self.ttl, "hits": self.hits, "misses": self.misses}
+
+# Cache file trên đĩa giới hạn theo tổng dung lượng (LRU theo thời gian dùng gần nhất = mtime), dùng chung giữa các worker.
+# Khóa là đường dẫn tương đối trong thư mục cache (vd. "<tài liệu>/page_3.jpg"); ghi ra file tạm rồi đổi tên nên không đọc phải file dở.
+class DiskLRUCache:
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        # Ước lượng trong tiến trình, tính lại khi dọn. Chỉ quét thư mục ở lần ghi/thống kê đầu tiên (_ensure_size),
+        # không quét lúc import (cả tiến trình con của pool render cũng import module này).
+        self._approx_bytes = None
+
+    # Gọi khi đang giữ self._lock.
+    def _ensure_size(self):
+        if self._approx_bytes is None:
+            self._approx_bytes = sum(size for _, size, _ in self._entries())
+
+    def _path(self, key):
+        path = os.path.normpath(os.path.join(self.directory, key))
+        if not path.startswith(os.path.normpath(self.directory) + os.sep):
+            raise ValueError(f"Khóa cache không hợp lệ: {key}")
+        return path
+
+    def _entries(self):
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except OSError: # Worker khác vừa xóa.
+                    continue
+                yield path, st.st_size, st.st_mtime
+
+    # Trả về đường dẫn file nếu có trong cache (và đánh dấu vừa dùng), ngược lại None. record=False: không tính hit/miss (kiểm tra lại).
+    def get(self, key, record=True):
+        path = self._path(key)
+        try:
+            os.utime(path)
+        except OSError:
+            if record:
+                self.misses += 1
+            return None
+        if record:
+            self.hits += 1
+        return path
+
+    def put(self, key, data):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+        with self._lock:
+            self._ensure_size()
+            self._approx_bytes += len(data)
+            if self._approx_bytes > self.max_bytes:
+                self._evict(keep=path)
+        return path
+
+    # Xóa các file ít dùng nhất cho tới khi còn dưới 90% giới hạn (trừ file vừa ghi, nơi gọi đang dùng).
+    def _evict(self, keep=None):
+        entries = sorted(self._entries(), key=lambda e: e[2])
+        total = sum(size for _, size, _ in entries)
+        target = self.max_bytes * 0.9
+        for path, size, _ in entries:
+            if total <= target:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+        self._approx_bytes = total
+
+    # Xóa mọi file có khóa bắt đầu bằng prefix (vd. toàn bộ ảnh của một tài liệu vừa bị xóa).
+    def remove_prefix(self, prefix):
+        root = self._path(prefix)
+        removed = 0
+        for path, size, _ in list(self._entries()):
+            if path == root or path.startswith(root + os.sep):
+                try:
+                    os.remove(path)
+                    removed += size
+                except OSError:
+                    pass
+        for root_dir, _, _ in sorted(os.walk(root), reverse=True): # Dọn các thư mục đã rỗng.
+            try: os.rmdir(root_dir)
+            except OSError: pass
+        with self._lock:
+            self._ensure_size()
+            self._approx_bytes = max(0, self._approx_bytes - removed)
+
+    def stats(self):
+        with self._lock:
+            self._ensure_size()
+        return {"bytes": self._approx_bytes, "max_bytes": self.max_bytes, "hits": self.hits, "misses": self.misses}
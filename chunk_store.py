@@ -0,0 +1,122 @@
+import os
+import json
+import sqlite3
+import threading
+
+# Đường dẫn kho chunk của thế hệ chỉ mục hiện tại (ghi trong file đánh dấu documents.json), mặc định chunks.sqlite.
+def current_store_path(index_dir):
+    try:
+        with open(os.path.join(index_dir, "documents.json"), encoding="utf-8") as f:
+            name = json.load(f).get("chunks") or "chunks.sqlite"
+    except (OSError, ValueError):
+        name = "chunks.sqlite"
+    return os.path.join(index_dir, name)
+
+# Kho lưu nội dung + metadata của chunk trên đĩa (SQLite) nằm cạnh snapshot chỉ mục FAISS,
+# để trả kết quả tìm kiếm mà không cần gọi lại Supabase.
+class ChunkStore:
+    def __init__(self, path):
+        self.path = path
+        self._write_lock = threading.Lock()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        return conn
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    # Tạo mới (xóa dữ liệu cũ nếu có).
+    def reset(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with self._write_lock, self._connect() as conn:
+            conn.execute("DROP TABLE IF EXISTS chunks")
+            conn.execute("""CREATE TABLE chunks (
+                id INTEGER PRIMARY KEY,
+                content TEXT NOT NULL,
+                metadata TEXT NOT NULL,
+                file_id TEXT,
+                source_file TEXT,
+                page INTEGER)""")
+            conn.execute("CREATE INDEX idx_chunks_file_id ON chunks(file_id, page)")
+            conn.execute("CREATE INDEX idx_chunks_source_file ON chunks(source_file)")
+
+    # Thêm/cập nhật các chunk: mỗi dòng gồm id, content, metadata (dict hoặc chuỗi JSON như Supabase trả về).
+    def upsert(self, rows):
+        records = []
+        for row in rows:
+            meta = row.get('metadata') or {}
+            if isinstance(meta, str):
+                meta = json.loads(meta)
+            records.append((row['id'], row.get('content') or '', json.dumps(meta, ensure_ascii=False),
+                            meta.get('file_id'), meta.get('source_file'), meta.get('page')))
+        if not records:
+            return
+        with self._write_lock, self._connect() as conn:
+            conn.executemany("INSERT OR REPLACE INTO chunks (id, content, metadata, file_id, source_file, page) VALUES (?, ?, ?, ?, ?, ?)", records)
+
+    def delete(self, ids):
+        ids = [int(i) for i in ids]
+        if not ids or not self.exists():
+            return
+        with self._write_lock, self._connect() as conn:
+            for i in range(0, len(ids), 500): # SQLite giới hạn số tham số mỗi câu lệnh.
+                batch = ids[i:i + 500]
+                conn.execute(f"DELETE FROM chunks WHERE id IN ({','.join('?' * len(batch))})", batch)
+
+    # Lấy các chunk theo id, trả về dict id -> {id, content, metadata} (cùng dạng dữ liệu của bảng documents).
+    def get_many(self, ids):
+        ids = [int(i) for i in ids]
+        found = {}
+        if not ids or not self.exists():
+            return found
+        with self._connect() as conn:
+            for i in range(0, len(ids), 500):
+                batch = ids[i:i + 500]
+                rows = conn.execute(f"SELECT id, content, metadata FROM chunks WHERE id IN ({','.join('?' * len(batch))})", batch).fetchall()
+                for doc_id, content, metadata in rows:
+                    found[doc_id] = {"id": doc_id, "content": content, "metadata": json.loads(metadata)}
+        return found
+
+    # Id các chunk (tăng dần) thỏa bộ lọc: file_id, khoảng trang [page_from, page_to], chỉ chunk có ảnh trang.
+    def filter_ids(self, file_id=None, page_from=None, page_to=None, image_only=False):
+        clauses, params = [], []
+        if file_id:
+            clauses.append("file_id = ?")
+            params.append(file_id)
+        if page_from is not None:
+            clauses.append("page >= ?")
+            params.append(int(page_from))
+        if page_to is not None:
+            clauses.append("page <= ?")
+            params.append(int(page_to))
+        if image_only:
+            clauses.append("json_extract(metadata, '$.image_url') IS NOT NULL")
+        if not self.exists():
+            return []
+        where = f" WHERE {' AND '.join(clauses)}" if clauses else ""
+        with self._connect() as conn:
+            return [row[0] for row in conn.execute(f"SELECT id FROM chunks{where} ORDER BY id", params)]
+
+    # Đọc toàn bộ kho theo từng lô (theo id tăng dần), mỗi lô là list {id, content, metadata}.
+    def iter_batches(self, batch_size=5000):
+        if not self.exists():
+            return
+        last_id = None
+        with self._connect() as conn:
+            while True:
+                if last_id is None:
+                    rows = conn.execute("SELECT id, content, metadata FROM chunks ORDER BY id LIMIT ?", (batch_size,)).fetchall()
+                else:
+                    rows = conn.execute("SELECT id, content, metadata FROM chunks WHERE id > ? ORDER BY id LIMIT ?", (last_id, batch_size)).fetchall()
+                if not rows:
+                    return
+                yield [{"id": doc_id, "content": content, "metadata": json.loads(metadata)} for doc_id, content, metadata in rows]
+                last_id = rows[-1][0]
+
+    def count(self):
+        if not self.exists():
+            return 0
+        with self._connect() as conn:
+            return conn.execute("SELECT COUNT(*) FROM chunks").fetchone()[0]
@@ -13,10 +13,95 @@ class Config:
     
     # Cấu hình Gemini
     GEMINI_API_KEY = os.getenv("API_KEY")
+    GEMINI_MODEL = os.getenv("GEMINI_MODEL", "gemini-2.5-flash")
+    AI_MAX_CONCURRENT = int(os.getenv("AI_MAX_CONCURRENT", 4)) # Số câu trả lời AI được sinh đồng thời
+    AI_TIMEOUT_SECONDS = int(os.getenv("AI_TIMEOUT_SECONDS", 60)) # Thời gian chờ tối đa giữa hai lần Gemini gửi dữ liệu
     
     # Cấu hình tìm kiếm
     SIMILARITY_THRESHOLD = 0.6
     TOP_K_SEARCH = 10
+    MAX_BATCH_QUERIES = int(os.getenv("MAX_BATCH_QUERIES", 64)) # Số câu hỏi tối đa mỗi request /api/search/batch
+    # Mặc định vector: BM25 viết bằng Python chậm hơn nhiều so với FAISS, câu hỏi "Điều 12" vẫn được tra tiêu đề ở mọi chế độ.
+    SEARCH_MODE = os.getenv("SEARCH_MODE", "vector").lower() # vector | lexical | hybrid (kết hợp BM25 + vector)
+    HYBRID_ALPHA = float(os.getenv("HYBRID_ALPHA", 0.7)) # Trọng số điểm vector khi kết hợp, phần còn lại là điểm BM25
+    LEXICAL_FAST_PATH_MAX_TOKENS = int(os.getenv("LEXICAL_FAST_PATH_MAX_TOKENS", 2)) # Câu hỏi từ khóa ngắn hơn mức này trả lời bằng BM25, không encode
+    SCOPED_EXACT_MAX_VECTORS = int(os.getenv("SCOPED_EXACT_MAX_VECTORS", 4096)) # Phạm vi nhỏ hơn mức này (vd. một tài liệu) được tính chính xác, lớn hơn thì lọc trong index
+
+    # Cấu hình lưu chỉ mục FAISS xuống đĩa (snapshot) để khởi động nhanh
+    INDEX_DIR = os.getenv("INDEX_DIR", "index_data")
+    DB_PAGE_SIZE = 1000 # Số dòng tối đa mỗi lần lấy từ Supabase (giới hạn mặc định của PostgREST)
+    DB_FETCH_WORKERS = int(os.getenv("DB_FETCH_WORKERS", 4)) # Số luồng tải embedding song song khi build chỉ mục
+    INDEX_POLL_SECONDS = float(os.getenv("INDEX_POLL_SECONDS", 1)) # Khoảng cách tối thiểu giữa 2 lần worker kiểm tra thế hệ chỉ mục mới trên đĩa
+    INDEX_KEEP_GENERATIONS = int(os.getenv("INDEX_KEEP_GENERATIONS", 3)) # Số thế hệ snapshot cũ giữ lại cho các worker chưa kịp chuyển sang thế hệ mới
+    INDEX_DELTA_MAX_VECTORS = int(os.getenv("INDEX_DELTA_MAX_VECTORS", 10000)) # Số vector mới tối đa nằm trong phần delta (tìm chính xác, giữ trong RAM) trước khi gộp vào snapshot đầy đủ
+    INDEX_DELTA_MAX_SEGMENTS = int(os.getenv("INDEX_DELTA_MAX_SEGMENTS", 64)) # Số file delta tối đa kể từ snapshot đầy đủ gần nhất trước khi gộp
+
+    # Cấu hình mô hình embedding và cache embedding trên đĩa
+    EMBED_MODEL_NAME = os.getenv("EMBED_MODEL_NAME", "intfloat/multilingual-e5-large")
+    EMBED_CACHE_PATH = os.getenv("EMBED_CACHE_PATH", os.path.join("cache", "embeddings.sqlite"))
+    EMBED_CACHE_MAX_ENTRIES = int(os.getenv("EMBED_CACHE_MAX_ENTRIES", 100000)) # ~4 KB mỗi vector 1024 chiều
+    EMBED_BACKEND = os.getenv("EMBED_BACKEND", "torch").lower() # torch | torch-int8 | onnx | onnx-int8 | stub (vector băm từ khóa, không cần tải model)
+    EMBED_THREADS = int(os.getenv("EMBED_THREADS", 0)) # Số luồng CPU cho model (0 = mặc định của thư viện)
+    EMBED_QUANT_CONFIG = os.getenv("EMBED_QUANT_CONFIG", "avx2") # Cấu hình lượng tử hóa ONNX: avx2 | avx512 | avx512_vnni | arm64
+    EMBED_ONNX_DIR = os.getenv("EMBED_ONNX_DIR", os.path.join("cache", "onnx")) # Nơi lưu model ONNX int8 đã export
+    EMBED_BATCH_MAX = int(os.getenv("EMBED_BATCH_MAX", 32)) # Số câu tối đa gộp vào một lần encode
+    EMBED_BATCH_WAIT_MS = float(os.getenv("EMBED_BATCH_WAIT_MS", 5)) # Thời gian chờ gộp các câu hỏi đến cùng lúc (0 = tắt)
+    EMBED_STUB_DIM = int(os.getenv("EMBED_STUB_DIM", 1024)) # Số chiều vector của backend stub (bằng multilingual-e5-large)
+    PRELOAD_MODEL = os.getenv("PRELOAD_MODEL", "0").lower() in ("1", "true", "yes") # Tải model ngay khi import app (gunicorn --preload: một bản dùng chung cho mọi worker)
+
+    # Cấu hình cache cho tìm kiếm (trong RAM)
+    QUERY_CACHE_SIZE = int(os.getenv("QUERY_CACHE_SIZE", 2048)) # Số câu hỏi được giữ embedding
+    RESULT_CACHE_SIZE = int(os.getenv("RESULT_CACHE_SIZE", 1024)) # Số kết quả tìm kiếm hoàn chỉnh được giữ lại
+
+    # Cấu hình cache câu trả lời Gemini (trên đĩa, dùng chung giữa các worker)
+    ANSWER_CACHE_PATH = os.getenv("ANSWER_CACHE_PATH", os.path.join("cache", "answers.sqlite"))
+    ANSWER_CACHE_TTL_SECONDS = int(os.getenv("ANSWER_CACHE_TTL_SECONDS", 24 * 3600)) # Câu trả lời cũ hơn sẽ được sinh lại
+    ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", 5000))
+
+    # Cấu hình hàng đợi xử lý upload chạy nền
+    INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", 1)) # Số file được xử lý đồng thời (OCR rất tốn CPU)
+    INGEST_MAX_PENDING = int(os.getenv("INGEST_MAX_PENDING", 10)) # Số job tối đa đang chờ/chạy, vượt quá sẽ từ chối upload
+    JOBS_DB_PATH = os.getenv("JOBS_DB_PATH", os.path.join(INDEX_DIR, "jobs.sqlite")) # Trạng thái job dùng chung giữa các worker
+    INGEST_EMBED_BATCH = int(os.getenv("INGEST_EMBED_BATCH", 64)) # Số chunk mới được embedding mỗi lần khi chunk dạng stream
+    INGEST_INSERT_PAGE_SIZE = int(os.getenv("INGEST_INSERT_PAGE_SIZE", 200)) # Số dòng mỗi request insert vào bảng documents
+    INGEST_MAX_BUFFERED_CHUNKS = int(os.getenv("INGEST_MAX_BUFFERED_CHUNKS", 2000)) # Số chunk đã embedding được giữ chờ ảnh trang xong trước khi ghi DB
+    RENDER_PROCESSES = int(os.getenv("RENDER_PROCESSES", max(1, (os.cpu_count() or 2) // 2))) # Số tiến trình render ảnh trang
+    STORAGE_UPLOAD_WORKERS = int(os.getenv("STORAGE_UPLOAD_WORKERS", 8)) # Số luồng upload lên Supabase Storage
+
+    # Cấu hình ảnh trang: upload = render + upload mọi trang lên Storage khi nạp, lazy = chỉ render khi có người xem (/page/<file>/<n>.jpg)
+    PAGE_IMAGE_MODE = os.getenv("PAGE_IMAGE_MODE", "upload").lower()
+    PAGE_IMAGE_DPI = int(os.getenv("PAGE_IMAGE_DPI", 150)) # Độ phân giải ảnh trang cỡ đầy đủ
+    PAGE_IMAGE_QUALITY = int(os.getenv("PAGE_IMAGE_QUALITY", 80)) # Chất lượng JPEG
+    PAGE_IMAGE_SIZES = os.getenv("PAGE_IMAGE_SIZES", "thumb:480,medium:960") # Các cỡ nhỏ hơn (tên:chiều rộng tối đa px), chọn bằng ?size=thumb
+    PAGE_CACHE_DIR = os.getenv("PAGE_CACHE_DIR", os.path.join("cache", "pages")) # Cache ảnh trang (và file PDF gốc) đã render ở chế độ lazy
+    PAGE_CACHE_MAX_MB = int(os.getenv("PAGE_CACHE_MAX_MB", 1024)) # Dung lượng tối đa của cache ảnh trang, vượt quá sẽ xóa ảnh ít xem nhất
+
+    # Cấu hình OCR
+    OCR_MODE = os.getenv("OCR_MODE", "selective").lower() # selective = chỉ OCR trang thiếu text, full = OCR lại toàn bộ file
+    OCR_MIN_TEXT_CHARS = int(os.getenv("OCR_MIN_TEXT_CHARS", 50)) # Trang có ít ký tự hơn ngưỡng này được coi là trang ảnh cần OCR
+    # Mặc định chỉ dùng một nửa số lõi: OCR chạy cùng máy với web server, phần còn lại dành cho tìm kiếm và embedding.
+    OCR_JOBS = int(os.getenv("OCR_JOBS", max(1, (os.cpu_count() or 2) // 2))) # Số trang OCR song song
+    OCR_CACHE_DIR = os.getenv("OCR_CACHE_DIR", os.path.join("cache", "ocr")) # Cache kết quả OCR theo SHA-256 của file PDF
+
+    # Cấu hình loại chỉ mục FAISS: flat (chính xác, quét toàn bộ), hnsw hoặc ivf (xấp xỉ, nhanh hơn khi dữ liệu lớn)
+    INDEX_TYPE = os.getenv("INDEX_TYPE", "flat").lower()
+    HNSW_M = int(os.getenv("HNSW_M", 32)) # Số cạnh mỗi nút trong đồ thị HNSW
+    HNSW_EF_CONSTRUCTION = int(os.getenv("HNSW_EF_CONSTRUCTION", 200))
+    HNSW_EF_SEARCH = int(os.getenv("HNSW_EF_SEARCH", 64))
+    INDEX_REBUILD_DELETED_RATIO = float(os.getenv("INDEX_REBUILD_DELETED_RATIO", 0.2)) # HNSW/rerank: dựng lại index khi số vector đã xóa (đang bị lọc khi tìm) vượt tỷ lệ này
+    IVF_NLIST = int(os.getenv("IVF_NLIST", 0)) # Số cụm IVF, 0 = tự chọn theo kích thước dữ liệu (~4*sqrt(N))
+    IVF_NPROBE = int(os.getenv("IVF_NPROBE", 16)) # Số cụm được quét khi tìm kiếm
+    IVF_MIN_TRAIN_SIZE = int(os.getenv("IVF_MIN_TRAIN_SIZE", 10000)) # Dưới ngưỡng này vẫn dùng flat, đủ dữ liệu mới train IVF
+
+    # Cấu hình nén vector để giảm RAM: none (float32, 4 KB/vector), fp16 (2 KB), sq8 (1 KB), pq (PQ_M byte)
+    VECTOR_CODEC = os.getenv("VECTOR_CODEC", "none").lower()
+    PQ_M = int(os.getenv("PQ_M", 64)) # Số sub-vector của PQ, phải chia hết số chiều (1024)
+    RERANK_K_FACTOR = int(os.getenv("RERANK_K_FACTOR", 0)) # > 0: lấy top_k * factor ứng viên rồi xếp hạng lại bằng bản fp16 của vector
+
+    # Cấu hình đo thời gian (/metrics) và ghi lại request chậm
+    SLOW_REQUEST_MS = float(os.getenv("SLOW_REQUEST_MS", 0)) # Request chạy lâu hơn mức này được ghi lại kèm thời gian từng giai đoạn (0 = tắt)
+    SLOW_REQUEST_PROFILE = os.getenv("SLOW_REQUEST_PROFILE", "0") == "1" # Bật cProfile cho mỗi request, lưu file .prof của request chậm (tốn CPU, chỉ bật khi điều tra)
+    SLOW_REQUEST_DIR = os.getenv("SLOW_REQUEST_DIR", os.path.join("logs", "slow_requests"))
 
 # Khởi tạo Supabase Client (Singleton)
 try:
@@ -0,0 +1,167 @@
+import os
+import re
+import time
+import hashlib
+import queue
+import threading
+import numpy as np
+from config import Config
+from lexical_index import tokenize
+
+EMBED_BACKENDS = ('torch', 'torch-int8', 'onnx', 'onnx-int8', 'stub')
+
+# Backend PyTorch của sentence-transformers (mặc định, giống trước đây). torch-int8: lượng tử hóa động các lớp Linear sang int8.
+class TorchEmbedder:
+    def __init__(self, model_name, quantize=False, threads=0):
+        import torch
+        from sentence_transformers import SentenceTransformer
+        if threads:
+            torch.set_num_threads(threads)
+        self.model = SentenceTransformer(model_name)
+        if quantize:
+            self.model = torch.quantization.quantize_dynamic(self.model.to('cpu'), {torch.nn.Linear}, dtype=torch.qint8)
+
+    def encode(self, texts, batch_size=32, show_progress_bar=False):
+        return np.asarray(self.model.encode(texts, batch_size=batch_size, show_progress_bar=show_progress_bar), dtype='float32')
+
+# Backend ONNX Runtime (CPU) qua sentence-transformers. onnx-int8: bản lượng tử hóa động int8, được export một lần vào EMBED_ONNX_DIR.
+class OnnxEmbedder:
+    def __init__(self, model_name, quantize=False, threads=0):
+        import onnxruntime as ort
+        from sentence_transformers import SentenceTransformer
+        options = ort.SessionOptions()
+        if threads:
+            options.intra_op_num_threads = threads
+            options.inter_op_num_threads = 1
+        model_kwargs = {"provider": "CPUExecutionProvider", "session_options": options}
+
+        if not quantize:
+            self.model = SentenceTransformer(model_name, backend="onnx", model_kwargs=model_kwargs)
+            return
+
+        local_dir = os.path.join(Config.EMBED_ONNX_DIR, re.sub(r"[^\w.-]+", "_", model_name))
+        file_name = f"onnx/model_qint8_{Config.EMBED_QUANT_CONFIG}.onnx"
+        if not os.path.exists(os.path.join(local_dir, file_name)):
+            from sentence_transformers import export_dynamic_quantized_onnx_model
+            print(f"--- Export model ONNX int8 ({Config.EMBED_QUANT_CONFIG}) vào {local_dir} ---")
+            model = SentenceTransformer(model_name, backend="onnx", model_kwargs={"provider": "CPUExecutionProvider"})
+            model.save(local_dir)
+            export_dynamic_quantized_onnx_model(model, Config.EMBED_QUANT_CONFIG, local_dir)
+        self.model = SentenceTransformer(local_dir, backend="onnx", model_kwargs=dict(model_kwargs, file_name=file_name))
+
+    def encode(self, texts, batch_size=32, show_progress_bar=False):
+        return np.asarray(self.model.encode(texts, batch_size=batch_size, show_progress_bar=show_progress_bar), dtype='float32')
+
+# Backend giả cho benchmark/chạy thử không cần tải model: mỗi từ (đã bỏ dấu) ứng với một vector ngẫu nhiên cố định
+# sinh từ hash của từ, vector của đoạn text là tổng các vector từ. Văn bản có nhiều từ chung sẽ có cosine cao.
+class HashEmbedder:
+    def __init__(self, dim=None):
+        self.dim = dim or Config.EMBED_STUB_DIM
+        self._token_vectors = {}
+        self._lock = threading.Lock()
+
+    def _token_vector(self, token):
+        vector = self._token_vectors.get(token)
+        if vector is None:
+            seed = int.from_bytes(hashlib.blake2b(token.encode('utf-8'), digest_size=8).digest(), 'little')
+            vector = np.random.default_rng(seed).standard_normal(self.dim).astype('float32')
+            with self._lock:
+                self._token_vectors[token] = vector
+        return vector
+
+    def encode(self, texts, batch_size=32, show_progress_bar=False):
+        out = np.zeros((len(texts), self.dim), dtype='float32')
+        for row, text in enumerate(texts):
+            for token in tokenize(text):
+                out[row] += self._token_vector(token)
+        return out
+
+# Gộp các yêu cầu encode nhỏ đến cùng lúc (vd. câu hỏi từ nhiều request) thành một lần gọi model.
+# Yêu cầu lớn (encode tài liệu) hoặc khi tắt gộp (max_wait_ms = 0) thì gọi model trực tiếp.
+class BatchingEmbedder:
+    def __init__(self, backend, name, max_batch=Config.EMBED_BATCH_MAX, max_wait_ms=Config.EMBED_BATCH_WAIT_MS):
+        self.backend = backend
+        self.name = name
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self._queue = queue.Queue()
+        self._worker = None
+        self._lock = threading.Lock()
+
+    def encode(self, texts, batch_size=32, show_progress_bar=False):
+        texts = list(texts)
+        if self.max_wait <= 0 or len(texts) >= self.max_batch:
+            return self.backend.encode(texts, batch_size=batch_size, show_progress_bar=show_progress_bar)
+
+        request = {"texts": texts, "done": threading.Event(), "result": None, "error": None}
+        self._ensure_worker()
+        self._queue.put(request)
+        request["done"].wait()
+        if request["error"] is not None:
+            raise request["error"]
+        return request["result"]
+
+    def _ensure_worker(self):
+        with self._lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._run, name="embed-batcher", daemon=True)
+                self._worker.start()
+
+    # Lấy yêu cầu đầu tiên, chờ thêm tối đa max_wait để gom đủ max_batch câu rồi encode một lần.
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            count = len(batch[0]["texts"])
+            deadline = time.perf_counter() + self.max_wait
+            while count < self.max_batch:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                try:
+                    request = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                batch.append(request)
+                count += len(request["texts"])
+
+            texts = [t for request in batch for t in request["texts"]]
+            try:
+                vectors = self.backend.encode(texts, batch_size=max(len(texts), 1)) if texts else None
+                offset = 0
+                for request in batch:
+                    n = len(request["texts"])
+                    request["result"] = vectors[offset:offset + n] if n else np.empty((0, 0), dtype='float32')
+                    offset += n
+            except Exception as e:
+                for request in batch:
+                    request["error"] = e
+            for request in batch:
+                request["done"].set()
+
+# Backend sẽ dùng (mặc định theo EMBED_BACKEND, giá trị không hợp lệ thì dùng torch).
+def resolve_backend(backend=None):
+    backend = backend or Config.EMBED_BACKEND
+    return backend if backend in EMBED_BACKENDS else 'torch'
+
+# Tên dùng làm khóa cache embedding: backend khác cho vector hơi khác nên không dùng chung cache (trừ torch mặc định).
+def embedder_cache_name(backend=None):
+    backend = resolve_backend(backend)
+    return Config.EMBED_MODEL_NAME if backend == 'torch' else f"{Config.EMBED_MODEL_NAME}@{backend}"
+
+# Tạo embedder theo cấu hình EMBED_BACKEND (torch | torch-int8 | onnx | onnx-int8 | stub).
+def create_embedder(backend=None, model_name=None, threads=None, batching=True):
+    if (backend or Config.EMBED_BACKEND) not in EMBED_BACKENDS:
+        print(f"EMBED_BACKEND không hợp lệ: {backend or Config.EMBED_BACKEND}, dùng torch")
+    backend = resolve_backend(backend)
+    model_name = model_name or Config.EMBED_MODEL_NAME
+    threads = Config.EMBED_THREADS if threads is None else threads
+
+    started = time.perf_counter()
+    if backend == 'stub':
+        model = HashEmbedder()
+    elif backend.startswith('onnx'):
+        model = OnnxEmbedder(model_name, quantize=backend == 'onnx-int8', threads=threads)
+    else:
+        model = TorchEmbedder(model_name, quantize=backend == 'torch-int8', threads=threads)
+    print(f"--- Đã tải model embedding {model_name} ({backend}) trong {time.perf_counter() - started:.1f}s ---")
+    return BatchingEmbedder(model, backend, max_wait_ms=Config.EMBED_BATCH_WAIT_MS if batching else 0)
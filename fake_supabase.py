@@ -0,0 +1,208 @@
+import json
+import time
+import threading
+
+# Bản giả lập trong RAM của các lời gọi Supabase mà ứng dụng dùng (bảng documents + Storage), để benchmark/chạy thử
+# các luồng chunk -> embedding -> ghi DB -> chỉ mục -> tìm kiếm mà không cần kết nối mạng.
+#   import config; config.supabase = FakeSupabase()  (gán trước khi import models, services, app)
+# latency_ms: độ trễ giả lập cho mỗi request (gần với gọi Supabase thật qua mạng).
+
+class FakeResponse:
+    def __init__(self, data, count=None):
+        self.data = data
+        self.count = count
+
+# Lấy giá trị theo cột, hỗ trợ cú pháp JSON "metadata->>file_id" của PostgREST.
+def _column_value(row, column):
+    if '->>' in column:
+        name, key = column.split('->>', 1)
+        value = (row.get(name) or {}).get(key)
+        return None if value is None else str(value)
+    return row.get(column)
+
+class FakeQuery:
+    def __init__(self, table, name):
+        self._table = table
+        self._name = name
+        self._columns = None
+        self._count = None
+        self._filters = []
+        self._order = None
+        self._limit = None
+        self._action = 'select'
+        self._payload = None
+
+    def select(self, columns='*', count=None):
+        self._columns = None if columns.strip() == '*' else [c.strip() for c in columns.split(',')]
+        self._count = count
+        return self
+
+    def insert(self, rows):
+        self._action = 'insert'
+        self._payload = rows if isinstance(rows, list) else [rows]
+        return self
+
+    def delete(self):
+        self._action = 'delete'
+        return self
+
+    def update(self, values):
+        self._action = 'update'
+        self._payload = values
+        return self
+
+    def eq(self, column, value):
+        self._filters.append(lambda row: _column_value(row, column) == (str(value) if '->>' in column else value))
+        return self
+
+    def gt(self, column, value):
+        self._filters.append(lambda row: row.get(column) is not None and row[column] > value)
+        return self
+
+    def lte(self, column, value):
+        self._filters.append(lambda row: row.get(column) is not None and row[column] <= value)
+        return self
+
+    def in_(self, column, values):
+        values = set(values)
+        self._filters.append(lambda row: _column_value(row, column) in values)
+        return self
+
+    def order(self, column, desc=False):
+        self._order = (column, desc)
+        return self
+
+    def limit(self, n):
+        self._limit = n
+        return self
+
+    def _matches(self, row):
+        return all(f(row) for f in self._filters)
+
+    def execute(self):
+        self._table.simulate_latency()
+        if self._action == 'insert':
+            return FakeResponse(self._table.insert(self._name, self._payload))
+        if self._action == 'delete':
+            return FakeResponse(self._table.delete(self._name, self._matches))
+        if self._action == 'update':
+            return FakeResponse(self._table.update(self._name, self._matches, self._payload))
+
+        rows = self._table.rows(self._name, self._matches)
+        count = len(rows) if self._count == 'exact' else None
+        if self._order:
+            column, desc = self._order
+            rows.sort(key=lambda row: row.get(column), reverse=desc)
+        if self._limit is not None:
+            rows = rows[:self._limit]
+        if self._columns:
+            rows = [{c: row.get(c) for c in self._columns} for row in rows]
+        return FakeResponse([dict(row) for row in rows], count)
+
+class FakeBucket:
+    def __init__(self, storage, name):
+        self._storage = storage
+        self._name = name
+
+    def upload(self, path, data, file_options=None):
+        self._storage.simulate_latency()
+        with self._storage.lock:
+            self._storage.files[(self._name, path)] = bytes(data)
+        return {"Key": f"{self._name}/{path}"}
+
+    def download(self, path):
+        self._storage.simulate_latency()
+        with self._storage.lock:
+            data = self._storage.files.get((self._name, path))
+        if data is None:
+            raise FileNotFoundError(f"{self._name}/{path}")
+        return data
+
+    def get_public_url(self, path):
+        return f"memory://{self._name}/{path}"
+
+    def remove(self, paths):
+        self._storage.simulate_latency()
+        with self._storage.lock:
+            for path in paths:
+                self._storage.files.pop((self._name, path), None)
+        return [{"name": p} for p in paths]
+
+    # Giống Storage thật: chỉ liệt kê các mục nằm ngay trong thư mục path.
+    def list(self, path=None):
+        self._storage.simulate_latency()
+        prefix = f"{path.rstrip('/')}/" if path else ""
+        with self._storage.lock:
+            names = {p[len(prefix):].split('/', 1)[0] for (bucket, p) in self._storage.files
+                     if bucket == self._name and p.startswith(prefix)}
+        return [{"name": name, "created_at": None} for name in sorted(names)]
+
+class FakeStorage:
+    def __init__(self, owner):
+        self._owner = owner
+        self.files = {} # (bucket, đường dẫn) -> bytes
+        self.lock = threading.Lock()
+
+    def simulate_latency(self):
+        self._owner.simulate_latency()
+
+    def from_(self, bucket):
+        return FakeBucket(self, bucket)
+
+class FakeSupabase:
+    def __init__(self, latency_ms=0):
+        self.latency = latency_ms / 1000
+        self._tables = {}
+        self._next_id = {}
+        self._lock = threading.Lock()
+        self.storage = FakeStorage(self)
+        self.requests = 0
+
+    def simulate_latency(self):
+        self.requests += 1
+        if self.latency > 0:
+            time.sleep(self.latency)
+
+    def table(self, name):
+        return FakeQuery(self, name)
+
+    # Cột embedding được lưu dạng chuỗi "[...]" như pgvector trả về, metadata là dict như cột jsonb.
+    def insert(self, name, rows):
+        inserted = []
+        with self._lock:
+            table = self._tables.setdefault(name, {})
+            for row in rows:
+                row = dict(row)
+                if 'id' not in row:
+                    row['id'] = self._next_id.get(name, 1)
+                self._next_id[name] = max(self._next_id.get(name, 1), row['id'] + 1)
+                if isinstance(row.get('embedding'), (list, tuple)):
+                    row['embedding'] = json.dumps([round(float(x), 6) for x in row['embedding']])
+                if isinstance(row.get('metadata'), str):
+                    row['metadata'] = json.loads(row['metadata'])
+                table[row['id']] = row
+                inserted.append(dict(row))
+        return inserted
+
+    def delete(self, name, predicate):
+        with self._lock:
+            table = self._tables.get(name, {})
+            removed = [row for row in table.values() if predicate(row)]
+            for row in removed:
+                del table[row['id']]
+        return [dict(row) for row in removed]
+
+    def update(self, name, predicate, values):
+        with self._lock:
+            updated = [row for row in self._tables.get(name, {}).values() if predicate(row)]
+            for row in updated:
+                row.update(values)
+        return [dict(row) for row in updated]
+
+    def rows(self, name, predicate):
+        with self._lock:
+            return [row for row in self._tables.get(name, {}).values() if predicate(row)]
+
+    def count(self, name):
+        with self._lock:
+            return len(self._tables.get(name, {}))
@@ -0,0 +1,23 @@
+import os
+
+# Chạy nhiều worker: gunicorn -c gunicorn.conf.py app:app
+# Model embedding được tải một lần ở tiến trình cha (preload) rồi fork, các worker dùng chung bộ nhớ thay vì mỗi worker một bản.
+os.environ.setdefault("PRELOAD_MODEL", "1")
+
+bind = os.getenv("BIND", "0.0.0.0:8000")
+workers = int(os.getenv("WEB_WORKERS", 2))
+# Worker gthread: mỗi request giữ một luồng đến khi xong, kể cả stream /api/search/stream (SSE) trong suốt thời gian Gemini sinh câu trả lời.
+# Vì vậy tối đa workers x threads request đồng thời (mặc định 8) và các stream AI đang mở chiếm luồng của tìm kiếm thường:
+# tăng WEB_THREADS nếu nhiều người dùng mode AI cùng lúc (luồng chủ yếu chờ mạng nên chi phí thấp).
+worker_class = "gthread"
+threads = int(os.getenv("WEB_THREADS", 4))
+timeout = int(os.getenv("WEB_TIMEOUT", 120))
+preload_app = True
+
+# Sau khi fork: chạy thử encode + nạp chỉ mục ở luồng nền (snapshot được memory-map nên cũng dùng chung page cache giữa các worker).
+# Worker nhận request ngay, tìm kiếm trả về rỗng cho đến khi nạp xong; lần build đầu dài hơn timeout cũng không làm worker bị kill.
+# Upload/xóa ở một worker ghi thế hệ snapshot mới, các worker khác tự chuyển sang ở request kế tiếp (INDEX_POLL_SECONDS).
+# Job upload chạy ở worker nhận file, tiến độ được ghi vào JOBS_DB_PATH nên /api/jobs/<id> trả lời được từ mọi worker.
+def post_fork(server, worker):
+    from models import warm_up
+    warm_up(background=True)
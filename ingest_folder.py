@@ -0,0 +1,138 @@
+import os
+import sys
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+# Nạp hàng loạt cả thư mục PDF (vd. toàn bộ quy chế của một học kỳ) thay vì upload từng file qua form /upload:
+#   python ingest_folder.py D:/quy-che/hk1 --workers 4
+# - OCR, render + upload ảnh trang của nhiều file chạy song song (--workers file cùng lúc, ảnh dùng chung pool render).
+# - Chunk mới của nhiều file được gom thành lô lớn (--embed-batch) để embedding, ghi DB theo trang INGEST_INSERT_PAGE_SIZE dòng.
+# - File giống hệt lần nạp trước (cùng file_id và SHA-256) được bỏ qua, trừ khi có --force.
+# - Chỉ mục FAISS chỉ được cập nhật một lần ở cuối (đồng bộ phần thay đổi), các worker web tự nạp thế hệ mới.
+
+def find_pdfs(folder, recursive=True):
+    paths = []
+    for root, dirs, files in os.walk(folder):
+        dirs.sort()
+        paths.extend(os.path.join(root, f) for f in sorted(files) if f.lower().endswith(".pdf"))
+        if not recursive:
+            break
+    return paths
+
+def main():
+    parser = argparse.ArgumentParser(description="Nạp hàng loạt các file PDF trong một thư mục vào bảng documents.")
+    parser.add_argument("folder", help="Thư mục chứa file PDF")
+    parser.add_argument("--workers", type=int, default=max(1, (os.cpu_count() or 2) // 2), help="Số file được OCR/tạo ảnh đồng thời")
+    parser.add_argument("--embed-batch", type=int, default=256, help="Số chunk (gom từ nhiều file) mỗi lần embedding")
+    parser.add_argument("--no-recursive", action="store_true", help="Không duyệt thư mục con")
+    parser.add_argument("--force", action="store_true", help="Xử lý lại cả các file không thay đổi")
+    parser.add_argument("--rebuild", action="store_true", help="Build lại toàn bộ chỉ mục ở cuối thay vì chỉ đồng bộ phần thay đổi")
+    args = parser.parse_args()
+
+    from config import Config, supabase
+    if supabase is None:
+        print("Chưa kết nối được Supabase, kiểm tra SUPABASE_URL/SUPABASE_KEY trong .env!")
+        return 1
+
+    from models import encode_documents, faiss_manager
+    from services import prepare_document, insert_chunk_rows, mark_latest_version
+    from ai_services import answer_cache
+    from utils import create_file_identifier
+
+    paths = find_pdfs(args.folder, recursive=not args.no_recursive)
+    # Hai file cùng file_id (vd. "Quy che.pdf" và "Quy che (1).pdf") là hai phiên bản của một tài liệu: chỉ nạp file đầu tiên.
+    by_id = {}
+    for path in paths:
+        file_id = create_file_identifier(os.path.basename(path))
+        if file_id in by_id:
+            print(f"Bỏ qua {path}: trùng tài liệu với {by_id[file_id]}")
+            continue
+        by_id[file_id] = path
+    paths = list(by_id.values())
+    print(f"--- Nạp {len(paths)} file PDF từ {args.folder} ({args.workers} file song song) ---")
+
+    started = time.time()
+    stats = {"ingested": 0, "skipped": 0, "failed": 0, "inserted": 0, "kept": 0, "deleted": 0}
+    pending = [] # Chunk mới của các file đã chuẩn bị xong, chờ embedding.
+    delete_ids = [] # Chunk của phiên bản cũ, chỉ xóa sau khi đã ghi xong phiên bản mới.
+    ingested = [] # (file_id, file_hash) của các file đã xử lý, chỉ đánh dấu đã nạp sau khi xóa xong chunk cũ.
+    page_size = max(1, Config.INGEST_INSERT_PAGE_SIZE)
+
+    def prepare(path):
+        with open(path, "rb") as f:
+            pdf_bytes = f.read()
+        return prepare_document(pdf_bytes, os.path.basename(path), force=args.force)
+
+    def embed_and_insert(chunks):
+        vectors = encode_documents([c['content'] for c in chunks], hashes=[c['hash'] for c in chunks], batch_size=32)
+        rows = list(zip(chunks, vectors))
+        for i in range(0, len(rows), page_size):
+            insert_chunk_rows(rows[i:i + page_size])
+        stats["inserted"] += len(rows)
+        print(f"--- Đã ghi {stats['inserted']} chunk mới ({time.time() - started:.0f}s) ---")
+
+    def collect(path, future):
+        try:
+            result = future.result()
+        except Exception as e:
+            stats["failed"] += 1
+            print(f"Lỗi xử lý {path}: {e}")
+            return
+        if result is None:
+            stats["skipped"] += 1
+            print(f"--- Không đổi, bỏ qua: {path} ---")
+            return
+        stats["ingested"] += 1
+        stats["kept"] += result["kept"]
+        pending.extend(result["chunks"])
+        delete_ids.extend(result["delete_ids"])
+        ingested.append((result["file_id"], result["file_hash"]))
+        print(f"--- {result['original_filename']}: {len(result['chunks'])} mới, {result['kept']} giữ, {len(result['delete_ids'])} xóa ---")
+
+    completed = False
+    try:
+        # Chỉ giữ tối đa 2 x workers file đang xử lý để RAM không tăng theo số file trong thư mục.
+        queue = list(reversed(paths))
+        running = {}
+        with ThreadPoolExecutor(max_workers=args.workers, thread_name_prefix="bulk-ingest") as executor:
+            while queue or running:
+                while queue and len(running) < args.workers * 2:
+                    path = queue.pop()
+                    running[executor.submit(prepare, path)] = path
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    collect(running.pop(future), future)
+                while len(pending) >= args.embed_batch:
+                    batch = pending[:args.embed_batch]
+                    del pending[:args.embed_batch]
+                    embed_and_insert(batch)
+        if pending:
+            embed_and_insert(pending)
+            pending.clear()
+
+        for i in range(0, len(delete_ids), page_size):
+            supabase.table("documents").delete().in_('id', delete_ids[i:i + page_size]).execute()
+        stats["deleted"] = len(delete_ids)
+        if delete_ids:
+            answer_cache.invalidate_chunks(delete_ids) # Câu trả lời AI dựa trên chunk cũ không còn đúng.
+        for file_id, file_hash in ingested:
+            mark_latest_version(file_id, file_hash)
+        completed = True
+    finally:
+        # Cập nhật chỉ mục một lần cho toàn bộ thay đổi (kể cả khi dừng giữa chừng, để phần đã ghi vẫn tìm kiếm được).
+        if stats["inserted"] or stats["deleted"] or args.rebuild:
+            if args.rebuild:
+                faiss_manager.build_index()
+            else:
+                faiss_manager.load_or_build()
+        if not completed:
+            print("Dừng giữa chừng: chưa xóa chunk của phiên bản cũ, chạy lại lệnh để hoàn tất.")
+
+    elapsed = time.time() - started
+    print(f"--- Xong {len(paths)} file trong {elapsed:.1f}s: nạp {stats['ingested']}, bỏ qua {stats['skipped']}, lỗi {stats['failed']}; "
+          f"chunk +{stats['inserted']} / giữ {stats['kept']} / -{stats['deleted']} ---")
+    return 1 if stats["failed"] else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
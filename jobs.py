@@ -0,0 +1,205 @@
+import os
+import json
+import socket
+import sqlite3
+import threading
+import uuid
+import time
+import datetime
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from config import Config
+from metrics import registry
+
+JOBS_FINISHED = registry.counter("embeddingpdf_jobs_total", "Số job xử lý nền đã kết thúc theo trạng thái", ("status",))
+JOB_SECONDS = registry.histogram("embeddingpdf_job_seconds", "Thời gian chạy của job xử lý nền (không tính thời gian chờ)")
+
+# Thời điểm khởi động của tiến trình (trường starttime trong /proc/<pid>/stat), None nếu không đọc được (không phải Linux).
+def _process_start(pid):
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            return f.read().rsplit(")", 1)[1].split()[19]
+    except (OSError, IndexError):
+        return None
+
+# Tiến trình sở hữu job: máy + pid + thời điểm khởi động, để pid bị tiến trình khác dùng lại sau khi khởi động lại không bị nhầm là còn sống.
+_OWNER = {"host": socket.gethostname(), "pid": os.getpid(), "start": _process_start(os.getpid())}
+
+# Tiến trình sở hữu job còn sống không. Job của máy khác hoặc trên Windows (os.kill sẽ kết thúc tiến trình) coi như còn sống.
+def _owner_alive(owner):
+    if not owner or owner.get("host") != _OWNER["host"] or os.name == "nt":
+        return True
+    pid = owner.get("pid")
+    start = _process_start(pid)
+    if start is not None or owner.get("start") is not None:
+        return start is not None and start == owner.get("start")
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        pass
+    return True
+
+# Hàng đợi xử lý nền cho các tác vụ nặng (OCR, tạo ảnh, embedding...) để request upload trả về ngay.
+# Job chạy trong tiến trình nhận upload, còn trạng thái được ghi vào SQLite (JOBS_DB_PATH) để khi chạy nhiều worker gunicorn,
+# request /api/jobs/<id> đến worker nào cũng đọc được tiến độ.
+class JobManager:
+    def __init__(self, max_workers=Config.INGEST_WORKERS, max_pending=Config.INGEST_MAX_PENDING, keep_finished=100, path=Config.JOBS_DB_PATH):
+        # Số worker nhỏ và cố định để OCR/embedding không chiếm hết CPU của các request tìm kiếm.
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="ingest")
+        self._jobs = OrderedDict() # Job của tiến trình này.
+        self._lock = threading.Lock()
+        self.max_pending = max_pending
+        self.keep_finished = keep_finished
+        self.path = path
+        self._init_db()
+        # Job đang chờ/chạy của tiến trình đã chết (worker bị kill, server khởi động lại) sẽ không bao giờ kết thúc:
+        # đánh dấu thất bại để không chiếm chỗ trong giới hạn max_pending và /api/jobs/<id> không báo "running" mãi.
+        with self._connect() as conn:
+            self._active_jobs(conn)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        return conn
+
+    def _init_db(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, status TEXT NOT NULL, data TEXT NOT NULL, updated REAL NOT NULL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status_updated ON jobs(status, updated)")
+
+    # Ghi trạng thái hiện tại của job (gọi khi đang giữ self._lock).
+    def _save(self, job):
+        with self._connect() as conn:
+            conn.execute("INSERT OR REPLACE INTO jobs (id, status, data, updated) VALUES (?, ?, ?, ?)",
+                         (job["id"], job["status"], json.dumps(job, ensure_ascii=False), time.time()))
+
+    # Số job đang chờ hoặc đang chạy của tiến trình này.
+    def active_count(self):
+        with self._lock:
+            return sum(1 for j in self._jobs.values() if j["status"] in ("queued", "running"))
+
+    # Số job đang chờ/chạy của mọi worker (bảng SQLite dùng chung); job của tiến trình đã chết được đánh dấu thất bại.
+    def _active_jobs(self, conn):
+        active = 0
+        for job_id, data in conn.execute("SELECT id, data FROM jobs WHERE status IN ('queued', 'running')").fetchall():
+            job = json.loads(data)
+            if _owner_alive(job.get("owner")):
+                active += 1
+                continue
+            job.update(status="failed", message="Tiến trình xử lý đã dừng trước khi job hoàn tất.",
+                       finished_at=datetime.datetime.now().isoformat())
+            conn.execute("UPDATE jobs SET status = ?, data = ?, updated = ? WHERE id = ?",
+                         ("failed", json.dumps(job, ensure_ascii=False), time.time(), job_id))
+            print(f"Job {job_id} bị bỏ dở (tiến trình {job.get('owner', {}).get('pid')} đã dừng), đánh dấu thất bại")
+        return active
+
+    # Đưa một tác vụ vào hàng đợi. func nhận thêm tham số report(stage, progress=None) để báo tiến độ.
+    # Trả về job id, hoặc None nếu hàng đợi đã đầy (đếm chung cho mọi worker, không phải riêng tiến trình này).
+    def submit(self, name, func, *args, **kwargs):
+        job_id = uuid.uuid4().hex[:12]
+        job = {
+            "id": job_id,
+            "name": name,
+            "status": "queued",
+            "stage": None,
+            "progress": 0.0,
+            "stages": [],
+            "message": "",
+            "created_at": datetime.datetime.now().isoformat(),
+            "finished_at": None,
+            "owner": _OWNER
+        }
+        with self._lock:
+            # Đếm và ghi job mới trong cùng một transaction ghi (BEGIN IMMEDIATE) để hai worker không cùng vượt giới hạn.
+            conn = self._connect()
+            try:
+                conn.isolation_level = None
+                conn.execute("BEGIN IMMEDIATE")
+                if self._active_jobs(conn) >= self.max_pending:
+                    conn.execute("COMMIT")
+                    return None
+                conn.execute("INSERT OR REPLACE INTO jobs (id, status, data, updated) VALUES (?, ?, ?, ?)",
+                             (job_id, job["status"], json.dumps(job, ensure_ascii=False), time.time()))
+                conn.execute("COMMIT")
+            except Exception:
+                if conn.in_transaction:
+                    conn.execute("ROLLBACK")
+                raise
+            finally:
+                conn.close()
+            self._jobs[job_id] = job
+            self._prune()
+        self._executor.submit(self._run, job_id, func, args, kwargs)
+        return job_id
+
+    # Trạng thái của job (bản sao để an toàn khi đọc từ luồng khác), kể cả job đang chạy ở worker khác.
+    def get(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is not None:
+                return {**job, "stages": [dict(s) for s in job["stages"]]}
+        with self._connect() as conn:
+            row = conn.execute("SELECT data FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def _run(self, job_id, func, args, kwargs):
+        self._update(job_id, status="running")
+        started = time.perf_counter()
+
+        def report(stage, progress=None):
+            self._report(job_id, stage, progress)
+
+        try:
+            success, msg = func(*args, report=report, **kwargs)
+            self._finish(job_id, "done" if success else "failed", msg)
+        except Exception as e:
+            print(f"Job {job_id} error: {e}")
+            self._finish(job_id, "failed", str(e))
+        JOB_SECONDS.observe(time.perf_counter() - started)
+
+    def _update(self, job_id, **fields):
+        with self._lock:
+            self._jobs[job_id].update(fields)
+            self._save(self._jobs[job_id])
+
+    # Ghi nhận giai đoạn hiện tại; khi chuyển sang giai đoạn mới thì đóng giai đoạn trước (kèm thời gian chạy).
+    def _report(self, job_id, stage, progress=None):
+        now = time.time()
+        with self._lock:
+            job = self._jobs[job_id]
+            stages = job["stages"]
+            if not stages or stages[-1]["name"] != stage:
+                if stages:
+                    stages[-1]["seconds"] = round(now - stages[-1]["started"], 2)
+                stages.append({"name": stage, "started": now, "seconds": None})
+            job["stage"] = stage
+            if progress is not None:
+                job["progress"] = round(float(progress), 3)
+            self._save(job)
+
+    def _finish(self, job_id, status, message):
+        now = time.time()
+        with self._lock:
+            job = self._jobs[job_id]
+            if job["stages"] and job["stages"][-1]["seconds"] is None:
+                job["stages"][-1]["seconds"] = round(now - job["stages"][-1]["started"], 2)
+            job.update(status=status, message=message, finished_at=datetime.datetime.now().isoformat())
+            JOBS_FINISHED.inc(status=status)
+            if status == "done":
+                job["progress"] = 1.0
+            self._save(job)
+
+    # Chỉ giữ lại keep_finished job đã kết thúc gần nhất (trong RAM của tiến trình này và trong SQLite).
+    def _prune(self):
+        finished = [jid for jid, j in self._jobs.items() if j["status"] in ("done", "failed")]
+        for jid in finished[:max(0, len(finished) - self.keep_finished)]:
+            del self._jobs[jid]
+        with self._connect() as conn:
+            conn.execute("DELETE FROM jobs WHERE status IN ('done', 'failed') AND id NOT IN "
+                         "(SELECT id FROM jobs WHERE status IN ('done', 'failed') ORDER BY updated DESC LIMIT ?)", (self.keep_finished,))
+
+# Singleton Instance
+job_manager = JobManager()
@@ -0,0 +1,133 @@
+import re
+import math
+import heapq
+import threading
+import unicodedata
+from collections import defaultdict
+
+# Tiêu đề dạng "Điều 12", "Chương III", "Mục 2", "Phần 1", "Khoản 3" (giống heading_pattern của chunk_pdf).
+_HEADING_RE = re.compile(r"^(phan|chuong|muc|dieu|khoan)\s+(\d+|[ivxlcdm]+)\b")
+
+# Chuẩn hóa tiếng Việt cho tìm kiếm từ khóa: bỏ dấu, đ -> d, chữ thường, để "dieu 12" khớp với "Điều 12".
+def fold_text(text):
+    text = unicodedata.normalize('NFD', text or '')
+    text = ''.join(c for c in text if unicodedata.category(c) != 'Mn')
+    return text.replace('đ', 'd').replace('Đ', 'D').lower()
+
+def tokenize(text):
+    return re.findall(r"\w+", fold_text(text))
+
+# Khóa tiêu đề (loại, số) của một đoạn text, ví dụ "Điều 12. Học phí" -> ("dieu", "12"); None nếu không phải tiêu đề.
+def heading_key(text):
+    m = _HEADING_RE.match(' '.join(tokenize(text)))
+    return (m.group(1), m.group(2)) if m else None
+
+# Câu hỏi chỉ gồm số hiệu điều/chương/mục (ví dụ "Điều 12", "chuong III") thì trả về khóa tiêu đề, ngược lại None.
+def parse_article_query(query):
+    tokens = tokenize(query)
+    if len(tokens) != 2:
+        return None
+    return heading_key(' '.join(tokens))
+
+# Chỉ mục từ khóa trong RAM (BM25) trên nội dung các chunk, kèm bảng tra tiêu đề -> id chunk cho câu hỏi theo số điều.
+# Cập nhật từng phần khi upload/xóa giống chỉ mục FAISS.
+class LexicalIndex:
+    def __init__(self, k1=1.5, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self._postings = defaultdict(dict) # từ -> {id chunk: số lần xuất hiện}
+        self._doc_len = {}
+        self._doc_terms = {} # id chunk -> các từ của chunk, dùng khi xóa.
+        self._total_len = 0
+        self._headings = defaultdict(set) # (loại, số) -> các id chunk thuộc tiêu đề đó.
+        self._doc_heading = {}
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._doc_len)
+
+    # Tập id các chunk đang có trong chỉ mục.
+    def ids(self):
+        with self._lock:
+            return set(self._doc_len)
+
+    # Thêm/cập nhật các chunk: mỗi dòng gồm id, content, metadata (giống dữ liệu của bảng documents).
+    def add(self, rows):
+        with self._lock:
+            for row in rows:
+                doc_id = int(row['id'])
+                if doc_id in self._doc_len:
+                    self._remove_one(doc_id)
+                tokens = tokenize(row.get('content') or '')
+                counts = defaultdict(int)
+                for t in tokens:
+                    counts[t] += 1
+                for t, tf in counts.items():
+                    self._postings[t][doc_id] = tf
+                self._doc_len[doc_id] = len(tokens)
+                self._doc_terms[doc_id] = tuple(counts)
+                self._total_len += len(tokens)
+
+                meta = row.get('metadata') or {}
+                key = heading_key(meta.get('section_title', '') if isinstance(meta, dict) else '')
+                if key is not None:
+                    self._headings[key].add(doc_id)
+                    self._doc_heading[doc_id] = key
+
+    def remove(self, ids):
+        with self._lock:
+            for doc_id in ids:
+                if int(doc_id) in self._doc_len:
+                    self._remove_one(int(doc_id))
+
+    def _remove_one(self, doc_id):
+        for t in self._doc_terms.pop(doc_id):
+            postings = self._postings[t]
+            postings.pop(doc_id, None)
+            if not postings:
+                del self._postings[t]
+        self._total_len -= self._doc_len.pop(doc_id)
+        key = self._doc_heading.pop(doc_id, None)
+        if key is not None:
+            self._headings[key].discard(doc_id)
+            if not self._headings[key]:
+                del self._headings[key]
+
+    # Các chunk thuộc tiêu đề (loại, số), sắp theo id (thứ tự xuất hiện trong tài liệu).
+    # allowed: tập id được phép (tìm kiếm trong phạm vi), None = toàn bộ.
+    def lookup_heading(self, key, top_k=10, allowed=None):
+        with self._lock:
+            ids = self._headings.get(key, set())
+            if allowed is not None:
+                ids = ids & allowed
+            return sorted(ids)[:top_k]
+
+    # Câu hỏi ngắn mà mọi từ đều có trong chỉ mục: coi là tìm theo từ khóa, không cần encode.
+    def is_keyword_query(self, query, max_tokens):
+        tokens = tokenize(query)
+        with self._lock:
+            return 0 < len(tokens) <= max_tokens and all(t in self._postings for t in tokens)
+
+    # Tìm kiếm BM25, trả về list (id, điểm) theo điểm giảm dần.
+    def search(self, query, top_k=10, allowed=None):
+        with self._lock:
+            n = len(self._doc_len)
+            if n == 0:
+                return []
+            avg_len = self._total_len / n or 1.0
+            scores = defaultdict(float)
+            for t in set(tokenize(query)):
+                postings = self._postings.get(t)
+                if not postings:
+                    continue
+                idf = math.log(1 + (n - len(postings) + 0.5) / (len(postings) + 0.5))
+                for doc_id, tf in postings.items():
+                    if allowed is not None and doc_id not in allowed:
+                        continue
+                    norm = self.k1 * (1 - self.b + self.b * self._doc_len[doc_id] / avg_len)
+                    scores[doc_id] += idf * tf * (self.k1 + 1) / (tf + norm)
+        return heapq.nlargest(top_k, scores.items(), key=lambda item: item[1])
+
+    def stats(self):
+        with self._lock:
+            return {"documents": len(self._doc_len), "terms": len(self._postings), "headings": len(self._headings)}
@@ -0,0 +1,216 @@
+import os
+import re
+import json
+import time
+import cProfile
+import datetime
+import threading
+from contextlib import contextmanager
+from config import Config
+
+# Đo thời gian từng giai đoạn (span) và xuất số liệu theo định dạng text của Prometheus cho route /metrics.
+# Không dùng thư viện ngoài: histogram/counter đơn giản trong RAM của từng tiến trình (mỗi worker một bộ số liệu).
+
+# Mốc histogram (giây): từ vài ms (tìm kiếm) đến vài phút (OCR, upload cả file).
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _label_text(names, values, extra=None):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+class Counter:
+    def __init__(self, name, help_text, label_names=()):
+        self.name = name
+        self.help = help_text
+        self.label_names = tuple(label_names)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels.get(n, "")) for n in self.label_names)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_label_text(self.label_names, key)} {value}")
+        return lines
+
+class Histogram:
+    def __init__(self, name, help_text, label_names=(), buckets=BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        self._series = {} # nhãn -> [số lần theo từng mốc, tổng, số lần]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(n, "")) for n in self.label_names)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    # Số lần và tổng thời gian theo từng bộ nhãn, vd. {("embedding",): {"count": 3, "sum": 1.2}}.
+    def totals(self):
+        with self._lock:
+            return {key: {"count": count, "sum": round(total, 6)} for key, (_, total, count) in self._series.items()}
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, (counts, total, count) in sorted(self._series.items()):
+                for bound, c in zip(self.buckets, counts):
+                    labels = _label_text(self.label_names, key, 'le="%s"' % bound)
+                    lines.append(f"{self.name}_bucket{labels} {c}")
+                labels = _label_text(self.label_names, key, 'le="+Inf"')
+                lines.append(f"{self.name}_bucket{labels} {count}")
+                lines.append(f"{self.name}_sum{_label_text(self.label_names, key)} {round(total, 6)}")
+                lines.append(f"{self.name}_count{_label_text(self.label_names, key)} {count}")
+        return lines
+
+# Số liệu đọc tại thời điểm scrape (kích thước chỉ mục, hit/miss của cache, số job đang chạy...).
+# fn trả về một số, hoặc dict {giá trị nhãn (tuple): số} khi có label_names.
+class Callback:
+    def __init__(self, name, help_text, fn, kind="gauge", label_names=()):
+        self.name = name
+        self.help = help_text
+        self.fn = fn
+        self.kind = kind
+        self.label_names = tuple(label_names)
+
+    def render(self):
+        try:
+            value = self.fn()
+        except Exception as e:
+            print(f"Lỗi đọc số liệu {self.name}: {e}")
+            return []
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        items = value.items() if isinstance(value, dict) else [((), value)]
+        for key, v in items:
+            if v is None:
+                continue
+            key = key if isinstance(key, tuple) else (key,)
+            v = float(v)
+            lines.append(f"{self.name}{_label_text(self.label_names, key)} {int(v) if v.is_integer() else v}")
+        return lines
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric):
+        with self._lock:
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help_text, label_names=()):
+        return self._register(Counter(name, help_text, label_names))
+
+    def histogram(self, name, help_text, label_names=(), buckets=BUCKETS):
+        return self._register(Histogram(name, help_text, label_names, buckets))
+
+    def callback(self, name, help_text, fn, kind="gauge", label_names=()):
+        return self._register(Callback(name, help_text, fn, kind, label_names))
+
+    # Nội dung trả về cho Prometheus (text exposition format 0.0.4).
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+registry = Registry()
+
+STAGE_SECONDS = registry.histogram("embeddingpdf_stage_seconds", "Thời gian chạy của từng giai đoạn xử lý", ("stage",))
+STAGE_ERRORS = registry.counter("embeddingpdf_stage_errors_total", "Số lần một giai đoạn bị lỗi", ("stage",))
+REQUEST_SECONDS = registry.histogram("embeddingpdf_http_request_seconds", "Thời gian xử lý request HTTP", ("endpoint", "method", "status"))
+SLOW_REQUESTS = registry.counter("embeddingpdf_slow_requests_total", "Số request chạy lâu hơn SLOW_REQUEST_MS", ("endpoint",))
+
+# Các span của request đang xử lý trong luồng hiện tại (chỉ dùng cho ghi lại request chậm).
+_request = threading.local()
+
+def _record(stage, seconds):
+    STAGE_SECONDS.observe(seconds, stage=stage)
+    spans = getattr(_request, "spans", None)
+    if spans is not None:
+        spans.append({"stage": stage, "ms": round(seconds * 1000, 2)})
+
+# Đo thời gian một đoạn code: with span("ocr"): ...
+@contextmanager
+def span(stage):
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        STAGE_ERRORS.inc(stage=stage)
+        raise
+    finally:
+        _record(stage, time.perf_counter() - started)
+
+# Ghi nhận thời gian đã đo ở nơi khác (vd. trong tiến trình con render trang).
+def observe(stage, seconds):
+    _record(stage, seconds)
+
+# Bắt đầu theo dõi một request: gom các span, bật cProfile nếu SLOW_REQUEST_PROFILE.
+def start_request():
+    _request.spans = []
+    _request.started = time.perf_counter()
+    _request.profiler = None
+    if Config.SLOW_REQUEST_MS > 0 and Config.SLOW_REQUEST_PROFILE:
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+            _request.profiler = profiler
+        except ValueError: # Đã có profiler khác đang chạy (Python 3.12+ chỉ cho một profiler mỗi tiến trình).
+            pass
+
+# Kết thúc request: ghi histogram, và nếu chậm hơn SLOW_REQUEST_MS thì lưu các span (kèm file .prof nếu có) vào SLOW_REQUEST_DIR.
+# Với response dạng stream (SSE), thời gian chỉ tính đến lúc gửi header; phần sinh câu trả lời nằm trong span "gemini".
+def finish_request(endpoint, method, status, path=""):
+    started = getattr(_request, "started", None)
+    if started is None:
+        return
+    elapsed = time.perf_counter() - started
+    spans = _request.spans
+    profiler = _request.profiler
+    _request.started = _request.spans = _request.profiler = None
+    if profiler is not None:
+        profiler.disable()
+
+    REQUEST_SECONDS.observe(elapsed, endpoint=endpoint, method=method, status=status)
+    if Config.SLOW_REQUEST_MS <= 0 or elapsed * 1000 < Config.SLOW_REQUEST_MS:
+        return
+
+    SLOW_REQUESTS.inc(endpoint=endpoint)
+    stamp = datetime.datetime.now().strftime("%Y%m%dT%H%M%S%f")
+    record = {"time": stamp, "endpoint": endpoint, "method": method, "path": path, "status": status,
+              "ms": round(elapsed * 1000, 2), "spans": spans}
+    try:
+        os.makedirs(Config.SLOW_REQUEST_DIR, exist_ok=True)
+        if profiler is not None:
+            name = re.sub(r"[^\w.-]+", "_", endpoint)
+            record["profile"] = os.path.join(Config.SLOW_REQUEST_DIR, f"{stamp}-{name}.prof")
+            profiler.dump_stats(record["profile"]) # Xem bằng: python -m pstats <file> hoặc snakeviz.
+        with open(os.path.join(Config.SLOW_REQUEST_DIR, "slow_requests.jsonl"), "a", encoding="utf-8") as f:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+    except OSError as e:
+        print(f"Lỗi ghi request chậm: {e}")
+    detail = ", ".join(f"{s['stage']}={s['ms']:.0f}" for s in spans)
+    print(f"--- Request chậm {method} {path}: {record['ms']:.0f} ms ({detail}) ---")
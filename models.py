@@ -1,65 +1,1257 @@
+import os
+import re
+import json
+import time
+import heapq
+import hashlib
+import datetime
+import threading
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
 import faiss
 import numpy as np
-import ast
-from sentence_transformers import SentenceTransformer
-from config import supabase
+from config import Config, supabase
+from caches import EmbeddingCache, LRUCache, normalize_query
+from chunk_store import ChunkStore, current_store_path
+from lexical_index import LexicalIndex, parse_article_query
+from embedders import create_embedder, embedder_cache_name
+from metrics import span
 
-# Khởi tạo mô hình Embedding (Singleton)
-embed_model = SentenceTransformer("intfloat/multilingual-e5-large")
+try:
+    import fcntl # Khóa file giữa các worker (Linux/macOS). Windows chỉ chạy một tiến trình (python app.py) nên không cần.
+except ImportError:
+    fcntl = None
+
+embedding_cache = EmbeddingCache(model_name=embedder_cache_name())
+
+# Mô hình Embedding (Singleton, backend theo EMBED_BACKEND) chỉ được tải ở lần dùng đầu tiên,
+# để import models/services (CLI, job, script) không phải chờ tải model ~2 GB.
+_embed_model = None
+_embed_model_lock = threading.Lock()
+
+def get_embed_model():
+    global _embed_model
+    with _embed_model_lock:
+        if _embed_model is None:
+            _embed_model = create_embedder()
+        return _embed_model
+
+def embed_model_loaded():
+    return _embed_model is not None
+
+# Embedding cho danh sách nội dung chunk, ưu tiên lấy từ cache theo hash nội dung (md5, giống content_hash của chunk),
+# chỉ gọi model cho các nội dung chưa từng được embed.
+def encode_documents(contents, hashes=None, batch_size=32, show_progress_bar=False):
+    if hashes is None:
+        hashes = [hashlib.md5(c.encode('utf-8')).hexdigest() for c in contents]
+    cached = embedding_cache.get_many(hashes)
+
+    missing = {} # hash -> nội dung (gộp các chunk trùng nội dung để chỉ embed một lần)
+    for h, c in zip(hashes, contents):
+        if h not in cached:
+            missing.setdefault(h, c)
+    if missing:
+        vectors = get_embed_model().encode(list(missing.values()), batch_size=batch_size, show_progress_bar=show_progress_bar)
+        new_items = dict(zip(missing.keys(), np.asarray(vectors, dtype='float32')))
+        embedding_cache.put_many(new_items)
+        cached.update(new_items)
+
+    print(f"--- Embedding: {len(set(hashes)) - len(missing)} từ cache, {len(missing)} mới ---")
+    if not contents:
+        return np.empty((0, 0), dtype='float32')
+    return np.stack([cached[h] for h in hashes])
+
+PQ_MIN_TRAIN_SIZE = 39 * 256 # Số vector tối thiểu để train PQ 8 bit ổn định.
+
+# Bộ nhớ thực tế (RSS) của tiến trình hiện tại, dùng để ước lượng kích thước container.
+# field="RssAnon": chỉ phần RAM ẩn danh (không gồm file được memory-map), chỉ có trên Linux.
+def process_rss_bytes(field="VmRSS"):
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    if field != "VmRSS":
+        return 0
+    try:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 # Đỉnh RSS (Linux tính bằng KB).
+    except ImportError:
+        return 0
+
+# Lấy các dòng của bảng documents theo từng trang (keyset theo id) để không bị giới hạn số dòng của PostgREST (1000 dòng).
+# filters: {cột: giá trị} lọc bằng eq, vd. {'metadata->>file_id': file_id}. Cột id luôn được lấy kèm để phân trang.
+def fetch_rows(columns, min_id=0, filters=None):
+    if 'id' not in [c.strip() for c in columns.split(',')]:
+        columns = f"id, {columns}"
+    rows = []
+    last_id = min_id
+    while True:
+        query = supabase.table('documents').select(columns).gt('id', last_id)
+        for column, value in (filters or {}).items():
+            query = query.eq(column, value)
+        page = query.order('id').limit(Config.DB_PAGE_SIZE).execute().data
+        if not page:
+            break
+        rows.extend(page)
+        last_id = page[-1]['id']
+        if len(page) < Config.DB_PAGE_SIZE:
+            break
+    return rows
+
+# Số chiều của một vector embedding lưu trong DB (chuỗi "[0.1,0.2,...]" của pgvector hoặc list).
+def _vector_dim(value):
+    return value.count(',') + 1 if isinstance(value, str) else len(value)
+
+# Chuyển cả trang embedding thành ma trận float32 trong một lần parse, không tạo list Python trung gian.
+def _parse_vectors(values, dim):
+    if values and not isinstance(values[0], str):
+        return np.asarray(values, dtype='float32').reshape(len(values), dim)
+    text = ",".join(v.strip()[1:-1] for v in values) # Bỏ dấu [ ] rồi nối các vector thành một chuỗi số duy nhất.
+    return np.fromstring(text, dtype='float32', sep=',').reshape(len(values), dim)
+
+# Tải embedding của các dòng có id > min_id: chia dải id cho nhiều luồng, mỗi luồng lấy theo trang
+# và ghi thẳng vào một ma trận float32 cấp phát trước (bộ nhớ đỉnh ~ kích thước ma trận cuối cùng).
+# Nếu có on_rows, nội dung + metadata của từng trang được chuyển cho on_rows(rows) rồi bỏ đi ngay.
+def load_embeddings(min_id=0, on_rows=None):
+    started = time.perf_counter()
+    head = supabase.table('documents').select('id', count='exact')\
+        .gt('id', min_id).order('id').limit(1).execute()
+    total = head.count or 0
+    if total == 0 or not head.data:
+        return np.array([], dtype='int64'), np.empty((0, 0), dtype='float32')
+
+    last = supabase.table('documents').select('id, embedding')\
+        .order('id', desc=True).limit(1).execute().data[0]
+    first_id, last_id = head.data[0]['id'], last['id']
+    dim = _vector_dim(last['embedding'])
+
+    ids = np.empty(total, dtype='int64')
+    matrix = np.empty((total, dim), dtype='float32')
+    state = {"ids": ids, "matrix": matrix, "count": 0}
+    lock = threading.Lock()
+
+    columns = 'id, embedding, content, metadata' if on_rows else 'id, embedding'
+
+    # Mỗi luồng xử lý một dải id [lo, hi], phân trang theo id nên không bị lệch khi bảng thay đổi trong lúc tải.
+    def fetch_range(lo, hi):
+        cursor = lo - 1
+        while True:
+            page = supabase.table('documents').select(columns)\
+                .gt('id', cursor).lte('id', hi).order('id').limit(Config.DB_PAGE_SIZE).execute().data
+            if not page:
+                return
+            block = _parse_vectors([row['embedding'] for row in page], dim)
+            with lock:
+                start = state["count"]
+                end = start + len(page)
+                if end > len(state["ids"]): # Có dòng mới được insert sau khi đếm: nới rộng ma trận.
+                    grow = max(end, int(len(state["ids"]) * 1.25))
+                    state["ids"] = np.resize(state["ids"], grow)
+                    state["matrix"] = np.resize(state["matrix"], (grow, dim))
+                state["ids"][start:end] = [row['id'] for row in page]
+                state["matrix"][start:end] = block
+                state["count"] = end
+            if on_rows:
+                on_rows([{"id": row['id'], "content": row['content'], "metadata": row['metadata']} for row in page])
+            cursor = page[-1]['id']
+            if len(page) < Config.DB_PAGE_SIZE:
+                return
+
+    n_ranges = max(1, min(Config.DB_FETCH_WORKERS * 4, total // Config.DB_PAGE_SIZE + 1))
+    bounds = np.linspace(first_id, last_id + 1, n_ranges + 1).astype('int64')
+    with ThreadPoolExecutor(max_workers=Config.DB_FETCH_WORKERS) as pool:
+        futures = [pool.submit(fetch_range, int(bounds[i]), int(bounds[i + 1]) - 1) for i in range(n_ranges)]
+        for f in futures:
+            f.result() # Ném lại lỗi nếu có luồng thất bại, tránh build chỉ mục thiếu dữ liệu.
+
+    count = state["count"]
+    elapsed = max(time.perf_counter() - started, 1e-6)
+    print(f"--- Đã tải {count} embeddings trong {elapsed:.1f}s ({count / elapsed:.0f} dòng/s, {count * dim * 4 / 1e6:.0f} MB) ---")
+    return state["ids"][:count], state["matrix"][:count]
+
+# Tải embedding của các dòng theo danh sách id (dòng có id nhỏ hơn mốc của snapshot nhưng chưa có trong chỉ mục,
+# vd. do worker khác ghi xen kẽ). Lấy theo lô id để URL của PostgREST không quá dài.
+def load_embeddings_by_ids(ids, on_rows=None, batch_size=200):
+    columns = 'id, embedding, content, metadata' if on_rows else 'id, embedding'
+    all_ids, blocks = [], []
+    ids = [int(i) for i in ids]
+    for i in range(0, len(ids), batch_size):
+        page = supabase.table('documents').select(columns).in_('id', ids[i:i + batch_size]).execute().data
+        if not page:
+            continue
+        blocks.append(_parse_vectors([row['embedding'] for row in page], _vector_dim(page[0]['embedding'])))
+        all_ids.extend(row['id'] for row in page)
+        if on_rows:
+            on_rows([{"id": row['id'], "content": row['content'], "metadata": row['metadata']} for row in page])
+    if not blocks:
+        return np.array([], dtype='int64'), np.empty((0, 0), dtype='float32')
+    return np.asarray(all_ids, dtype='int64'), np.vstack(blocks)
+
+# Một thế hệ chỉ mục: index FAISS kèm loại/kiểu nén và mốc max_id. Sau khi được công bố thì không bị sửa nữa:
+# người đọc lấy tham chiếu một lần cho mỗi lượt tìm kiếm, người ghi dựng thế hệ mới trên bản sao rồi thay thế bằng một phép gán.
+class IndexGeneration:
+    def __init__(self, index, kind, codec, max_id, path=None, deleted=None):
+        # FAISS lưu trực tiếp id của tài liệu trong DB (mảng int64 của IndexIDMap hoặc id của IVF), không cần dict ánh xạ riêng.
+        self.index = index
+        self.kind = kind # Loại chỉ mục thực tế đang dùng: flat, hnsw hoặc ivf.
+        self.codec = codec # Kiểu lưu vector: none, fp16, sq8 hoặc pq.
+        self.max_id = max_id # Id lớn nhất đã có trong chỉ mục, dùng làm mốc phiên bản cho snapshot.
+        self.path = path # File snapshot đang được memory-map (chỉ đọc), None nếu index nằm trong RAM.
+        # Id đã xóa nhưng vẫn nằm trong index không hỗ trợ remove_ids (HNSW, lớp rerank): bị loại khi tìm kiếm bằng IDSelector,
+        # chỉ dựng lại index khi số id đã xóa vượt INDEX_REBUILD_DELETED_RATIO. Mảng id đã sắp xếp.
+        self.deleted = np.asarray(deleted if deleted is not None else [], dtype='int64')
+        # Phần delta: vector (float32, đã chuẩn hóa) thêm sau snapshot đầy đủ, giữ trong RAM và tìm chính xác,
+        # được gộp vào index khi vượt INDEX_DELTA_MAX_VECTORS. delta_ids đã sắp xếp, cùng thứ tự với delta_vectors.
+        self.delta_ids = np.array([], dtype='int64')
+        self.delta_vectors = np.empty((0, index.d), dtype='float32')
+        self.segments = [] # Các file delta (documents-<n>.seg.npz) đã áp dụng lên file index gốc.
+        self._lookup = None # (id_map, thứ tự sắp xếp id_map, id đã sắp xếp), tính một lần cho mỗi thế hệ.
+        self._live_ids = None
+
+    # Số vector còn hiệu lực (không tính id đã xóa).
+    @property
+    def size(self):
+        return int(self.index.ntotal) - int(self.deleted.size) + int(self.delta_ids.size)
+
+    @property
+    def mapped(self):
+        return self.path is not None
+
+    # Tách các lớp của index: (index gốc flat/hnsw/ivf, lớp rerank nếu có).
+    def layers(self):
+        index = self.index
+        if hasattr(index, 'id_map'):
+            index = faiss.downcast_index(index.index)
+        refine = None
+        if isinstance(index, faiss.IndexRefine):
+            refine = index
+            index = faiss.downcast_index(index.base_index)
+        return index, refine
+
+    # Cài đặt tham số tìm kiếm (efSearch, nprobe, số ứng viên rerank) cho index.
+    def apply_search_params(self):
+        base, refine = self.layers()
+        if self.kind == 'hnsw':
+            base.hnsw.efSearch = Config.HNSW_EF_SEARCH
+        elif self.kind == 'ivf':
+            base.nprobe = Config.IVF_NPROBE
+        if refine is not None:
+            refine.k_factor = Config.RERANK_K_FACTOR
+
+    # Bảng tra id -> vị trí trong index, tính lần đầu cần dùng rồi giữ lại vì mỗi thế hệ đã công bố là bất biến.
+    # Bản sao đang sửa (writable_copy) phải gọi modified() sau mỗi lần add_with_ids/remove_ids.
+    def lookup(self):
+        if self._lookup is None:
+            if hasattr(self.index, 'id_map'):
+                id_map = faiss.vector_to_array(self.index.id_map)
+                order = np.argsort(id_map, kind='stable')
+                sorted_ids = id_map[order]
+            else:
+                invlists = self.index.invlists # IVF không bọc IDMap: id nằm trong các inverted list.
+                parts = [faiss.rev_swig_ptr(invlists.get_ids(l), invlists.list_size(l)).copy()
+                         for l in range(self.index.nlist) if invlists.list_size(l)]
+                id_map, order = None, None
+                sorted_ids = np.sort(np.concatenate(parts)) if parts else np.array([], dtype='int64')
+            self._lookup = (id_map, order, sorted_ids)
+        return self._lookup
+
+    def modified(self):
+        self._lookup = None
+        self._live_ids = None
+
+    # Các id đang có trong chỉ mục (không gồm id đã xóa, gồm phần delta), đã sắp xếp. Mảng dùng chung, không được sửa.
+    def indexed_ids(self):
+        if self._live_ids is None:
+            ids = self.lookup()[2]
+            if self.deleted.size:
+                ids = ids[~np.isin(ids, self.deleted, assume_unique=True)]
+            if self.delta_ids.size:
+                ids = np.union1d(ids, self.delta_ids)
+            ids.flags.writeable = False
+            self._live_ids = ids
+        return self._live_ids
+
+    # Lọc các id (đã sắp xếp, không trùng) chỉ giữ id có trong chỉ mục: tìm nhị phân trên indexed_ids, không sắp xếp lại cả chỉ mục.
+    def known(self, ids):
+        ids = np.asarray(ids, dtype='int64')
+        live = self.indexed_ids()
+        if ids.size == 0 or live.size == 0:
+            return ids[:0]
+        found = live[np.minimum(np.searchsorted(live, ids), live.size - 1)] == ids
+        return ids[found]
+
+    # Vị trí trong index (IndexIDMap) của các id trong DB, tra bằng tìm kiếm nhị phân trên mảng id đã sắp xếp.
+    def positions(self, ids):
+        id_map, order, sorted_ids = self.lookup()
+        return order[np.searchsorted(sorted_ids, np.asarray(ids, dtype='int64'))].astype('int64')
+
+    # Khôi phục vector (đã chuẩn hóa) theo id trong DB, từ index gốc hoặc từ phần delta.
+    def reconstruct(self, ids):
+        ids = np.asarray(ids, dtype='int64')
+        if self.delta_ids.size:
+            in_delta = np.isin(ids, self.delta_ids)
+            if in_delta.any():
+                vectors = np.empty((ids.size, self.index.d), dtype='float32')
+                vectors[in_delta] = self.delta_vectors[np.searchsorted(self.delta_ids, ids[in_delta])]
+                if not in_delta.all():
+                    vectors[~in_delta] = self._reconstruct_base(ids[~in_delta])
+                return vectors
+        return self._reconstruct_base(ids)
+
+    def _reconstruct_base(self, ids):
+        if not hasattr(self.index, 'id_map'):
+            return self.index.reconstruct_batch(ids)
+        return self.index.index.reconstruct_batch(self.positions(ids))
+
+    # Index có hỗ trợ remove_ids trực tiếp không (HNSW và lớp rerank thì không).
+    def supports_remove(self):
+        base, refine = self.layers()
+        return refine is None and self.kind != 'hnsw'
+
+    # Index gốc có nhận SearchParameters/IDSelector không (IndexPQ của FAISS từ chối mọi tham số tìm kiếm).
+    def supports_selector(self):
+        base, _ = self.layers()
+        return not isinstance(base, faiss.IndexPQ)
+
+    # Thế hệ mới dùng chung index gốc (không sao chép) với thay đổi áp dụng lên phần delta: vector mới (đã chuẩn hóa) vào delta,
+    # id bị xóa nằm trong delta thì bỏ khỏi delta, nằm trong index gốc thì đánh dấu đã xóa. Chi phí theo kích thước thay đổi
+    # và phần delta, không theo cả chỉ mục. Trả về (thế hệ mới, số vector đã xóa).
+    def with_changes(self, ids, vectors, remove_ids=()):
+        remove_ids = np.unique(np.asarray(remove_ids, dtype='int64'))
+        delta_ids, delta_vectors = self.delta_ids, self.delta_vectors
+        deleted, removed = self.deleted, 0
+        if remove_ids.size:
+            in_delta = np.isin(delta_ids, remove_ids)
+            if in_delta.any():
+                delta_ids, delta_vectors = delta_ids[~in_delta], delta_vectors[~in_delta]
+                removed += int(in_delta.sum())
+            base_ids = self.lookup()[2]
+            present = remove_ids[np.isin(remove_ids, base_ids) & ~np.isin(remove_ids, deleted)]
+            if present.size:
+                deleted = np.union1d(deleted, present)
+                removed += int(present.size)
+        ids = np.asarray(ids, dtype='int64')
+        if ids.size:
+            delta_ids = np.concatenate([delta_ids, ids])
+            delta_vectors = np.vstack([delta_vectors, np.asarray(vectors, dtype='float32').reshape(ids.size, -1)])
+            order = np.argsort(delta_ids, kind='stable')
+            delta_ids, delta_vectors = delta_ids[order], np.ascontiguousarray(delta_vectors[order])
+        gen = IndexGeneration(self.index, self.kind, self.codec, max(self.max_id, int(ids.max()) if ids.size else 0),
+                              path=self.path, deleted=deleted)
+        gen.delta_ids, gen.delta_vectors = delta_ids, delta_vectors
+        gen.segments = list(self.segments)
+        gen._lookup = self._lookup # Cùng index gốc nên dùng lại bảng tra vị trí.
+        return gen, removed
+
+    # Áp dụng một file delta (ghi bởi FaissManager._save_segment) lên thế hệ này.
+    def with_segment(self, path):
+        with np.load(path) as data:
+            gen, _ = self.with_changes(data["ids"], data["vectors"], data["removed"])
+        gen.segments.append(os.path.basename(path))
+        return gen
+
+    # Tìm chính xác trên phần delta (hoặc tập con ids của delta), trả về (distances, id trong DB).
+    def search_delta(self, query_embeddings, top_k, ids=None):
+        vectors = self.delta_vectors if ids is None else self.delta_vectors[np.searchsorted(self.delta_ids, ids)]
+        ids = self.delta_ids if ids is None else ids
+        distances, positions = faiss.knn(query_embeddings, vectors, min(top_k, ids.size), metric=faiss.METRIC_INNER_PRODUCT)
+        return distances, np.where(positions > -1, ids[np.maximum(positions, 0)], -1)
+
+    # Bản sao trong RAM của index gốc để sửa (thêm/xóa vector) mà không ảnh hưởng các lượt tìm kiếm đang dùng thế hệ này.
+    # Không gồm phần delta. Index memory-map được đọc lại từ chính file snapshot của nó (FAISS không clone được IVF memory-map).
+    def writable_copy(self):
+        index = faiss.read_index(self.path) if self.mapped else faiss.clone_index(self.index)
+        copy = IndexGeneration(index, self.kind, self.codec, self.max_id, deleted=self.deleted.copy())
+        copy.apply_search_params()
+        return copy
 
 class FaissManager:
-    def __init__(self):
-        # Chỉ giữ 1 index chung cho toàn bộ hệ thống
-        self.index = None
-        self.id_map = {}
+    def __init__(self, index_dir=Config.INDEX_DIR):
+        # Chỉ giữ 1 index chung cho toàn bộ hệ thống, dưới dạng thế hệ đang phục vụ (None khi chưa có dữ liệu).
+        self._gen = None
+        self._write_lock = threading.RLock() # Chỉ một luồng được build/thêm/xóa tại một thời điểm; người đọc không cần khóa.
+        self._loader = None
+        self._loader_lock = threading.Lock()
+        self._last_load_attempt = 0.0
+        # Snapshot được ghi thành các thế hệ đánh số (documents-<n>.faiss, chunks-<n>.sqlite) mà mọi worker memory-map chỉ đọc,
+        # documents.json là file đánh dấu thế hệ hiện tại: worker kiểm tra nó (một lệnh stat) và chuyển sang thế hệ mới ở request kế tiếp.
+        self.index_dir = index_dir
+        self.meta_path = os.path.join(index_dir, "documents.json")
+        self.lock_path = os.path.join(index_dir, "index.lock") # Khóa ghi giữa các worker (flock).
+        self.generation = None # Số thế hệ trên đĩa mà tiến trình này đang dùng, None khi chưa nạp.
+        self._meta_mtime = None
+        self._last_check = 0.0
+        self._lock_depth = 0
+        self._lock_file = None
+        self.chunk_store = ChunkStore(current_store_path(index_dir)) # Nội dung + metadata để trả kết quả không cần gọi DB.
+        self.version = 0 # Tăng mỗi khi nội dung chỉ mục thay đổi, dùng để vô hiệu hóa cache kết quả tìm kiếm.
+        self.query_cache = LRUCache(Config.QUERY_CACHE_SIZE) # Câu hỏi đã chuẩn hóa -> embedding (không phụ thuộc nội dung chỉ mục).
+        self.lexical = LexicalIndex() # Chỉ mục từ khóa BM25 trên cùng các chunk, dựng lại từ kho chunk khi khởi động.
+        self.scope_cache = LRUCache(256) # Bộ lọc phạm vi -> id chunk, gắn với phiên bản chỉ mục.
+
+    # Các thuộc tính của thế hệ đang phục vụ (chỉ đọc).
+    @property
+    def index(self):
+        gen = self._gen
+        return gen.index if gen is not None else None
+
+    @property
+    def index_kind(self):
+        gen = self._gen
+        return gen.kind if gen is not None else None
+
+    @property
+    def index_codec(self):
+        gen = self._gen
+        return gen.codec if gen is not None else None
+
+    @property
+    def ntotal(self):
+        gen = self._gen
+        return gen.size if gen is not None else 0
+
+    @property
+    def max_id(self):
+        gen = self._gen
+        return gen.max_id if gen is not None else 0
+
+    # Vùng ghi: khóa luồng trong tiến trình + khóa file giữa các worker (lồng nhau được). Khi vào lần đầu,
+    # nạp thế hệ mới nhất trên đĩa trước để không ghi đè thay đổi của worker khác.
+    @contextlib.contextmanager
+    def _writing(self):
+        with self._write_lock:
+            outermost = self._lock_depth == 0
+            if outermost and fcntl is not None:
+                os.makedirs(self.index_dir, exist_ok=True)
+                self._lock_file = open(self.lock_path, "a")
+                fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+            self._lock_depth += 1
+            try:
+                if outermost:
+                    self._load_newer_generation()
+                yield
+            finally:
+                self._lock_depth -= 1
+                if outermost and self._lock_file is not None:
+                    fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+                    self._lock_file.close()
+                    self._lock_file = None
+
+    # Công bố thế hệ mới: một phép gán, các lượt tìm kiếm đang chạy vẫn dùng thế hệ cũ đến khi xong.
+    def _publish(self, gen):
+        self._gen = gen
+        self.version += 1
 
+    # Loại chỉ mục và kiểu nén sẽ dùng cho n vectors: IVF chỉ được train khi đủ dữ liệu, trước đó dùng flat.
+    @staticmethod
+    def _target_layout(n):
+        kind = Config.INDEX_TYPE if Config.INDEX_TYPE in ('flat', 'hnsw', 'ivf') else 'flat'
+        if kind == 'ivf' and n < Config.IVF_MIN_TRAIN_SIZE:
+            kind = 'flat'
+        codec = Config.VECTOR_CODEC if Config.VECTOR_CODEC in ('none', 'fp16', 'sq8', 'pq') else 'none'
+        if codec == 'pq' and (n < PQ_MIN_TRAIN_SIZE or kind == 'hnsw'):
+            codec = 'sq8' # Chưa đủ dữ liệu để train codebook PQ (256 tâm/sub-vector); HNSW+PQ của FAISS không hỗ trợ Inner Product.
+        return kind, codec
+
+    # Chuỗi mô tả phần lõi của index (chưa gồm lớp rerank và IDMap) cho faiss.index_factory.
+    @staticmethod
+    def _index_description(kind, codec, n):
+        storage = {"none": "Flat", "fp16": "SQfp16", "sq8": "SQ8", "pq": f"PQ{Config.PQ_M}"}[codec]
+        if kind == 'hnsw':
+            return f"HNSW{Config.HNSW_M},{storage}"
+        if kind == 'ivf':
+            nlist = Config.IVF_NLIST or int(4 * np.sqrt(n))
+            nlist = max(1, min(nlist, n // 39)) # FAISS cần ~39 điểm/cụm để train ổn định.
+            return f"IVF{nlist},{storage}"
+        return storage
+
+    # Tạo thế hệ chỉ mục mới theo cấu hình từ các vector đã chuẩn hóa (tự train IVF/SQ8/PQ). Inner Product (IP) trên vector đã chuẩn hóa = cosine similarity.
+    def _create_index(self, ids, vectors):
+        kind, codec = self._target_layout(len(ids))
+        dimension = vectors.shape[1]
+        index = faiss.index_factory(dimension, self._index_description(kind, codec, len(ids)), faiss.METRIC_INNER_PRODUCT)
+        refine = codec != 'none' and Config.RERANK_K_FACTOR > 0
+        if refine: # Xếp hạng lại ứng viên bằng bản fp16 của vector.
+            index = faiss.IndexRefine(index, faiss.index_factory(dimension, "SQfp16", faiss.METRIC_INNER_PRODUCT))
+        if refine or kind != 'ivf': # IVF tự hỗ trợ add_with_ids/remove_ids nên không cần bọc IDMap.
+            index = faiss.IndexIDMap(index)
+        gen = IndexGeneration(index, kind, codec, int(ids.max()))
+        base, _ = gen.layers()
+        if kind == 'hnsw':
+            base.hnsw.efConstruction = Config.HNSW_EF_CONSTRUCTION
+        if not index.is_trained:
+            print(f"--- Train chỉ mục {kind}/{codec} trên {len(ids)} vectors ---")
+            index.train(vectors)
+        if kind == 'ivf' and not hasattr(index, 'id_map'):
+            index.set_direct_map_type(faiss.DirectMap.Hashtable) # Cho phép reconstruct/xóa vector theo id của DB.
+        index.add_with_ids(vectors, ids)
+        gen.apply_search_params()
+        return gen
+
+    # Chuẩn hóa dữ liệu đầu vào thành (ids int64, vectors float32 đã chuẩn hóa L2).
+    @staticmethod
+    def _prepare(ids, vectors, copy=True):
+        ids = np.asarray(ids, dtype='int64')
+        # Mặc định copy vì normalize_L2 sửa trực tiếp trên mảng.
+        vectors = (np.array(vectors, dtype='float32') if copy else np.asarray(vectors, dtype='float32')).reshape(len(ids), -1)
+        vectors = np.ascontiguousarray(vectors)
+        faiss.normalize_L2(vectors) # Chuẩn hóa vector về độ dài đơn vị để tính cosine similarity chính xác.
+        return ids, vectors
+
+    # Các id đang có trong chỉ mục.
+    def _indexed_ids(self):
+        gen = self._gen
+        return gen.indexed_ids() if gen is not None else np.array([], dtype='int64')
+
+    # Vector gốc (float32, đã chuẩn hóa) của các id trong một thế hệ, trả về (ids, vectors) theo cùng thứ tự.
+    # codec none: lấy thẳng từ index; có lớp rerank: lấy từ lớp fp16 (IndexRefine khôi phục từ lớp này, sai số ~1e-4).
+    # SQ8/PQ không rerank: vector khôi phục đã mang sai số nén nên tải lại embedding từ DB (song song theo dải id);
+    # id không còn trong DB bị bỏ. DB lỗi thì đành dùng vector khôi phục từ index.
+    def _exact_vectors(self, gen, ids):
+        ids = np.asarray(ids, dtype='int64')
+        _, refine = gen.layers()
+        if gen.codec != 'none' and refine is None and ids.size:
+            try:
+                db_ids, db_vectors = load_embeddings()
+                order = np.argsort(db_ids)
+                pos = np.minimum(np.searchsorted(db_ids, ids, sorter=order), max(db_ids.size - 1, 0))
+                found = db_ids[order[pos]] == ids if db_ids.size else np.zeros(ids.size, dtype=bool)
+                ids = ids[found]
+                vectors = np.ascontiguousarray(db_vectors[order[pos[found]]])
+                faiss.normalize_L2(vectors)
+                return ids, vectors
+            except Exception as e:
+                print(f"Không tải được embedding gốc từ DB, dùng vector khôi phục từ chỉ mục: {e}")
+        vectors = gen.reconstruct(ids)
+        faiss.normalize_L2(vectors) # Bù sai số do nén.
+        return ids, vectors
+
+    # Dựng lại chỉ mục từ vector gốc của một thế hệ (xem _exact_vectors), ví dụ khi đổi loại index/kiểu nén,
+    # khi đủ dữ liệu để train IVF/PQ hoặc khi dọn id đã xóa. Không train/mã hóa lại từ vector đã nén để sai số không bị tích lũy.
+    # Trả về thế hệ mới (None nếu trống).
+    def _rebuild_local(self, gen, exclude_ids=None):
+        ids = gen.indexed_ids()
+        if exclude_ids is not None:
+            ids = ids[~np.isin(ids, exclude_ids)]
+        if ids.size == 0:
+            return None
+        ids, vectors = self._exact_vectors(gen, ids)
+        if ids.size == 0:
+            return None
+        new_gen = self._create_index(ids, vectors)
+        new_gen.max_id = max(new_gen.max_id, gen.max_id)
+        print(f"--- Đã dựng lại chỉ mục {new_gen.kind}/{new_gen.codec} với {new_gen.size} vectors ---")
+        return new_gen
+
+    # Thống kê bộ nhớ: kích thước index (ước lượng bằng snapshot trên đĩa, gần bằng kích thước trong RAM) và RSS của tiến trình.
+    def memory_stats(self):
+        gen = self._gen
+        ntotal = int(gen.index.ntotal) if gen is not None else 0
+        index_bytes = os.path.getsize(gen.path) if ntotal and gen.mapped and os.path.exists(gen.path) else 0
+        return {
+            "index_type": gen.kind if gen is not None else None,
+            "codec": gen.codec if gen is not None else None,
+            "ntotal": gen.size if gen is not None else 0,
+            "deleted": int(gen.deleted.size) if gen is not None else 0, # Id đã xóa còn nằm trong index, chờ dựng lại.
+            "delta": int(gen.delta_ids.size) if gen is not None else 0, # Vector mới chưa gộp vào snapshot đầy đủ.
+            "segments": len(gen.segments) if gen is not None else 0,
+            "index_bytes": index_bytes,
+            "bytes_per_vector": round(index_bytes / ntotal, 1) if ntotal else 0,
+            "process_rss_bytes": process_rss_bytes(),
+            # RSS ẩn danh (RAM riêng của tiến trình): không tính các trang của snapshot đang memory-map dùng chung giữa các worker.
+            "process_anon_rss_bytes": process_rss_bytes("RssAnon")
+        }
+
+    # Build toàn bộ từ DB vào một thế hệ mới (kho chunk + BM25 + FAISS) rồi mới thay thế thế hệ đang phục vụ.
+    # Nếu lỗi, thế hệ cũ vẫn được giữ nguyên để tiếp tục tìm kiếm. Trả về True nếu build thành công.
     def build_index(self):
-        try:
-            # Lấy toàn bộ data từ bảng documents
-            response = supabase.table('documents').select('id, embedding').execute()
-            docs = response.data
-            if not docs:
+        with self._writing(), span("index_build"):
+            try:
+                # Lấy toàn bộ embedding (kèm nội dung, metadata vào kho chunk của thế hệ mới) từ bảng documents (song song, theo trang)
+                new_store = ChunkStore(os.path.join(self.index_dir, f"chunks-{self._next_generation()}.sqlite"))
+                new_store.reset()
+                new_lexical = LexicalIndex()
+                def on_rows(rows):
+                    new_store.upsert(rows)
+                    new_lexical.add(rows)
+                ids, embeddings = load_embeddings(on_rows=on_rows)
+
+                gen = None
+                if ids.size:
+                    ids, embeddings = self._prepare(ids, embeddings, copy=False) # Ma trận đã là float32 riêng của hàm này nên chuẩn hóa tại chỗ.
+                    # Khởi tạo index theo cấu hình và đưa toàn bộ vector vào bộ nhớ RAM kèm id thật trong DB.
+                    gen = self._create_index(ids, embeddings)
+
+                self.chunk_store = new_store
+                self.lexical = new_lexical
+                self._publish(gen)
+            except Exception as e:
+                print(f"Error building index (giữ nguyên chỉ mục hiện tại): {e}")
+                return False
+
+            self.save_snapshot()
+            if gen is None:
                 print("Không có dữ liệu trong database!")
-                self.index = None
-                self.id_map = {}
+                return True
+            print(f"--- Đã xong chỉ mục chung ({gen.kind}/{gen.codec}) với {gen.size} vectors ---")
+            stats = self.memory_stats()
+            print(f"--- RAM: index ~{stats['index_bytes'] / 1e6:.1f} MB ({stats['bytes_per_vector']} byte/vector), tiến trình {stats['process_rss_bytes'] / 1e6:.0f} MB ---")
+            return True
+
+    # Refresh lại chỉ mục. Nếu đang có một lần build/cập nhật khác chạy thì bỏ qua thay vì build chồng.
+    def refresh_index(self):
+        if not self._write_lock.acquire(blocking=False):
+            print("--- Đang có một lần build chỉ mục khác, bỏ qua refresh ---")
+            return False
+        try:
+            return self.build_index()
+        finally:
+            self._write_lock.release()
+
+    def _read_meta(self):
+        try:
+            with open(self.meta_path, encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    # Số thế hệ kế tiếp (gọi trong vùng ghi nên không trùng giữa các worker).
+    def _next_generation(self):
+        meta = self._read_meta() or {}
+        return max(meta.get("generation", 0), self.generation or 0) + 1
+
+    # Ghi thế hệ đang phục vụ thành một thế hệ mới trên đĩa rồi cập nhật file đánh dấu (ghi ra file tạm rồi đổi tên
+    # để không bao giờ để lại snapshot hỏng). Sau đó tiến trình này cũng chuyển sang bản memory-map của file vừa ghi,
+    # nên RAM không tăng theo số worker.
+    def save_snapshot(self):
+        with self._writing():
+            gen = self._gen
+            if gen is not None and gen.delta_ids.size:
+                gen = self._compact(gen) # Snapshot đầy đủ chỉ gồm index: gộp phần delta vào trước (cùng nội dung nên không tăng version).
+                self._gen = gen
+            number = self._next_generation()
+            try:
+                os.makedirs(self.index_dir, exist_ok=True)
+                index_file = None
+                if gen is not None:
+                    index_file = f"documents-{number}.faiss"
+                    path = os.path.join(self.index_dir, index_file)
+                    faiss.write_index(gen.index, path + ".tmp")
+                    os.replace(path + ".tmp", path)
+                    if gen.deleted.size: # Id đã xóa của index HNSW/rerank, lưu cạnh file index.
+                        with open(path + ".deleted.tmp", "wb") as f:
+                            np.save(f, gen.deleted)
+                        os.replace(path + ".deleted.tmp", path + ".deleted.npy")
+                meta = {
+                    "generation": number,
+                    "file": index_file, # None: chỉ mục trống.
+                    "deleted": f"{index_file}.deleted.npy" if gen is not None and gen.deleted.size else None,
+                    "chunks": os.path.basename(self.chunk_store.path),
+                    "max_id": gen.max_id if gen is not None else 0,
+                    "ntotal": gen.size if gen is not None else 0,
+                    "index_type": gen.kind if gen is not None else None,
+                    "codec": gen.codec if gen is not None else None,
+                    "saved_at": datetime.datetime.now().isoformat()
+                }
+                with open(self.meta_path + ".tmp", "w", encoding="utf-8") as f:
+                    json.dump(meta, f)
+                os.replace(self.meta_path + ".tmp", self.meta_path)
+                self.generation = number
+                self._meta_mtime = os.stat(self.meta_path).st_mtime_ns
+            except Exception as e:
+                print(f"Lỗi lưu snapshot chỉ mục: {e}")
                 return
 
-            ids = [doc['id'] for doc in docs]
-            embeddings_list = [ast.literal_eval(doc['embedding']) for doc in docs] # Dữ liệu từ DB trả về dạng chuỗi (String), cần chuyển thành List số thực.
-            embeddings = np.array(embeddings_list).astype('float32') # Chuyển List thành mảng Numpy định dạng float32 (FAISS yêu cầu bắt buộc định dạng này).
-            
-            self.id_map = {i: doc_id for i, doc_id in enumerate(ids)} # Lưu lại vị trí ánh xạ giữa index và id của tài liệu.
-            
-            # Khởi tạo index 
-            dimension = embeddings.shape[1]
-            self.index = faiss.IndexFlatIP(dimension) # Khởi tạo index với định dạng Inner Product (IP) cho phép tính cosine similarity.
-            faiss.normalize_L2(embeddings) # Chuẩn hóa vector về độ dài đơn vị để tính cosine similarity chính xác.
-            self.index.add(embeddings) # Đưa toàn bộ vector vào bộ nhớ RAM để sẵn sàng tìm kiếm.
-            
-            print(f"--- Đã xong chỉ mục chung với {self.index.ntotal} vectors ---")
+            if gen is not None and not gen.mapped:
+                try:
+                    # Cùng nội dung nên không tăng version (cache kết quả vẫn đúng).
+                    self._gen = self._map_generation(path, gen.kind, gen.codec, gen.max_id, gen.deleted)
+                except Exception as e:
+                    print(f"Lỗi memory-map snapshot vừa ghi, giữ bản trong RAM: {e}")
+            self._cleanup_generations(number, meta)
+
+    # Ghi thay đổi của một lần cập nhật thành một file delta nhỏ (id thêm + vector, id xóa) và một thế hệ mới trên đĩa
+    # trỏ tới cùng file index gốc, thay vì ghi lại cả chỉ mục. Worker khác chỉ đọc thêm các file delta mới.
+    # Trả về False nếu thế hệ trên đĩa không khớp với thế hệ đang phục vụ (người gọi ghi snapshot đầy đủ).
+    def _save_segment(self, gen, ids, vectors, remove_ids):
+        meta = self._read_meta()
+        if meta is None or not gen.mapped or meta.get("file") != os.path.basename(gen.path) or \
+                (meta.get("segments") or []) != gen.segments:
+            return False
+        number = self._next_generation()
+        try:
+            segment_file = f"documents-{number}.seg.npz"
+            path = os.path.join(self.index_dir, segment_file)
+            with open(path + ".tmp", "wb") as f:
+                np.savez(f, ids=np.asarray(ids, dtype='int64'), removed=np.asarray(remove_ids, dtype='int64'),
+                         vectors=np.asarray(vectors, dtype='float32').reshape(len(ids), gen.index.d))
+            os.replace(path + ".tmp", path)
+            meta.update({
+                "generation": number,
+                "segments": gen.segments + [segment_file],
+                "chunks": os.path.basename(self.chunk_store.path),
+                "max_id": gen.max_id,
+                "ntotal": gen.size,
+                "saved_at": datetime.datetime.now().isoformat()
+            })
+            with open(self.meta_path + ".tmp", "w", encoding="utf-8") as f:
+                json.dump(meta, f)
+            os.replace(self.meta_path + ".tmp", self.meta_path)
+            self.generation = number
+            self._meta_mtime = os.stat(self.meta_path).st_mtime_ns
         except Exception as e:
-            print(f"Error building index: {e}")
-            self.index = None
-            self.id_map = {}
+            print(f"Lỗi lưu file delta của chỉ mục: {e}")
+            return False
+        gen.segments.append(segment_file) # Thế hệ vừa công bố tương ứng với thế hệ trên đĩa này.
+        self._cleanup_generations(number, meta)
+        return True
 
-    # Refresh lại chỉ mục
-    def refresh_index(self):
-        self.build_index()
+    def _map_generation(self, path, kind, codec, max_id, deleted=None):
+        # IO_FLAG_MMAP_IFC: các mảng mã vector (flat/SQ/PQ, HNSW, lớp rerank) trỏ thẳng vào vùng map thay vì được sao chép
+        # vào RAM riêng của tiến trình, nên các worker dùng chung page cache. FAISS cũ chưa có cờ này thì dùng IO_FLAG_MMAP.
+        flags = getattr(faiss, "IO_FLAG_MMAP_IFC", faiss.IO_FLAG_MMAP) | faiss.IO_FLAG_READ_ONLY
+        index = faiss.read_index(path, flags)
+        gen = IndexGeneration(index, kind, codec, max_id, path=path, deleted=deleted)
+        gen.apply_search_params()
+        return gen
+
+    # Xóa file của các thế hệ cũ hơn INDEX_KEEP_GENERATIONS, giữ kho chunk đang dùng và kho ngay trước nó (worker khác có thể
+    # vẫn đọc đến lần kiểm tra kế tiếp), cùng file index gốc và các file delta mà thế hệ hiện tại (meta) còn tham chiếu.
+    # Worker còn map file index cũ vẫn đọc được đến khi chuyển thế hệ (Linux); trên Windows file đang mở không xóa được thì để lần sau.
+    def _cleanup_generations(self, current, meta):
+        referenced = {meta.get("file"), meta.get("deleted"), *(meta.get("segments") or [])}
+        names = os.listdir(self.index_dir)
+        m = re.match(r"^chunks-(\d+)\.sqlite$", os.path.basename(self.chunk_store.path))
+        chunks_gen = int(m.group(1)) if m else current
+        older = [int(m.group(1)) for m in (re.match(r"^chunks-(\d+)\.sqlite$", n) for n in names) if m and int(m.group(1)) < chunks_gen]
+        keep_chunks = {chunks_gen, max(older, default=chunks_gen)}
+        for name in names:
+            m = re.match(r"^(documents|chunks)-(\d+)\.(faiss|sqlite|seg)", name)
+            if m is None or name in referenced:
+                continue
+            number = int(m.group(2))
+            if m.group(1) == 'chunks':
+                keep = number in keep_chunks
+            else:
+                keep = number >= current - Config.INDEX_KEEP_GENERATIONS
+            if keep:
+                continue
+            try:
+                os.remove(os.path.join(self.index_dir, name))
+            except OSError:
+                pass
+
+    # Nạp một thế hệ theo nội dung file đánh dấu: memory-map index (chỉ đọc), mở kho chunk tương ứng và cập nhật BM25.
+    def _load_generation(self, meta):
+        store = ChunkStore(os.path.join(self.index_dir, meta.get("chunks") or "chunks.sqlite"))
+        if not store.exists():
+            return False
+        index_file = meta.get("file", "documents.faiss") # Snapshot cũ (trước khi đánh số thế hệ) không có trường này.
+        gen = None
+        if index_file:
+            path = os.path.join(self.index_dir, index_file)
+            segments = meta.get("segments") or []
+            current = self._gen
+            if current is not None and current.path == path and segments[:len(current.segments)] == current.segments:
+                gen = current # Cùng file index gốc: chỉ áp dụng các file delta mới.
+            else:
+                deleted = np.load(os.path.join(self.index_dir, meta["deleted"])) if meta.get("deleted") else None
+                gen = self._map_generation(path, meta.get("index_type") or "flat", meta.get("codec") or "none",
+                                           meta.get("max_id", 0), deleted)
+            for segment_file in segments[len(gen.segments):]:
+                gen = gen.with_segment(os.path.join(self.index_dir, segment_file))
+        if store.path != self.chunk_store.path or len(self.lexical) == 0:
+            self.chunk_store = store
+            self._load_lexical()
+        else:
+            self._sync_lexical()
+        self.generation = meta.get("generation", 0)
+        self._publish(gen)
+        print(f"--- Đã nạp snapshot thế hệ {self.generation} với {gen.size if gen is not None else 0} vectors (max_id={meta.get('max_id', 0)}) ---")
+        return True
+
+    # Nạp thế hệ trên đĩa nếu khác thế hệ đang dùng (do worker khác ghi). Trả về True nếu đã chuyển thế hệ.
+    def _load_newer_generation(self):
+        try:
+            mtime = os.stat(self.meta_path).st_mtime_ns
+        except OSError:
+            return False
+        meta = self._read_meta()
+        self._meta_mtime = mtime
+        if meta is None or meta.get("generation", 0) == self.generation:
+            return False
+        try:
+            return self._load_generation(meta)
+        except Exception as e:
+            print(f"Lỗi đọc snapshot chỉ mục: {e}")
+            return False
+
+    # Gọi ở đầu mỗi lượt tìm kiếm: tối đa một lần mỗi INDEX_POLL_SECONDS, chỉ stat file đánh dấu, khi đổi mới đọc và remap.
+    # Bỏ qua nếu luồng khác trong tiến trình đang ghi (luồng đó tự nạp thế hệ mới nhất).
+    def check_for_updates(self):
+        now = time.monotonic()
+        if now - self._last_check < Config.INDEX_POLL_SECONDS:
+            return
+        self._last_check = now
+        try:
+            if os.stat(self.meta_path).st_mtime_ns == self._meta_mtime:
+                return
+        except OSError:
+            return
+        if not self._write_lock.acquire(blocking=False):
+            return
+        try:
+            with span("index_remap"):
+                self._load_newer_generation()
+        finally:
+            self._write_lock.release()
+
+    # Đọc snapshot trên đĩa bằng memory-map. Trả về True nếu đọc thành công.
+    def load_snapshot(self):
+        meta = self._read_meta()
+        if meta is None:
+            return False
+        with self._write_lock:
+            try:
+                return self._load_generation(meta)
+            except Exception as e:
+                print(f"Lỗi đọc snapshot chỉ mục: {e}")
+                return False
+
+    # Dựng chỉ mục BM25 từ kho chunk cục bộ (không gọi DB).
+    def _load_lexical(self):
+        lexical = LexicalIndex()
+        for rows in self.chunk_store.iter_batches():
+            lexical.add(rows)
+        self.lexical = lexical
+
+    # Cập nhật BM25 theo kho chunk dùng chung khi worker khác đã thêm/xóa chunk (so sánh tập id, chỉ đọc các chunk mới).
+    def _sync_lexical(self):
+        store_ids = set(self.chunk_store.filter_ids())
+        known = self.lexical.ids()
+        self.lexical.remove(known - store_ids)
+        added = sorted(store_ids - known)
+        for i in range(0, len(added), 5000):
+            self.lexical.add(self.chunk_store.get_many(added[i:i + 5000]).values())
+
+    # Lưu các dòng chunk vào kho cục bộ và chỉ mục BM25.
+    def _store_rows(self, rows):
+        self.chunk_store.upsert(rows)
+        self.lexical.add(rows)
+
+    # Chỉ lấy các thay đổi từ DB so với snapshot: dòng mới và dòng đã bị xóa, so sánh theo toàn bộ tập id
+    # (dòng có id nhỏ hơn max_id vẫn có thể chưa có trong chỉ mục nếu được commit xen kẽ bởi worker khác).
+    def sync_changes(self):
+        with self._writing():
+            db_ids = np.array([row['id'] for row in fetch_rows('id')], dtype='int64') # Chỉ lấy cột id nên rất nhẹ.
+            indexed_ids = self._indexed_ids()
+            removed_ids = np.setdiff1d(indexed_ids, db_ids)
+            missing_ids = np.setdiff1d(db_ids, indexed_ids)
+
+            # Dòng sau mốc max_id: tải song song theo dải id; dòng bị bỏ sót phía trước mốc: tải theo danh sách id.
+            new_ids, new_embeddings = load_embeddings(min_id=self.max_id, on_rows=self._store_rows)
+            gap_ids = missing_ids[missing_ids <= self.max_id]
+            if gap_ids.size:
+                old_ids, old_embeddings = load_embeddings_by_ids(gap_ids, on_rows=self._store_rows)
+                if old_ids.size:
+                    new_ids = np.concatenate([old_ids, new_ids]) if new_ids.size else old_ids
+                    new_embeddings = np.vstack([old_embeddings, new_embeddings]) if new_embeddings.size else old_embeddings
+
+            self.update_chunks(new_ids, new_embeddings, remove_ids=removed_ids)
+            print(f"--- Đồng bộ snapshot: +{new_ids.size}, -{removed_ids.size} ---")
+
+    # Khởi động: ưu tiên snapshot trên đĩa + áp dụng thay đổi, chỉ build toàn bộ khi chưa có snapshot.
+    def load_or_build(self):
+        with self._writing(): # Vào vùng ghi đã nạp snapshot mới nhất nếu có (worker khác có thể vừa build xong).
+            if self.generation is None and not self.load_snapshot():
+                self.build_index()
+                return
+            try:
+                self.sync_changes()
+            except Exception as e:
+                # Supabase lỗi: vẫn phục vụ tìm kiếm bằng snapshot hiện có.
+                print(f"Không đồng bộ được với DB, dùng snapshot hiện có: {e}")
+            gen = self._gen
+            if gen is not None and (gen.kind, gen.codec) != self._target_layout(gen.size):
+                # Cấu hình INDEX_TYPE/VECTOR_CODEC đã đổi so với snapshot: dựng lại (từ DB nếu snapshot đang nén SQ8/PQ).
+                self._publish(self._rebuild_local(gen))
+                self.save_snapshot()
+
+    # Chỉ mục chưa có khi đang phục vụ request: nạp/build ở luồng nền (tối đa một luồng, cách nhau ít nhất 30 giây)
+    # thay vì bắt request phải chờ build toàn bộ.
+    def _load_in_background(self):
+        with self._loader_lock:
+            if (self._loader is not None and self._loader.is_alive()) or time.time() - self._last_load_attempt < 30:
+                return
+            self._last_load_attempt = time.time()
+            print("Chỉ mục chưa sẵn sàng, đang nạp ở nền...")
+            def load():
+                with self._write_lock:
+                    if self._gen is None:
+                        self.load_or_build()
+            self._loader = threading.Thread(target=load, name="index-loader", daemon=True)
+            self._loader.start()
+
+    # Thêm các chunk mới vào chỉ mục mà không cần build lại toàn bộ (sửa trên bản sao rồi công bố thế hệ mới).
+    # docs: các dòng {id, content, metadata} tương ứng để lưu vào kho chunk cục bộ.
+    def add_chunks(self, ids, vectors, docs=None):
+        self.update_chunks(ids, vectors, docs=docs)
+
+    # Xóa các chunk khỏi chỉ mục theo id trong DB (sửa trên bản sao rồi công bố thế hệ mới).
+    def remove_chunks(self, ids):
+        return self.update_chunks([], [], remove_ids=ids)
+
+    # Thêm và xóa trong cùng một lần: thay đổi đi vào phần delta của thế hệ mới (dùng chung index gốc đang memory-map)
+    # và được ghi thành một file delta nhỏ, nên chi phí I/O và RAM theo kích thước thay đổi chứ không theo cả chỉ mục.
+    # Khi delta đủ lớn thì gộp thành snapshot đầy đủ (xem _needs_compaction). Trả về số vector đã xóa.
+    def update_chunks(self, ids, vectors, docs=None, remove_ids=()):
+        if len(ids) == 0 and len(remove_ids) == 0:
+            return 0
+        with self._writing():
+            remove_ids = np.asarray(remove_ids, dtype='int64')
+            if remove_ids.size:
+                self.chunk_store.delete(remove_ids.tolist())
+                self.lexical.remove(remove_ids.tolist())
+            gen = self._gen
+            if gen is None:
+                if len(ids) == 0:
+                    self.version += 1
+                    return 0
+                # Chưa có chỉ mục trong RAM: build đầy đủ từ DB (dữ liệu mới đã được insert nên sẽ có mặt, kể cả trong kho chunk).
+                self.build_index()
+                return 0
+            if docs:
+                self._store_rows(docs)
+
+            if len(ids):
+                ids, vectors = self._prepare(ids, vectors)
+            else:
+                ids, vectors = np.array([], dtype='int64'), np.empty((0, gen.index.d), dtype='float32')
+            new_gen, removed = gen.with_changes(ids, vectors, remove_ids)
+
+            compacted = False
+            if new_gen.size == 0:
+                new_gen = None
+            elif self._needs_compaction(new_gen):
+                new_gen = self._compact(new_gen)
+                compacted = True
+            self._publish(new_gen)
+            if new_gen is None:
+                print("--- Chỉ mục đã trống ---")
+            else:
+                print(f"--- Đã thêm {len(ids)}, xóa {removed} vectors, chỉ mục có {new_gen.size} vectors"
+                      f"{' (đã gộp snapshot)' if compacted else f', delta {new_gen.delta_ids.size}'} ---")
+            if new_gen is None or compacted or not self._save_segment(new_gen, ids, vectors, remove_ids):
+                self.save_snapshot()
+            return removed
+
+    # Gộp phần delta vào snapshot đầy đủ khi: delta vượt INDEX_DELTA_MAX_VECTORS (tìm chính xác trên delta chậm dần, tốn RAM mỗi worker)
+    # hoặc có quá INDEX_DELTA_MAX_SEGMENTS file delta (worker mới phải đọc lại hết), đủ dữ liệu để đổi loại index (train IVF/PQ),
+    # số id đã xóa vượt INDEX_REBUILD_DELETED_RATIO, index gốc không lọc được id đã xóa (IndexPQ), hoặc index gốc không nằm trên đĩa.
+    def _needs_compaction(self, gen):
+        return (not gen.mapped or
+                gen.delta_ids.size > Config.INDEX_DELTA_MAX_VECTORS or
+                len(gen.segments) >= Config.INDEX_DELTA_MAX_SEGMENTS or
+                (gen.kind, gen.codec) != self._target_layout(gen.size) or
+                gen.deleted.size > Config.INDEX_REBUILD_DELETED_RATIO * gen.index.ntotal or
+                (gen.deleted.size > 0 and not gen.supports_selector()))
+
+    # Gộp phần delta và các id đã xóa vào một index gốc mới trong RAM (người gọi ghi snapshot đầy đủ). Đổi loại index,
+    # quá nhiều id đã xóa hoặc không xóa/lọc được trên index gốc thì dựng lại từ vector gốc (_rebuild_local).
+    def _compact(self, gen):
+        if ((gen.kind, gen.codec) != self._target_layout(gen.size) or
+                gen.deleted.size > Config.INDEX_REBUILD_DELETED_RATIO * gen.index.ntotal or
+                (gen.deleted.size and not gen.supports_remove() and not gen.supports_selector())):
+            return self._rebuild_local(gen)
+        new_gen = gen.writable_copy()
+        if gen.delta_ids.size:
+            new_gen.index.add_with_ids(gen.delta_vectors, gen.delta_ids)
+        if new_gen.deleted.size and new_gen.supports_remove():
+            new_gen.index.remove_ids(new_gen.deleted)
+            new_gen.deleted = np.array([], dtype='int64')
+        new_gen.modified()
+        new_gen.max_id = gen.max_id
+        return new_gen
 
     # Hàm này được gọi khi người dùng bấm nút "Tìm kiếm"
-    def search(self, query: str, top_k: int = 10):
-        if self.index is None:
-            print("Chỉ mục chưa sẵn sàng, đang thử build lại...")
-            self.refresh_index()
-            if self.index is None:
-                # Chắc chắn không có index, trả về kết quả rỗng
-                return np.array([[]], dtype='float32'), np.array([[]], dtype='int64'), {}
-
-        query_embedding = embed_model.encode(query).astype('float32').reshape(1, -1) # Chuyển đổi query thành vector embedding.
-        faiss.normalize_L2(query_embedding) # Chuẩn hóa vector về độ dài đơn vị để tính cosine similarity chính xác.
-        
-        distances, indices = self.index.search(query_embedding, top_k) # FAISS quét trong RAM trả về 2 giá trị: distances (điểm số tương đồng xấp xỉ 1.0) và indices (vị trí) của các vector tìm thấy.
-        return distances[0], indices[0], self.id_map # Trả về id_map để app.py dịch ngược lại ra ID thật trong Database.
+    def search(self, query: str, top_k: int = 10, scope=None):
+        distances, ids = self.search_many([query], top_k, scope=scope)
+        return distances[0], ids[0]
+
+    # Id các chunk trong phạm vi tìm kiếm (theo file_id, khoảng trang, chỉ chunk có ảnh); None nếu không giới hạn.
+    def scope_ids(self, file_id=None, page_from=None, page_to=None, image_only=False):
+        if not (file_id or page_from is not None or page_to is not None or image_only):
+            return None
+        key = (file_id, page_from, page_to, image_only)
+        version = self.version
+        entry = self.scope_cache.get(key, version=version)
+        if entry is None:
+            ids = np.asarray(self.chunk_store.filter_ids(file_id, page_from, page_to, image_only), dtype='int64')
+            if ids.size and ids.size >= self.chunk_store.count():
+                # Bộ lọc không loại chunk nào (vd. chế độ ảnh khi mọi chunk đều có ảnh): tìm như không giới hạn,
+                # không dựng IDSelector trên cả chỉ mục cho mỗi câu hỏi.
+                ids = None
+            entry = (ids,) # Bọc lại để phân biệt None (không giới hạn) với cache miss.
+            self.scope_cache.put(key, entry, version=version)
+        return entry[0]
+
+    # Tham số tìm kiếm FAISS kèm bộ lọc id (selector) cho index gốc, giữ efSearch/nprobe/k_factor như cấu hình.
+    @staticmethod
+    def _filtered_search_params(gen, selector):
+        base, refine = gen.layers()
+        if isinstance(base, faiss.IndexHNSW):
+            params = faiss.SearchParametersHNSW()
+            params.efSearch = Config.HNSW_EF_SEARCH
+        elif isinstance(base, faiss.IndexIVF):
+            params = faiss.SearchParametersIVF()
+            params.nprobe = Config.IVF_NPROBE
+        else:
+            params = faiss.SearchParameters()
+        params.sel = selector
+        if refine is None:
+            return params, [params]
+        refine_params = faiss.IndexRefineSearchParameters()
+        refine_params.k_factor = refine.k_factor
+        refine_params.sel = selector
+        refine_params.base_index_params = params
+        return refine_params, [refine_params, params] # Giữ tham chiếu để các đối tượng SWIG không bị giải phóng khi đang tìm.
+
+    # Tìm kiếm chỉ trong tập id cho trước, luôn trả đủ top_k (nếu phạm vi đủ lớn) thay vì lọc sau khi tìm.
+    # Phạm vi nhỏ (vd. một tài liệu): tính chính xác trên các vector của phạm vi. Phạm vi lớn: lọc ngay trong index bằng IDSelector.
+    # IndexPQ không nhận IDSelector nên luôn tính chính xác, từng khối SCOPED_EXACT_MAX_VECTORS vector để giới hạn RAM.
+    def _search_scoped(self, gen, query_embeddings, top_k, scope):
+        scope = gen.known(np.unique(scope)) # Bỏ id chưa có trong chỉ mục.
+        if scope.size == 0:
+            nq = len(query_embeddings)
+            return np.empty((nq, 0), dtype='float32'), np.empty((nq, 0), dtype='int64')
+        if scope.size == gen.size: # Phạm vi gồm cả thế hệ: không cần bộ lọc.
+            return self._search_all(gen, query_embeddings, top_k)
+
+        if scope.size > Config.SCOPED_EXACT_MAX_VECTORS and gen.supports_selector():
+            in_delta = np.isin(scope, gen.delta_ids)
+            base_scope = scope[~in_delta]
+            if base_scope.size:
+                distances, labels = self._search_selected(gen, query_embeddings, top_k, base_scope)
+            else:
+                distances, labels = np.empty((len(query_embeddings), 0), dtype='float32'), np.empty((len(query_embeddings), 0), dtype='int64')
+            return self._merge_delta(gen, query_embeddings, top_k, distances, labels, scope[in_delta])
+
+        k = min(top_k, scope.size)
+        block = max(1, Config.SCOPED_EXACT_MAX_VECTORS)
+        heap = faiss.ResultHeap(len(query_embeddings), k, keep_max=True)
+        for start in range(0, scope.size, block):
+            ids = scope[start:start + block]
+            vectors = gen.reconstruct(ids)
+            faiss.normalize_L2(vectors)
+            distances, positions = faiss.knn(query_embeddings, vectors, min(k, ids.size), metric=faiss.METRIC_INNER_PRODUCT)
+            heap.add_result(distances, np.where(positions > -1, ids[np.maximum(positions, 0)], -1))
+        heap.finalize()
+        return heap.D, heap.I
+
+    # Tìm kiếm với bộ lọc id: chỉ trong ids, hoặc loại trừ ids (exclude=True, dùng cho id đã xóa của HNSW/rerank).
+    def _search_selected(self, gen, query_embeddings, top_k, ids, exclude=False):
+        if not hasattr(gen.index, 'id_map'): # IVF không bọc IDMap: selector dùng trực tiếp id trong DB.
+            batch = faiss.IDSelectorBatch(ids)
+            selector = faiss.IDSelectorNot(batch) if exclude else batch
+            params, _keep = self._filtered_search_params(gen, selector)
+            return gen.index.search(query_embeddings, top_k, params=params)
+
+        # IndexIDMap chỉ dịch id của selector ở lớp ngoài cùng, không dịch cho lớp rerank bên trong,
+        # nên đổi id sang vị trí trong index rồi tìm trực tiếp trên index bên trong.
+        id_map = gen.lookup()[0]
+        batch = faiss.IDSelectorBatch(gen.positions(ids))
+        selector = faiss.IDSelectorNot(batch) if exclude else batch
+        params, _keep = self._filtered_search_params(gen, selector)
+        distances, labels = faiss.downcast_index(gen.index.index).search(query_embeddings, top_k, params=params)
+        return distances, np.where(labels > -1, id_map[np.maximum(labels, 0)], -1)
+
+    # Gộp kết quả của index gốc với kết quả tìm chính xác trên phần delta (toàn bộ, hoặc chỉ các id delta_ids), giữ top_k.
+    @staticmethod
+    def _merge_delta(gen, query_embeddings, top_k, distances, labels, delta_ids=None):
+        if (gen.delta_ids if delta_ids is None else delta_ids).size == 0:
+            return distances, labels
+        delta_distances, delta_labels = gen.search_delta(query_embeddings, top_k, delta_ids)
+        heap = faiss.ResultHeap(len(query_embeddings), top_k, keep_max=True)
+        heap.add_result(np.ascontiguousarray(distances, dtype='float32'), np.ascontiguousarray(labels, dtype='int64'))
+        heap.add_result(delta_distances, delta_labels)
+        heap.finalize()
+        return heap.D, heap.I
+
+    # Tìm kiếm trên toàn bộ thế hệ (index gốc + phần delta), bỏ qua các id đã xóa nhưng còn nằm trong index.
+    def _search_all(self, gen, query_embeddings, top_k):
+        if gen.deleted.size:
+            distances, labels = self._search_selected(gen, query_embeddings, top_k, gen.deleted, exclude=True)
+        else:
+            distances, labels = gen.index.search(query_embeddings, top_k)
+        return self._merge_delta(gen, query_embeddings, top_k, distances, labels)
+
+    # Tìm kiếm theo chế độ vector | lexical | hybrid, trả về list (id, điểm) đã lọc theo ngưỡng, điểm giảm dần.
+    # Câu hỏi theo số điều/chương ("Điều 12") được trả lời bằng bảng tra tiêu đề ở mọi chế độ (rẻ, không cần encode);
+    # ngoài chế độ vector, câu hỏi từ khóa ngắn cũng được trả lời bằng BM25.
+    # scope: mảng id chunk được phép (từ scope_ids), None = toàn bộ.
+    def search_matches(self, query: str, top_k: int = 10, mode: str = None, scope=None):
+        return self.search_matches_many([query], top_k, mode=mode, scope=scope)[0]
+
+    # Giống search_matches cho nhiều câu hỏi: phần vector của cả lô đi qua một lần search_many (encode + quét FAISS),
+    # sau đó kết hợp với điểm BM25 riêng cho từng câu hỏi.
+    def search_matches_many(self, queries, top_k: int = 10, mode: str = None, scope=None):
+        self.check_for_updates()
+        mode = mode or Config.SEARCH_MODE
+        allowed = None # Tập id của phạm vi cho chỉ mục từ khóa, chỉ tạo khi cần (tìm vector dùng trực tiếp mảng scope).
+        if scope is not None and mode != 'vector':
+            allowed = set(scope.tolist())
+        results = [None] * len(queries)
+        lexical_scores = [{} for _ in queries]
+        pending = [] # Vị trí các câu hỏi cần tìm kiếm vector.
+        for pos, query in enumerate(queries):
+            article = parse_article_query(query)
+            if article is not None:
+                if scope is not None and allowed is None:
+                    # Chế độ vector: lọc các chunk của tiêu đề theo mảng scope thay vì tạo tập id của cả phạm vi.
+                    ids = np.asarray(self.lexical.lookup_heading(article, None), dtype='int64')
+                    ids = ids[np.isin(ids, scope)][:top_k].tolist()
+                else:
+                    ids = self.lexical.lookup_heading(article, top_k, allowed=allowed)
+                if ids:
+                    results[pos] = [(doc_id, 1.0) for doc_id in ids]
+                    continue
+
+            if mode != 'vector':
+                with span("lexical_search"):
+                    lexical_hits = self.lexical.search(query, top_k * 2, allowed=allowed)
+                best = lexical_hits[0][1] if lexical_hits else 0.0
+                lexical_scores[pos] = {doc_id: score / best for doc_id, score in lexical_hits} # Chuẩn hóa BM25 về [0, 1].
+                if mode == 'lexical' or (lexical_hits and self.lexical.is_keyword_query(query, Config.LEXICAL_FAST_PATH_MAX_TOKENS)):
+                    results[pos] = list(lexical_scores[pos].items())[:top_k]
+                    continue
+            pending.append(pos)
+
+        if pending:
+            dists, ids = self.search_many([queries[pos] for pos in pending], top_k * 2 if mode != 'vector' else top_k, scope=scope)
+            for row, pos in enumerate(pending):
+                results[pos] = self._fuse(queries[pos], top_k, lexical_scores[pos], dists[row], ids[row])
+        return results
+
+    # Kết hợp kết quả vector (dists, ids của một câu hỏi) với điểm BM25 đã chuẩn hóa.
+    def _fuse(self, query, top_k, lexical_scores, dists, ids):
+        vector_scores = {int(i): float(d) for i, d in zip(ids, dists) if i > -1}
+        if not lexical_scores:
+            return [(i, s) for i, s in vector_scores.items() if s >= Config.SIMILARITY_THRESHOLD][:top_k]
+
+        # Chunk chỉ có trong kết quả BM25: tính điểm cosine từ vector lưu trong chỉ mục để kết hợp công bằng.
+        missing = [i for i in lexical_scores if i not in vector_scores]
+        gen = self._gen
+        if missing and gen is not None:
+            missing = gen.known(np.unique(np.asarray(missing, dtype='int64')))
+            if missing.size:
+                vectors = gen.reconstruct(missing)
+                faiss.normalize_L2(vectors)
+                sims = vectors @ self.encode_queries([query])[0]
+                vector_scores.update({int(i): float(s) for i, s in zip(missing, sims)})
+
+        alpha = Config.HYBRID_ALPHA
+        fused = {}
+        for doc_id in set(vector_scores) | set(lexical_scores):
+            vec = vector_scores.get(doc_id, 0.0)
+            if vec < Config.SIMILARITY_THRESHOLD and doc_id not in lexical_scores:
+                continue
+            fused[doc_id] = alpha * vec + (1 - alpha) * lexical_scores.get(doc_id, 0.0)
+        return heapq.nlargest(top_k, fused.items(), key=lambda item: item[1])
+
+    # Chuyển các câu hỏi thành vector đã chuẩn hóa, dùng lại embedding của câu hỏi đã gặp (LRU theo câu hỏi đã chuẩn hóa).
+    def encode_queries(self, queries):
+        keys = [normalize_query(q) for q in queries]
+        vectors = {k: self.query_cache.get(k) for k in set(keys)}
+        missing = [k for k, v in vectors.items() if v is None]
+        if missing:
+            with span("query_encode"):
+                encoded = np.asarray(get_embed_model().encode(missing, batch_size=32), dtype='float32').reshape(len(missing), -1) # Chuyển đổi các query thành vector embedding.
+            faiss.normalize_L2(encoded) # Chuẩn hóa vector về độ dài đơn vị để tính cosine similarity chính xác.
+            for k, v in zip(missing, encoded):
+                self.query_cache.put(k, v)
+                vectors[k] = v
+        return np.stack([vectors[k] for k in keys])
+
+    # Tìm kiếm nhiều câu hỏi cùng lúc: encode cả lô trong một lần gọi model và một lần index.search.
+    # Lấy thế hệ chỉ mục một lần cho cả lượt tìm kiếm nên không bị ảnh hưởng khi có thế hệ mới được công bố giữa chừng.
+    def search_many(self, queries, top_k: int = 10, scope=None):
+        self.check_for_updates()
+        gen = self._gen
+        if gen is None:
+            # Chưa có index: nạp ở nền, request này trả về kết quả rỗng thay vì chờ build.
+            self._load_in_background()
+            return np.empty((len(queries), 0), dtype='float32'), np.empty((len(queries), 0), dtype='int64')
+
+        query_embeddings = self.encode_queries(queries)
+        with span("faiss_search"):
+            if scope is not None:
+                return self._search_scoped(gen, query_embeddings, top_k, np.asarray(scope, dtype='int64'))
+            return self._search_all(gen, query_embeddings, top_k) # FAISS quét trong RAM trả về 2 giá trị: distances (điểm số tương đồng xấp xỉ 1.0) và ids của tài liệu trong Database (-1 nếu không đủ kết quả).
+
+    # Đo recall@k của chỉ mục hiện tại so với tìm kiếm chính xác (brute-force) trên cùng tập vector,
+    # dùng các vector đã lưu làm truy vấn mẫu. Giúp chọn efSearch/nprobe dựa trên số liệu thực tế.
+    def evaluate_recall(self, k: int = 10, n_queries: int = 200):
+        gen = self._gen
+        if gen is None or gen.size == 0:
+            return None
+
+        # Đáp án chính xác tính trên vector gốc, không phải vector đã nén của chính index (sẽ đánh giá recall cao hơn thực tế).
+        ids, vectors = self._exact_vectors(gen, gen.indexed_ids())
+        if ids.size == 0:
+            return None
+        rng = np.random.default_rng(0)
+        sample = rng.choice(len(ids), size=min(n_queries, len(ids)), replace=False)
+        queries = np.ascontiguousarray(vectors[sample])
+        k = min(k, len(ids))
+
+        started = time.perf_counter()
+        _, exact_pos = faiss.knn(queries, vectors, k, metric=faiss.METRIC_INNER_PRODUCT)
+        exact_ms = (time.perf_counter() - started) * 1000 / len(queries)
+
+        started = time.perf_counter()
+        _, approx_ids = self._search_all(gen, queries, k)
+        approx_ms = (time.perf_counter() - started) * 1000 / len(queries)
+
+        exact_ids = ids[exact_pos]
+        hits = sum(len(set(e) & set(a)) for e, a in zip(exact_ids.tolist(), approx_ids.tolist()))
+        return {
+            "index_type": gen.kind,
+            "codec": gen.codec,
+            "ntotal": gen.size,
+            "k": k,
+            "queries": len(queries),
+            "recall": hits / (k * len(queries)),
+            "exact_ms_per_query": round(exact_ms, 3),
+            "index_ms_per_query": round(approx_ms, 3)
+        }
+
+    # Lấy nội dung + metadata của các chunk từ kho cục bộ; chỉ gọi DB cho những id chưa có trong kho.
+    def get_chunks(self, ids):
+        with span("chunk_fetch"):
+            docs = self.chunk_store.get_many(ids)
+        missing = [i for i in ids if i not in docs]
+        if missing:
+            with span("db_fetch"):
+                res = supabase.table('documents').select('id, content, metadata').in_('id', missing).execute()
+            self.chunk_store.upsert(res.data)
+            docs.update({doc['id']: doc for doc in res.data})
+        return docs
 
 # Singleton Instance
-faiss_manager = FaissManager()
\ No newline at end of file
+faiss_manager = FaissManager()
+
+# Chuẩn bị sẵn sàng phục vụ: tải model + chạy thử một lần encode (khởi tạo kernel), nạp chỉ mục.
+# Gọi khi khởi động server hoặc trong từng worker sau khi fork (model đã được tải trước ở tiến trình cha).
+# background=True: chạy ở luồng nền (worker gunicorn: build chỉ mục lâu hơn timeout sẽ không chặn heartbeat làm worker bị kill).
+def warm_up(load_index=True, background=False):
+    if background:
+        threading.Thread(target=warm_up, kwargs={"load_index": load_index}, name="warm-up", daemon=True).start()
+        return
+    started = time.perf_counter()
+    get_embed_model().encode(["warm-up"])
+    if load_index and faiss_manager.index is None:
+        faiss_manager.load_or_build()
+    print(f"--- Warm-up xong trong {time.perf_counter() - started:.1f}s ---")
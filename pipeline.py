@@ -0,0 +1,163 @@
+import os
+import hashlib
+import threading
+import contextlib
+import tempfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+import fitz  # PyMuPDF
+from config import Config, supabase
+from caches import DiskLRUCache
+from metrics import span, observe
+from render_worker import render_page_batch
+
+_render_pool = None
+_render_pool_lock = threading.Lock()
+
+# Process pool dùng chung cho việc render trang (render PDF tốn CPU và giữ GIL nên cần tiến trình riêng).
+# Tiến trình con được tạo bằng forkserver (spawn trên Windows) thay vì fork: tiến trình hiện tại đang chạy các luồng
+# torch, hàng đợi upload, Storage và Gemini, fork giữa chừng có thể sao chép khóa đang bị giữ và làm tiến trình con treo.
+def get_render_pool():
+    global _render_pool
+    with _render_pool_lock:
+        if _render_pool is None:
+            method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+            context = multiprocessing.get_context(method)
+            if method == "forkserver":
+                # Máy chủ forkserver chỉ nạp sẵn render_worker (fitz). Tuy vậy mỗi tiến trình con (kể cả với spawn trên Windows)
+                # vẫn import lại module chạy chính dưới tên __mp_main__: chạy `python app.py` thì toàn bộ phần top-level của app.py
+                # (config, models, kết nối Supabase...) chạy lại trong tiến trình con, chỉ khối `if __name__ == "__main__"` là không.
+                # Dưới gunicorn, module chính là launcher của gunicorn nên tiến trình con chỉ nạp render_worker.
+                context.set_forkserver_preload(["render_worker"])
+            _render_pool = ProcessPoolExecutor(max_workers=Config.RENDER_PROCESSES, mp_context=context)
+        return _render_pool
+
+# Render toàn bộ trang song song trên nhiều tiến trình, trả về (số trang, ảnh JPEG) ngay khi từng nhóm trang xong.
+def render_pages(pdf_bytes, page_count, dpi=Config.PAGE_IMAGE_DPI, jpg_quality=Config.PAGE_IMAGE_QUALITY):
+    with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as t: # Tiến trình con đọc PDF từ file tạm thay vì nhận bytes qua pickle.
+        t.write(pdf_bytes)
+        pdf_path = t.name
+    try:
+        batch_size = max(1, min(8, page_count // (Config.RENDER_PROCESSES * 2)))
+        batches = [list(range(start, min(start + batch_size, page_count + 1))) for start in range(1, page_count + 1, batch_size)]
+        pool = get_render_pool()
+        futures = [pool.submit(render_page_batch, pdf_path, batch, dpi, jpg_quality) for batch in batches]
+        for future in as_completed(futures):
+            images, seconds = future.result()
+            observe("page_render", seconds)
+            yield from images
+    finally:
+        try: os.remove(pdf_path)
+        except OSError: pass
+
+# Upload lên Supabase Storage bằng nhiều luồng, giới hạn số file đang chờ để không giữ quá nhiều ảnh trong RAM.
+class StorageUploader:
+    def __init__(self, max_workers=Config.STORAGE_UPLOAD_WORKERS):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="storage")
+        self._slots = threading.BoundedSemaphore(max_workers * 2)
+
+    # Dùng upsert (ghi đè) thay cho remove + upload: chỉ một request cho mỗi file.
+    def _upload(self, path, data, content_type):
+        with span("storage_upload"):
+            supabase.storage.from_(Config.BUCKET_NAME).upload(
+                path, data, {"content-type": content_type, "cache-control": "3600", "upsert": "true"}
+            )
+        return path
+
+    # Đưa một file vào hàng đợi upload, trả về Future. Sẽ chờ nếu đã có quá nhiều file đang chờ upload.
+    def upload(self, path, data, content_type):
+        self._slots.acquire()
+        try:
+            future = self._executor.submit(self._upload, path, data, content_type)
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+
+# Singleton Instance
+storage_uploader = StorageUploader()
+
+# Cỡ ảnh trang: {tên: chiều rộng tối đa}, vd. "thumb:480,medium:960" -> {"thumb": 480, "medium": 960}.
+def parse_page_sizes(value):
+    sizes = {}
+    for item in (value or "").split(","):
+        name, _, width = item.partition(":")
+        if name.strip() and width.strip().isdigit():
+            sizes[name.strip()] = int(width)
+    return sizes
+
+# Ảnh trang render theo yêu cầu (PAGE_IMAGE_MODE=lazy): lần đầu có người xem mới tải PDF gốc từ Storage và render trang
+# trên process pool; ảnh và file PDF được giữ trong cache đĩa giới hạn PAGE_CACHE_MAX_MB, dùng chung giữa các worker.
+class PageImageRenderer:
+    def __init__(self, cache_dir=Config.PAGE_CACHE_DIR, max_mb=Config.PAGE_CACHE_MAX_MB):
+        self.cache = DiskLRUCache(cache_dir, max_mb * 1024 * 1024)
+        self.sizes = parse_page_sizes(Config.PAGE_IMAGE_SIZES)
+        # Khóa theo ảnh/file PDF: nhiều request cùng một trang chưa có trong cache chỉ render một lần.
+        # key -> [khóa, số luồng đang giữ/chờ], bị xóa khi luồng cuối cùng nhả khóa nên không tăng theo số trang đã xem.
+        self._key_locks = {}
+        self._lock = threading.Lock()
+
+    # ETag chỉ phụ thuộc file, trang và thông số render (tên file đã có mốc thời gian + uid nên nội dung không đổi),
+    # nên trả 304 được mà không cần đọc cache.
+    def etag(self, safe_name, page_no, size=None):
+        spec = f"{safe_name}:{page_no}:{Config.PAGE_IMAGE_DPI}:{self.sizes.get(size, 0)}:{Config.PAGE_IMAGE_QUALITY}"
+        return hashlib.sha1(spec.encode('utf-8')).hexdigest()[:20]
+
+    @staticmethod
+    def _base(safe_name):
+        return os.path.splitext(safe_name)[0]
+
+    @contextlib.contextmanager
+    def _key_lock(self, key):
+        with self._lock:
+            entry = self._key_locks.get(key)
+            if entry is None:
+                entry = self._key_locks[key] = [threading.Lock(), 0]
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self._key_locks[key]
+
+    # Đường dẫn file PDF gốc trong cache, tải từ Storage nếu chưa có.
+    def _pdf_path(self, safe_name):
+        key = f"{self._base(safe_name)}/source.pdf"
+        with self._key_lock(key):
+            path = self.cache.get(key)
+            if path is None:
+                with span("page_pdf_download"):
+                    data = supabase.storage.from_(Config.BUCKET_NAME).download(safe_name)
+                path = self.cache.put(key, data)
+        return path
+
+    # Trả về đường dẫn ảnh JPEG của trang (render nếu chưa có trong cache), None nếu trang không tồn tại.
+    def get(self, safe_name, page_no, size=None):
+        suffix = f"-{size}" if size else ""
+        key = f"{self._base(safe_name)}/page_{page_no}{suffix}.jpg"
+        path = self.cache.get(key)
+        if path is not None:
+            return path
+        with self._key_lock(key):
+            path = self.cache.get(key, record=False) # Request khác vừa render xong.
+            if path is not None:
+                return path
+            pdf_path = self._pdf_path(safe_name)
+            with fitz.open(pdf_path) as doc:
+                if not 1 <= page_no <= len(doc):
+                    return None
+            future = get_render_pool().submit(render_page_batch, pdf_path, [page_no],
+                                              Config.PAGE_IMAGE_DPI, Config.PAGE_IMAGE_QUALITY, self.sizes.get(size, 0))
+            images, seconds = future.result()
+            observe("page_render", seconds)
+            return self.cache.put(key, images[0][1])
+
+    # Xóa ảnh và file PDF đã cache của một tài liệu (gọi khi tài liệu bị xóa).
+    def purge(self, safe_name):
+        self.cache.remove_prefix(self._base(safe_name))
+
+page_renderer = PageImageRenderer()
@@ -0,0 +1,23 @@
+import time
+import fitz  # PyMuPDF
+
+# Hàm chạy trong tiến trình con của pool render (pipeline.get_render_pool). Module này chỉ import fitz, để việc gọi hàm
+# không kéo theo pipeline/config (kết nối Supabase, cache, model). Tiến trình con vẫn import lại module chạy chính
+# dưới tên __mp_main__ (vd. app.py khi chạy `python app.py`), xem pipeline.get_render_pool.
+
+# Chạy trong tiến trình con: render một nhóm trang (đánh số từ 1) của file PDF thành ảnh JPEG.
+# max_width > 0: giảm dpi để ảnh không rộng quá max_width px (cỡ ảnh nhỏ của chế độ lazy).
+# Trả về (ảnh, số giây render) để tiến trình cha ghi số liệu (span không đo được qua ranh giới tiến trình).
+def render_page_batch(pdf_path, page_numbers, dpi, jpg_quality, max_width=0):
+    started = time.perf_counter()
+    doc = fitz.open(pdf_path)
+    try:
+        images = []
+        for page_no in page_numbers:
+            page = doc.load_page(page_no - 1)
+            page_dpi = min(dpi, max(1, int(max_width * 72 / page.rect.width))) if max_width else dpi
+            pix = page.get_pixmap(dpi=page_dpi)
+            images.append((page_no, pix.tobytes(output="jpg", jpg_quality=jpg_quality)))
+        return images, time.perf_counter() - started
+    finally:
+        doc.close()
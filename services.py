@@ -1,42 +1,99 @@
 import os
 import fitz  # PyMuPDF
 import re
+import time
 import subprocess
 import tempfile
 import hashlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from config import Config, supabase
-from models import embed_model, faiss_manager
+from models import encode_documents, faiss_manager, fetch_rows
+from pipeline import render_pages, storage_uploader, page_renderer
+from ai_services import answer_cache
 from utils import clean_text, slugify_filename, create_file_identifier
+from metrics import span, observe
 
-# Hàm tạo ảnh cho từng trang PDF và upload lên Storage
-def generate_and_upload_page_images(pdf_bytes, safe_filename):
-    print(f"--- Bắt đầu tạo ảnh cho: {safe_filename} ---")
-    page_url_map = {}
+# Đường dẫn ảnh của một trang trong Storage.
+def page_image_path(safe_filename, page_no):
     base_name = os.path.splitext(safe_filename)[0]
-    
+    return f"page_images/{base_name}/page_{page_no}.jpg"
+
+# URL public của ảnh các trang. URL chỉ phụ thuộc vào đường dẫn nên tính được trước khi ảnh được upload xong.
+# Chế độ lazy: URL trỏ tới route /page/<file>/<n>.jpg của app, ảnh chỉ được render khi có người xem.
+def page_image_urls(safe_filename, page_count):
+    if Config.PAGE_IMAGE_MODE == 'lazy':
+        return {n: f"/page/{safe_filename}/{n}.jpg" for n in range(1, page_count + 1)}
+    bucket = supabase.storage.from_(Config.BUCKET_NAME)
+    return {n: bucket.get_public_url(page_image_path(safe_filename, n)) for n in range(1, page_count + 1)}
+
+# Hàm tạo ảnh cho từng trang PDF và upload lên Storage: render song song trên nhiều tiến trình,
+# upload song song qua storage_uploader. on_page(done, total) được gọi sau mỗi trang để báo tiến độ.
+def generate_and_upload_page_images(pdf_bytes, safe_filename, on_page=None):
     try:
-        doc = fitz.open(stream=pdf_bytes, filetype="pdf")
-        for page_num in range(len(doc)):
-            page = doc.load_page(page_num)
-            pix = page.get_pixmap(dpi=150)
-            img_bytes = pix.tobytes(output="jpg", jpg_quality=80)
-            
-            current_page = page_num + 1
-            image_path = f"page_images/{base_name}/page_{current_page}.jpg"
-            
-            supabase.storage.from_(Config.BUCKET_NAME).remove([image_path])
-            supabase.storage.from_(Config.BUCKET_NAME).upload(
-                image_path, img_bytes, {"content-type": "image/jpeg", "cache-control": "3600"}
-            )
-            page_url_map[current_page] = supabase.storage.from_(Config.BUCKET_NAME).get_public_url(image_path)
+        with fitz.open(stream=pdf_bytes, filetype="pdf") as doc:
+            page_count = len(doc)
+        if Config.PAGE_IMAGE_MODE == 'lazy': # Không render lúc nạp, route /page render từ file PDF gốc đã upload.
+            return page_image_urls(safe_filename, page_count)
+        print(f"--- Bắt đầu tạo ảnh cho: {safe_filename} ---")
+
+        with span("page_images"): # Toàn bộ giai đoạn; thời gian render từng nhóm trang và từng lần upload được đo riêng.
+            uploads = [
+                storage_uploader.upload(page_image_path(safe_filename, page_no), img_bytes, "image/jpeg")
+                for page_no, img_bytes in render_pages(pdf_bytes, page_count)
+            ]
+            for done, future in enumerate(as_completed(uploads), start=1):
+                future.result()
+                if on_page:
+                    on_page(done, page_count)
         
-        return page_url_map
+        return page_image_urls(safe_filename, page_count)
     except Exception as e:
         print(f"Error generating images: {e}")
         return {}
 
+# Hàm tìm các trang cần OCR: trang chỉ có ảnh hoặc lớp text quá ít (đánh số từ 1).
+def pages_needing_ocr(pdf_bytes, min_chars=None):
+    min_chars = Config.OCR_MIN_TEXT_CHARS if min_chars is None else min_chars
+    with fitz.open(stream=pdf_bytes, filetype="pdf") as doc:
+        return [i + 1 for i, page in enumerate(doc) if len(page.get_text("text").strip()) < min_chars]
+
+# Hàm rút gọn danh sách trang thành dạng "1-3,7,9-10" cho tham số --pages của ocrmypdf.
+def format_page_ranges(pages):
+    ranges = []
+    for p in sorted(pages):
+        if ranges and p == ranges[-1][1] + 1:
+            ranges[-1][1] = p
+        else:
+            ranges.append([p, p])
+    return ",".join(f"{a}-{b}" if a != b else str(a) for a, b in ranges)
+
+# Hash SHA-256 của file PDF gốc, lưu vào metadata (file_hash) để nhận ra file không đổi khi nạp lại.
+def compute_file_hash(pdf_bytes):
+    return hashlib.sha256(pdf_bytes).hexdigest()
+
+# Đường dẫn cache OCR: khóa theo SHA-256 của file PDF gốc và cấu hình OCR (upload lại cùng file sẽ dùng lại kết quả).
+def _ocr_cache_path(pdf_bytes):
+    digest = compute_file_hash(pdf_bytes)
+    variant = Config.OCR_MODE if Config.OCR_MODE == 'full' else f"{Config.OCR_MODE}{Config.OCR_MIN_TEXT_CHARS}"
+    return os.path.join(Config.OCR_CACHE_DIR, f"{digest}-{variant}.pdf")
+
 # Hàm chạy Tesseract OCR lên file PDF để lấy lớp text và xóa chữ ký số.
+# Chế độ selective chỉ OCR các trang thiếu text; kết quả được cache trên đĩa theo nội dung file.
 def perform_ocr(pdf_bytes_in, safe_filename):
+    cache_path = _ocr_cache_path(pdf_bytes_in)
+    if os.path.exists(cache_path):
+        with open(cache_path, 'rb') as f:
+            print(f"--- Dùng lại kết quả OCR đã cache cho {safe_filename} ---")
+            return f.read()
+
+    ocr_pages = None # None = OCR toàn bộ file.
+    if Config.OCR_MODE == 'selective':
+        ocr_pages = pages_needing_ocr(pdf_bytes_in)
+        if not ocr_pages:
+            print("--- Tất cả các trang đã có lớp text, bỏ qua OCR ---")
+            return pdf_bytes_in
+        print(f"--- OCR {len(ocr_pages)} trang thiếu text: {format_page_ranges(ocr_pages)} ---")
+
     temp_in_path = "" # Tạo file tạm để lưu file PDF gốc.
     temp_unsigned_path = "" # Tạo file tạm để lưu file PDF sau khi gỡ chữ ký số.
     temp_out_path = "" # Tạo file tạm để lưu file PDF sau khi OCR.
@@ -53,15 +110,23 @@ def perform_ocr(pdf_bytes_in, safe_filename):
         with tempfile.NamedTemporaryFile(delete=True, suffix=".pdf") as t_out: 
             temp_out_path = t_out.name
 
-        subprocess.run(['gswin64c', '-o', temp_unsigned_path, '-sDEVICE=pdfwrite', '-dNOSAFER', temp_in_path], capture_output=True, check=False) # Chạy Ghostscript để gỡ chữ ký số.
+        with span("ghostscript"):
+            subprocess.run(['gswin64c', '-o', temp_unsigned_path, '-sDEVICE=pdfwrite', '-dNOSAFER', temp_in_path], capture_output=True, check=False) # Chạy Ghostscript để gỡ chữ ký số.
         
-        subprocess.run(['ocrmypdf', '-l', 'vie+eng', '-O0', '--force-ocr', '--continue-on-soft-render-error', temp_unsigned_path, temp_out_path], 
-            capture_output=True, check=False) # Chạy Tesseract OCR để OCR lên file PDF sau khi gỡ chữ ký số và lưu vào file tạm.
+        page_args = ['--pages', format_page_ranges(ocr_pages)] if ocr_pages else [] # Chỉ rasterize + OCR các trang được chọn, các trang khác giữ nguyên.
+        with span("ocr"):
+            subprocess.run(['ocrmypdf', '-l', 'vie+eng', '-O0', '--force-ocr', '--continue-on-soft-render-error', '--jobs', str(Config.OCR_JOBS)]
+                + page_args + [temp_unsigned_path, temp_out_path],
+                capture_output=True, check=False) # Chạy Tesseract OCR song song theo trang lên file PDF sau khi gỡ chữ ký số và lưu vào file tạm.
         
         if os.path.exists(temp_out_path) and os.path.getsize(temp_out_path) > 0: # Kiểm tra file tạm đã tạo thành công chưa.
             with open(temp_out_path, 'rb') as f:
                 ocr_pdf_bytes = f.read()
                 print("OCR thành công!")
+            os.makedirs(Config.OCR_CACHE_DIR, exist_ok=True)
+            with open(cache_path + ".tmp", 'wb') as f:
+                f.write(ocr_pdf_bytes)
+            os.replace(cache_path + ".tmp", cache_path)
     except Exception as e:
         print(f"OCR Error: {e}")
     finally:
@@ -76,162 +141,283 @@ def perform_ocr(pdf_bytes_in, safe_filename):
 def compute_chunk_hash(content):
     return hashlib.md5(content.encode('utf-8')).hexdigest()
 
-# Hàm chia nhỏ PDF thành các chunks, kết hợp Heading và Max Length (= 800 ký tự).
-def chunk_pdf(pdf_bytes, safe_filename, process_mode='image', page_url_map=None, max_chunk_size=800):
-    print(f"--- Chunking ({process_mode}) ---")
-    doc = fitz.open(stream=pdf_bytes, filetype="pdf") # Mở file PDF để lấy các trang.
-    chunks = []
-    current_heading = "Nội dung chung" # Tiêu đề của chunk hiện tại.
-    current_buffer = "" # Nội dung của chunk hiện tại.
-    
+# Tạo một chunk (nội dung = tiêu đề + thân, metadata, hash).
+def _make_chunk(safe_filename, heading, body, page, process_mode, page_url_map):
+    metadata = {
+        "source_file": safe_filename,
+        "section_title": heading,
+        "page": page
+    }
+    if process_mode == 'image' and page_url_map:
+        metadata["image_url"] = page_url_map.get(page)
+
+    content_str = f"{heading}\n{body}" # Tạo nội dung của chunk.
+    return {
+        "content": content_str,
+        "metadata": metadata,
+        "hash": compute_chunk_hash(content_str)
+    }
+
+# Chia PDF thành các chunk dạng stream, kết hợp Heading và Max Length (= 800 ký tự): trả về chunk theo từng trang ngay khi
+# đọc xong trang đó, nên tài liệu dài không phải giữ toàn bộ danh sách chunk trong RAM.
+def iter_chunks(pdf_bytes, safe_filename, process_mode='image', page_url_map=None, max_chunk_size=800):
     heading_pattern = re.compile(r"^(PHẦN\s+[\d\.]+|[IVXLCDM]+\s*\.|Chương\s+[IVXLCDM]+|Điều\s+\d+|Mục\s+\d+|[A-Z]\.|\d+\.\d*\.)", re.IGNORECASE) # Phát hiện tiêu đề theo Điều, Mục, Chương, Phần
-    
-    start_page = 0 # Trang bắt đầu.
-    current_chunk_page = 1 # Trang hiện tại.
 
-    for page_num in range(start_page, len(doc)):
-        page = doc.load_page(page_num)
-        blocks = page.get_text("blocks")
-        for block in blocks:
-            text = clean_text(block[4]) # fitz trả về dạng list, block[4] là text của block, các vị trí còn lại là tọa độ và các thông số khác.
-            if not text: continue
+    current_heading = "Nội dung chung" # Tiêu đề của chunk hiện tại.
+    parts = [] # Các đoạn text của chunk hiện tại, chỉ nối thành chuỗi khi tạo chunk (tránh cộng chuỗi lặp lại).
+    buffer_len = 0 # Độ dài nội dung của chunk hiện tại.
+    current_chunk_page = 1 # Trang bắt đầu của chunk hiện tại.
 
-            is_heading = heading_pattern.match(text) and len(text) < 150 # Phát hiện tiêu đề nếu text ngắn hơn 150 ký tự và khớp với pattern.
-            
-            if is_heading or len(current_buffer) > max_chunk_size: # Nếu là tiêu đề hoặc chunk hiện tại đã lớn hơn max_chunk_size thì tạo chunk mới.
-                if current_buffer.strip():
-                    metadata = {
-                        "source_file": safe_filename,
-                        "section_title": current_heading,
-                        "page": current_chunk_page
-                    }
-                    if process_mode == 'image' and page_url_map:
-                        metadata["image_url"] = page_url_map.get(current_chunk_page)
-
-                    content_str = f"{current_heading}\n{current_buffer.strip()}" # Tạo nội dung của chunk.
-                    chunks.append({
-                        "content": content_str,
-                        "metadata": metadata,
-                        "hash": compute_chunk_hash(content_str)
-                    })
-                    
-                    current_buffer = ""
-                    current_chunk_page = page_num + 1
-
-                if is_heading:
-                    current_heading = text
-                else:
-                    current_buffer += text + "\n"
-            else:
-                current_buffer += text + "\n"
-
-    if current_buffer.strip(): # Nếu còn nội dung trong buffer thì tạo chunk cuối cùng.
-        metadata = {
-            "source_file": safe_filename, 
-            "section_title": current_heading,
-            "page": current_chunk_page
-        }
-        if process_mode == 'image' and page_url_map:
-            metadata["image_url"] = page_url_map.get(current_chunk_page)
-            
-        content_str = f"{current_heading}\n{current_buffer.strip()}"
-        chunks.append({
-            "content": content_str,
-            "metadata": metadata,
-            "hash": compute_chunk_hash(content_str)
-        })
-    
+    with fitz.open(stream=pdf_bytes, filetype="pdf") as doc:
+        for page_num in range(len(doc)):
+            started = time.perf_counter()
+            page_chunks = []
+            for block in doc.load_page(page_num).get_text("blocks"):
+                text = clean_text(block[4]) # fitz trả về dạng list, block[4] là text của block, các vị trí còn lại là tọa độ và các thông số khác.
+                if not text: continue
+
+                is_heading = heading_pattern.match(text) and len(text) < 150 # Phát hiện tiêu đề nếu text ngắn hơn 150 ký tự và khớp với pattern.
+
+                if is_heading or buffer_len > max_chunk_size: # Nếu là tiêu đề hoặc chunk hiện tại đã lớn hơn max_chunk_size thì tạo chunk mới.
+                    body = "".join(parts).strip()
+                    if body:
+                        page_chunks.append(_make_chunk(safe_filename, current_heading, body, current_chunk_page, process_mode, page_url_map))
+                        parts = []
+                        buffer_len = 0
+                        current_chunk_page = page_num + 1
+
+                    if is_heading:
+                        current_heading = text
+                        continue
+
+                parts.append(text + "\n")
+                buffer_len += len(text) + 1
+
+            observe("chunking", time.perf_counter() - started)
+            yield from page_chunks
+
+    body = "".join(parts).strip()
+    if body: # Nếu còn nội dung trong buffer thì tạo chunk cuối cùng.
+        yield _make_chunk(safe_filename, current_heading, body, current_chunk_page, process_mode, page_url_map)
+
+# Hàm chia nhỏ PDF thành các chunks (toàn bộ danh sách), dùng iter_chunks.
+def chunk_pdf(pdf_bytes, safe_filename, process_mode='image', page_url_map=None, max_chunk_size=800):
+    print(f"--- Chunking ({process_mode}) ---")
+    chunks = list(iter_chunks(pdf_bytes, safe_filename, process_mode, page_url_map, max_chunk_size))
     print(f"--- Created {len(chunks)} chunks ---")
     return chunks
 
-# Hàm xử lý luồng upload.
-def process_upload(file):
-    pdf_bytes = file.read()
-    
-    original_filename = file.filename
+# Luồng chạy nền giai đoạn tạo ảnh trang, để chunking và embedding chạy song song với render/upload ảnh.
+_image_stage_pool = ThreadPoolExecutor(max_workers=Config.INGEST_WORKERS, thread_name_prefix="page-images")
+
+# Lấy các chunk đã có của phiên bản trước (theo FILE_ID): map hash nội dung -> id chunk, và file_hash của lần nạp gần nhất
+# đã hoàn tất (ghi trên chunk có id lớn nhất, xem mark_latest_version). Chunk giữ lại từ các phiên bản cũ hơn vẫn mang file_hash cũ.
+def existing_chunks(file_id):
+    with span("db_diff"):
+        old_docs = fetch_rows('metadata', filters={'metadata->>file_id': file_id}) # Lấy theo trang, không bị giới hạn 1000 dòng.
+
+    old_hashes_map = {}
+    for doc in old_docs: # Lưu lại map giữa hash cũ và id của chunk cũ.
+        meta = doc.get('metadata') or {}
+        h = meta.get('content_hash')
+        if h:
+            old_hashes_map[h] = doc['id']
+    latest_hash = (old_docs[-1].get('metadata') or {}).get('file_hash') if old_docs else None # fetch_rows sắp theo id tăng dần.
+    return old_hashes_map, latest_hash
+
+# Đánh dấu phiên bản đã nạp xong: ghi file_hash lên chunk có id lớn nhất của tài liệu. Chỉ gọi sau khi đã xóa xong chunk cũ,
+# chunk mới được insert không mang file_hash nên lần nạp bị dừng giữa chừng sẽ không bị coi là "không đổi" khi chạy lại.
+def mark_latest_version(file_id, file_hash):
+    latest = supabase.table("documents").select('id, metadata').eq('metadata->>file_id', file_id)\
+        .order('id', desc=True).limit(1).execute().data
+    if latest and (latest[0].get('metadata') or {}).get('file_hash') != file_hash:
+        metadata = {**(latest[0].get('metadata') or {}), 'file_hash': file_hash}
+        supabase.table("documents").update({'metadata': metadata}).eq('id', latest[0]['id']).execute()
+
+# Ghi một trang (chunk, embedding) vào bảng documents. Trả về id mới và các dòng {id, content, metadata} để cập nhật chỉ mục.
+def insert_chunk_rows(rows):
+    data = [{
+        "content": c['content'],
+        "metadata": c['metadata'],
+        "embedding": e.tolist()
+    } for c, e in rows]
+
+    with span("db_insert"):
+        inserted = supabase.table("documents").insert(data).execute()
+    new_ids = [row['id'] for row in inserted.data] # Supabase trả về các dòng vừa insert theo đúng thứ tự gửi lên.
+    docs = [{"id": i, "content": d['content'], "metadata": d['metadata']} for i, d in zip(new_ids, data)]
+    return new_ids, docs
+
+# Chuẩn bị một file cho nạp hàng loạt (ingest_folder.py): kiểm tra hash file, OCR, chunk và so sánh hash với phiên bản trước,
+# rồi upload file gốc + ảnh trang (chờ xong) nếu có chunk mới. Embedding và ghi DB do nơi gọi gom chung nhiều file.
+# Trả về None nếu file giống hệt lần nạp trước (trừ khi force=True).
+def prepare_document(pdf_bytes, original_filename, force=False):
+    file_id = create_file_identifier(original_filename)
+    file_hash = compute_file_hash(pdf_bytes)
+    old_hashes_map, latest_hash = existing_chunks(file_id)
+    if file_hash == latest_hash and not force: # Chỉ so với phiên bản đang có, không so với các phiên bản cũ hơn.
+        return None
+
+    safe_name = slugify_filename(original_filename)
+    ocr_bytes = perform_ocr(pdf_bytes, safe_name)
+    with fitz.open(stream=ocr_bytes, filetype="pdf") as doc:
+        page_map = page_image_urls(safe_name, len(doc))
+
+    new_chunks = []
+    new_hashes_set = set()
+    kept = 0
+    for chunk in iter_chunks(ocr_bytes, safe_name, process_mode='image', page_url_map=page_map):
+        h = chunk['hash']
+        if h in new_hashes_set: # Trùng nội dung trong cùng file: chỉ ghi một lần.
+            continue
+        new_hashes_set.add(h)
+        if h in old_hashes_map:
+            kept += 1
+            continue
+        chunk['metadata'].update(file_id=file_id, original_filename=original_filename, content_hash=h)
+        new_chunks.append(chunk)
+
+    # Chỉ có chunk cũ bị xóa (hoặc không đổi): không cần upload lại file gốc và ảnh trang.
+    if new_chunks:
+        original_upload = storage_uploader.upload(safe_name, pdf_bytes, "application/pdf")
+        images_ok = generate_and_upload_page_images(ocr_bytes, safe_name)
+        original_upload.result()
+        if not images_ok:
+            for c in new_chunks: # Tạo ảnh lỗi: bỏ link ảnh.
+                c['metadata'].pop('image_url', None)
+
+    return {
+        "file_id": file_id,
+        "file_hash": file_hash,
+        "original_filename": original_filename,
+        "chunks": new_chunks,
+        "kept": kept,
+        "delete_ids": [oid for h, oid in old_hashes_map.items() if h not in new_hashes_set]
+    }
+
+# Hàm báo tiến độ mặc định khi chạy trực tiếp (không qua hàng đợi).
+def _no_report(stage, progress=None):
+    pass
+
+# Hàm xử lý luồng upload. Chạy nền trong hàng đợi (jobs.py), report(stage, progress) dùng để báo tiến độ từng giai đoạn.
+def process_upload(pdf_bytes, original_filename, report=_no_report):
     # Tạo ID cố định dựa trên tên gốc: "Quy che.pdf" -> "quy-che" -> Dùng để tìm đúng phiên bản trước của tài liệu này.
     file_id = create_file_identifier(original_filename) 
     safe_name = slugify_filename(original_filename) 
+    file_hash = compute_file_hash(pdf_bytes)
     
-    # 1. Upload file gốc
-    supabase.storage.from_(Config.BUCKET_NAME).upload(safe_name, pdf_bytes, {"content-type": "application/pdf"})
+    # 1. Upload file gốc (chạy nền, song song với OCR)
+    report("ocr", 0.05)
+    original_upload = storage_uploader.upload(safe_name, pdf_bytes, "application/pdf")
     
-    # 2. Xử lý OCR cho file và tạo ảnh cho các trang trong file.
+    # 2. Xử lý OCR cho file, sau đó tạo ảnh các trang chạy nền song song với chunking và embedding.
     ocr_bytes = perform_ocr(pdf_bytes, safe_name)
-    page_map = generate_and_upload_page_images(ocr_bytes, safe_name)
+    with fitz.open(stream=ocr_bytes, filetype="pdf") as doc:
+        page_map = page_image_urls(safe_name, len(doc))
+    images_future = _image_stage_pool.submit(generate_and_upload_page_images, ocr_bytes, safe_name)
     
-    # 3. Chunking
-    new_chunks = chunk_pdf(ocr_bytes, safe_name, process_mode='image', page_url_map=page_map)
+    # 3. Lấy giá trị hash cũ dựa trên FILE_ID của phiên bản trước của tài liệu để so sánh với hash mới.
+    report("db_diff", 0.3)
+    old_hashes_map, _ = existing_chunks(file_id)
+
+    # 4. Chunking dạng stream: chunk mới (hash chưa có) được gom thành lô INGEST_EMBED_BATCH để embedding,
+    # kết quả được ghi DB theo trang INGEST_INSERT_PAGE_SIZE dòng, nên RAM không tăng theo độ dài tài liệu.
+    report("chunking", 0.35)
+    page_count = len(page_map)
+    new_hashes_set = set() # Tất cả hash của chunks mới.
+    ids_to_keep = [] # Chunks cũ.
+    batch = [] # Chunks mới chờ embedding.
+    pending = [] # (chunk, embedding) chờ ghi DB.
+    state = {"images_ready": False, "inserted": 0, "total": 0}
+
+    # Chờ upload file gốc và ảnh trang xong trước khi ghi DB, để kết quả tìm kiếm không trỏ tới ảnh chưa tồn tại.
+    def wait_for_images():
+        if state["images_ready"]:
+            return
+        report("page_images", 0.8)
+        original_upload.result()
+        state["images_ok"] = bool(images_future.result())
+        state["images_ready"] = True
+
+    def embed(chunks):
+        with span("embedding"):
+            vectors = encode_documents([c['content'] for c in chunks], hashes=[c['hash'] for c in chunks], batch_size=32)
+        pending.extend(zip(chunks, vectors))
 
-    # Gán ID vào metadata chunk
-    for chunk in new_chunks:
+    def insert_page(rows):
+        if not state["images_ok"]:
+            for c, _ in rows: # Tạo ảnh lỗi: bỏ link ảnh như luồng tuần tự trước đây.
+                c['metadata'].pop('image_url', None)
+        new_ids, docs = insert_chunk_rows(rows)
+        # Đưa ngay trang vừa ghi vào chỉ mục (một file delta nhỏ, không ghi lại cả snapshot) thay vì giữ ids/vector/nội dung
+        # của cả tài liệu đến cuối, nên RAM không tăng theo độ dài tài liệu.
+        with span("index_update"):
+            faiss_manager.update_chunks(new_ids, [e for _, e in rows], docs=docs)
+        state["inserted"] += len(rows)
+
+    # Ghi các trang đã đủ dòng. Trong lúc ảnh trang chưa xong thì giữ lại (tối đa INGEST_MAX_BUFFERED_CHUNKS chunk) để
+    # embedding vẫn chạy song song với render ảnh; final=True ghi nốt phần còn lại.
+    def flush(final=False):
+        if not state["images_ready"]:
+            if not final and not images_future.done() and len(pending) < Config.INGEST_MAX_BUFFERED_CHUNKS:
+                return
+            wait_for_images()
+        page_size = max(1, Config.INGEST_INSERT_PAGE_SIZE)
+        while pending and (final or len(pending) >= page_size):
+            rows = pending[:page_size]
+            del pending[:page_size]
+            report("db_write", 0.35 + 0.5 * rows[-1][0]['metadata']['page'] / max(page_count, 1))
+            insert_page(rows)
+
+    for chunk in iter_chunks(ocr_bytes, safe_name, process_mode='image', page_url_map=page_map):
+        # Gán ID vào metadata chunk
         chunk['metadata']['file_id'] = file_id
         chunk['metadata']['original_filename'] = original_filename
+        state["total"] += 1
 
-    table_name = "documents"
-    
-    # 4. Lấy giá trị hash cũ dựa trên FILE_ID của phiên bản trước của tài liệu để so sánh với hash mới.
-    old_docs_response = supabase.table(table_name)\
-        .select('id, metadata')\
-        .eq('metadata->>file_id', file_id)\
-        .execute()
-    
-    old_hashes_map = {} 
-    
-    if old_docs_response.data: # Lưu lại map giữa hash cũ và id của chunk cũ.
-        for doc in old_docs_response.data:
-            meta = doc.get('metadata', {})
-            h = meta.get('content_hash')
-            if h:
-                old_hashes_map[h] = doc['id']
-            
-    # 5. Phân loại thành 2 loại chunk.
-    chunks_to_insert = [] # Chunks mới.
-    ids_to_keep = [] # Chunks cũ.
-    
-    for chunk in new_chunks:
         h = chunk['hash'] # Lấy hash của chunk mới.
+        new_hashes_set.add(h)
         if h in old_hashes_map:
             ids_to_keep.append(old_hashes_map[h])
-            # Cập nhật lại metadata (page_url, source_file) cho chunk cũ
             # Supabase vector update hơi có vấn đề nên đôi khi link ảnh của chunk cũ sẽ trỏ về file PDF cũ (vẫn xem được bình thường).
-        else:
-            chunk['metadata']['content_hash'] = h # Cập nhật hash mới cho chunk cũ.
-            chunks_to_insert.append(chunk)
-    
-    new_hashes_set = set(c['hash'] for c in new_chunks) # Lấy tất cả hash của chunks mới.
-    ids_to_delete = [oid for h, oid in old_hashes_map.items() if h not in new_hashes_set] # Lấy tất cả id của chunks cũ không có trong chunks mới.
+            continue
+
+        chunk['metadata']['content_hash'] = h # Cập nhật hash mới cho chunk.
+        batch.append(chunk)
+        if len(batch) >= Config.INGEST_EMBED_BATCH:
+            report("embedding", 0.35 + 0.5 * chunk['metadata']['page'] / max(page_count, 1))
+            embed(batch)
+            batch = []
+            flush()
+
+    if batch:
+        report("embedding", 0.85)
+        embed(batch)
+    flush(final=True)
 
-    print(f"--- Update: Insert {len(chunks_to_insert)}, Keep {len(ids_to_keep)}, Delete {len(ids_to_delete)} ---")
+    # 5. Xóa các chunk cũ không còn trong phiên bản mới (sau khi đã ghi bản mới để tài liệu không bị trống giữa chừng).
+    ids_to_delete = [oid for h, oid in old_hashes_map.items() if h not in new_hashes_set]
+    print(f"--- Update: {state['total']} chunks, Insert {state['inserted']}, Keep {len(ids_to_keep)}, Delete {len(ids_to_delete)} ---")
 
-    # 6. Thực hiện các thao tác trên database.
+    report("db_write", 0.9)
     if ids_to_delete: # Xóa chunks cũ.
-        supabase.table(table_name).delete().in_('id', ids_to_delete).execute()
-        
-    if chunks_to_insert:
-        contents = [c['content'] for c in chunks_to_insert]
-        print("--- Embedding new chunks ---")
-        embeddings = embed_model.encode(contents, batch_size=32, show_progress_bar=True)
-        
-        data = [{
-            "content": c['content'],
-            "metadata": c['metadata'],
-            "embedding": e.tolist()
-        } for c, e in zip(chunks_to_insert, embeddings)]
-        
-        supabase.table(table_name).insert(data).execute()
-        
-    if ids_to_delete or chunks_to_insert:
-        faiss_manager.refresh_index()
-            
-    return True, f"Cập nhật {original_filename}: +{len(chunks_to_insert)} mới, -{len(ids_to_delete)} cũ."
+        with span("db_delete"):
+            supabase.table("documents").delete().in_('id', ids_to_delete).execute()
+    if ids_to_delete:
+        with span("index_update"):
+            faiss_manager.remove_chunks(ids_to_delete)
+        answer_cache.invalidate_chunks(ids_to_delete) # Câu trả lời AI dựa trên chunk cũ không còn đúng.
+    mark_latest_version(file_id, file_hash)
+
+    return True, f"Cập nhật {original_filename}: +{state['inserted']} mới, -{len(ids_to_delete)} cũ."
     
     return False, "Không trích xuất được nội dung."
 
 # Hàm xóa tài liệu và các dữ liệu liên quan.
 def delete_document(safe_name):
     try:
-        # Xóa DB dựa trên source_file (safe_name)
+        # Xóa DB dựa trên source_file (safe_name), giữ lại danh sách id (lấy theo trang, không bị giới hạn 1000 dòng) để xóa khỏi chỉ mục.
+        removed_ids = [row['id'] for row in fetch_rows('id', filters={'metadata->>source_file': safe_name})]
         supabase.table('documents').delete().eq('metadata->>source_file', safe_name).execute()
         
         # Xóa file PDF gốc
@@ -244,9 +430,11 @@ def delete_document(safe_name):
         if files:
             targets = [f"{path}/{f['name']}" for f in files]
             supabase.storage.from_(Config.BUCKET_NAME).remove(targets)
+        page_renderer.purge(safe_name) # Ảnh render theo yêu cầu (chế độ lazy) đã cache trên đĩa.
             
-        # Refresh index
-        faiss_manager.refresh_index()
+        # Cập nhật chỉ mục: chỉ bỏ các vector của tài liệu vừa xóa
+        faiss_manager.remove_chunks(removed_ids)
+        answer_cache.invalidate_chunks(removed_ids)
         return True, "Xóa thành công"
     except Exception as e:
         return False, str(e)
\ No newline at end of file